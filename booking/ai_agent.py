@@ -14,6 +14,7 @@ from typing import Any, Dict, List, Optional, Tuple
 from langchain_core.messages import HumanMessage, SystemMessage
 
 from core.file_utils import read_docx, read_pdf, read_text_file
+from core.llm import invoke_llm
 
 
 # ==================== PROMPTS ====================
@@ -512,7 +513,7 @@ def _extract_pdf_with_openai(llm: Any, path: str) -> str:
                 {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}}
             )
         doc.close()
-        resp = llm.invoke([HumanMessage(content=content_parts)])
+        resp = invoke_llm(llm, [HumanMessage(content=content_parts)], step="booking_extract")
         return resp.content
     except ImportError:
         return ""
@@ -532,7 +533,7 @@ def _extract_image_with_openai(llm: Any, path: str) -> str:
         {"type": "text", "text": "Trích xuất toàn bộ văn bản từ hình ảnh này. Giữ nguyên format, số, ngày tháng."},
         {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}},
     ])
-    resp = llm.invoke([msg])
+    resp = invoke_llm(llm, [msg], step="booking_extract")
     return resp.content
 
 
@@ -616,10 +617,10 @@ def extract_trip_info(llm: Any, input_dir: str, guest_names: list = None) -> Dic
 
     # Call AI to extract trip info
     prompt = TRIP_EXTRACTOR_PROMPT.format(text=combined_text)
-    response = llm.invoke([
+    response = invoke_llm(llm, [
         SystemMessage(content="Bạn là chuyên viên xử lý hồ sơ visa. Trả về JSON hợp lệ."),
         HumanMessage(content=prompt),
-    ])
+    ], step="booking_trip")
 
     trip_info = _safe_json_loads(response.content)
     if not isinstance(trip_info, dict):
@@ -740,10 +741,10 @@ def ai_select_bookings(llm: Any, trip_info: Dict[str, Any]) -> Dict[str, Any]:
     trip_info_str = json.dumps(trip_info, ensure_ascii=False, indent=2)
     prompt = BOOKING_EXPERT_PROMPT.format(trip_info=trip_info_str)
 
-    response = llm.invoke([
+    response = invoke_llm(llm, [
         SystemMessage(content="Bạn là chuyên gia booking quốc tế. Trả về JSON hợp lệ với thông tin khách sạn và chuyến bay THẬT."),
         HumanMessage(content=prompt),
-    ])
+    ], step="booking_select")
 
     booking_data = _safe_json_loads(response.content)
 
@@ -7,10 +7,11 @@ import shutil
 from typing import Any, Dict, List, Optional
 
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfReader
 
+from core.llm import get_chat_model, invoke_llm, submit_with_scope
 from core.prompts import SYSTEM_BASE
+from pdf_tools.pdf_service import get_page_count, write_split_documents
 
 
 def _sanitize_name(value: str, fallback: str) -> str:
@@ -79,12 +80,14 @@ def _extract_name_from_filename(filename: str) -> str:
     return ""
 
 
-def _pick_unique_destination(dest_dir: str, stem: str, ext: str) -> str:
+def _pick_unique_destination(dest_dir: str, stem: str, ext: str, reserved: Optional[set] = None) -> str:
     candidate = os.path.join(dest_dir, f"{stem}{ext}")
     idx = 1
-    while os.path.exists(candidate):
+    while os.path.exists(candidate) or (reserved is not None and candidate in reserved):
         candidate = os.path.join(dest_dir, f"{stem} ({idx}){ext}")
         idx += 1
+    if reserved is not None:
+        reserved.add(candidate)
     return candidate
 
 
@@ -202,7 +205,7 @@ def _classify_single(llm: Any, filename: str, text: str) -> Optional[Dict[str, s
     """Classify a single-doc file with 1 API call."""
     prompt = _build_classify_prompt(filename, text)
     try:
-        result = llm.invoke([SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)])
+        result = invoke_llm(llm, [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)], step="classifier")
         raw = result.content or ""
         # Extract JSON from response
         match = re.search(r'\{[^{}]*\}', raw, re.DOTALL)
@@ -229,7 +232,7 @@ def _classify_multi_page_pdf(llm: Any, filename: str, page_texts: List[str]) ->
     """Classify a multi-page PDF: detect + classify ALL documents in 1 API call."""
     prompt = _build_classify_prompt_multi(filename, page_texts)
     try:
-        result = llm.invoke([SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)])
+        result = invoke_llm(llm, [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)], step="classifier")
         raw = result.content or ""
         # Extract JSON from response
         match = re.search(r'\{.*\}', raw, re.DOTALL)
@@ -344,17 +347,15 @@ def _split_and_copy_pdf(
     output_dir: str,
     docs: List[Dict[str, Any]],
 ) -> List[Dict[str, Any]]:
-    reader = PdfReader(src_path)
-    total = len(reader.pages)
+    total = get_page_count(src_path)
     results: List[Dict[str, Any]] = []
+    documents: List[Dict[str, Any]] = []
+    reserved: set = set()
     for item in docs:
         s = int(item["start_page"])
         e = int(item["end_page"])
         if s < 1 or e > total or s > e:
             continue
-        writer = PdfWriter()
-        for i in range(s - 1, e):
-            writer.add_page(reader.pages[i])
         person_dir = os.path.join(output_dir, _sanitize_name(item["person_name"], "UNKNOWN PERSON"))
         os.makedirs(person_dir, exist_ok=True)
         domain = _resolve_domain_prefix(item["doc_type_en"])
@@ -362,9 +363,9 @@ def _split_and_copy_pdf(
         pname = _sanitize_name(item["person_name"], "UNKNOWN").replace(" ", "_")
         # Format: DOMAIN_PersonName_DocType.pdf
         stem = f"{domain}_{pname}_{doc}"
-        out_path = _pick_unique_destination(person_dir, stem, ".pdf")
-        with open(out_path, "wb") as f:
-            writer.write(f)
+        # Files are written together below, so also skip names taken in this batch
+        out_path = _pick_unique_destination(person_dir, stem, ".pdf", reserved)
+        documents.append({"pages": list(range(s - 1, e)), "path": out_path})
         results.append({
             "filename": os.path.basename(src_path),
             "pages": f"{s}-{e}",
@@ -372,6 +373,8 @@ def _split_and_copy_pdf(
             "doc_type_en": item["doc_type_en"],
             "to": os.path.relpath(out_path, output_dir).replace("\\", "/"),
         })
+    # One open of the source for every output document
+    write_split_documents(src_path, documents)
     return results
 
 
@@ -387,7 +390,7 @@ def classify_files_in_folder(
         raise FileNotFoundError(f"Folder not found: {input_dir}")
     os.makedirs(output_dir, exist_ok=True)
 
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
     files: List[str] = []
     for root, _, names in os.walk(input_dir):
         for name in sorted(names):
@@ -490,7 +493,7 @@ def classify_files_in_folder(
     future_to_src = {}
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         for src_path in files:
-            future = executor.submit(_process_single_file, src_path)
+            future = submit_with_scope(executor, _process_single_file, src_path)
             future_to_src[future] = src_path
 
         for future in as_completed(future_to_src):
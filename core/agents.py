@@ -1,14 +1,26 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from langchain_core.messages import HumanMessage, SystemMessage
 
-from core.file_utils import read_docx, read_pdf, read_text_file
+from core.extract_cache import get_extraction_cache, llm_model_name
+from core.file_utils import (
+    file_content_hash,
+    file_fingerprint,
+    fingerprint_matches,
+    read_docx,
+    read_pdf,
+    read_text_file,
+)
+from core.llm import invoke_llm, stream_llm, submit_with_scope
 from core.prompts import (
     EMPLOYMENT_EXTRACT_PROMPT,
     FILE_EXTRACT_TEXT_PROMPT,
@@ -57,45 +69,72 @@ def _image_to_base64(data: bytes) -> str:
 
 def _llm_extract_from_text(llm: Any, text: str) -> str:
     prompt = FILE_EXTRACT_TEXT_PROMPT.format(text=text)
-    result = llm.invoke([SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)])
+    result = invoke_llm(llm, [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)], step="ingest")
     return result.content or ""
 
 
-def _llm_extract_from_image_bytes(llm: Any, image_bytes: bytes) -> str:
+def _llm_extract_from_image_bytes(llm: Any, image_bytes: bytes, mime_type: str = "image/png") -> str:
     b64 = _image_to_base64(image_bytes)
     message = HumanMessage(
         content=[
             {"type": "text", "text": FILE_OCR_IMAGE_PROMPT},
-            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}},
+            {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{b64}"}},
         ]
     )
-    result = llm.invoke([SystemMessage(content=SYSTEM_BASE), message])
+    result = invoke_llm(llm, [SystemMessage(content=SYSTEM_BASE), message], step="ingest")
     return result.content or ""
 
 
-def _extract_pdf_with_openai(llm: Any, path: str) -> str:
-    text = read_pdf(path)
-    if text.strip():
-        return _llm_extract_from_text(llm, text)
+DEFAULT_OCR_WORKERS = 4
 
+
+def _ocr_workers() -> int:
     try:
-        import pdfplumber
-        from PIL import Image
+        return max(1, int(os.getenv("OCR_MAX_WORKERS", str(DEFAULT_OCR_WORKERS))))
+    except ValueError:
+        return DEFAULT_OCR_WORKERS
+
+
+def _ocr_scanned_pdf(llm: Any, path: str) -> Tuple[str, bool]:
+    """OCR every page in parallel. Returns (text, complete); complete is False when
+    any page failed to render or OCR, so the partial text must not be cached."""
+    try:
+        import fitz
+        from pdf_tools.pdf_service import render_page_jpeg
     except Exception:
-        return text
+        return "", False
 
-    texts: List[str] = []
-    with pdfplumber.open(path) as pdf:
-        for page in pdf.pages:
+    doc = fitz.open(path)
+    texts: List[str] = [""] * len(doc)
+    failed: List[int] = []
+    with ThreadPoolExecutor(max_workers=_ocr_workers()) as executor:
+        futures = {}
+        try:
+            # Render on this thread while earlier pages are already being OCR'd
+            for page_idx in range(len(doc)):
+                try:
+                    jpeg_bytes = render_page_jpeg(doc[page_idx])
+                except Exception:
+                    failed.append(page_idx)
+                    continue
+                future = submit_with_scope(executor, _llm_extract_from_image_bytes, llm, jpeg_bytes, "image/jpeg")
+                futures[future] = page_idx
+        finally:
+            doc.close()
+        for future in as_completed(futures):
             try:
-                page_image = page.to_image().original
-                if isinstance(page_image, Image.Image):
-                    buffer = BytesIO()
-                    page_image.save(buffer, format="PNG")
-                    texts.append(_llm_extract_from_image_bytes(llm, buffer.getvalue()))
-            except Exception:
-                continue
-    return "\n".join(t for t in texts if t)
+                texts[futures[future]] = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"[ocr] {os.path.basename(path)} page {futures[future] + 1} failed: {e}")
+    return "\n".join(t for t in texts if t), not failed
+
+
+def _extract_pdf_with_openai(llm: Any, path: str) -> Tuple[str, bool]:
+    text = read_pdf(path)
+    if text.strip():
+        return _llm_extract_from_text(llm, text), True
+    return _ocr_scanned_pdf(llm, path)
 
 
 def _extract_image_with_openai(llm: Any, path: str) -> str:
@@ -110,7 +149,10 @@ def _extract_image_with_openai(llm: Any, path: str) -> str:
         return ""
 
 
-def extract_text_with_openai(llm: Any, path: str) -> str:
+LLM_EXTRACT_EXTENSIONS = [".pdf", ".png", ".jpg", ".jpeg", ".tiff", ".bmp"]
+
+
+def extract_text_with_openai(llm: Any, path: str, content_hash: Optional[str] = None) -> str:
     ext = os.path.splitext(path)[1].lower()
     if ext in [".txt", ".md"]:
         return read_text_file(path)
@@ -119,32 +161,148 @@ def extract_text_with_openai(llm: Any, path: str) -> str:
             return read_docx(path)
         except Exception:
             return ""
+    if ext not in LLM_EXTRACT_EXTENSIONS:
+        return ""
+
+    # PDFs and images go through the LLM: reuse any earlier result for the same bytes
+    cache = get_extraction_cache()
+    model = llm_model_name(llm)
+    try:
+        key = cache.make_key(content_hash, model) if content_hash else cache.key_for_file(path, model)
+    except OSError:
+        key = None
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
     if ext == ".pdf":
-        return _extract_pdf_with_openai(llm, path)
-    if ext in [".png", ".jpg", ".jpeg", ".tiff", ".bmp"]:
-        return _extract_image_with_openai(llm, path)
-    return ""
+        text, complete = _extract_pdf_with_openai(llm, path)
+    else:
+        text, complete = _extract_image_with_openai(llm, path), True
 
+    # Empty output usually means a failed call, and a partial OCR (some pages hit a
+    # 429/timeout) would be pinned forever - only cache complete extractions
+    if key and complete and text.strip():
+        cache.put(key, text, {"name": os.path.basename(path), "model": model})
+    return text
 
-def ingest_files(state: GraphState) -> GraphState:
-    input_dir = state["input_dir"]
-    llm = state["llm"]
-    files: List[Dict[str, str]] = []
 
-    for root, _, filenames in os.walk(input_dir):
-        for fname in filenames:
-            path = os.path.join(root, fname)
-            text = extract_text_with_openai(llm, path)
-            files.append(
-                {
-                    "path": path,
-                    "name": fname,
-                    "text": text,
-                    "domain": detect_domain(fname),
-                }
-            )
+DEFAULT_INGEST_WORKERS = 6
+
+
+def _ingest_workers() -> int:
+    try:
+        return max(1, int(os.getenv("INGEST_MAX_WORKERS", str(DEFAULT_INGEST_WORKERS))))
+    except ValueError:
+        return DEFAULT_INGEST_WORKERS
+
+
+def list_input_paths(input_dir: str) -> List[str]:
+    paths: List[str] = []
+    for root, dirs, filenames in os.walk(input_dir):
+        dirs.sort()
+        for fname in sorted(filenames):
+            paths.append(os.path.join(root, fname))
+    return paths
+
 
-    state["files"] = files
+def build_file_record(llm: Any, path: str) -> Dict[str, Any]:
+    fname = os.path.basename(path)
+    # Fingerprint before extracting so a file edited mid-run is picked up next time;
+    # the same content hash keys the extraction cache, so the file is read once
+    try:
+        content_hash: Optional[str] = file_content_hash(path)
+        fingerprint: Dict[str, Any] = file_fingerprint(path, content_hash)
+    except OSError:
+        content_hash = None
+        fingerprint = {}
+    text = extract_text_with_openai(llm, path, content_hash)
+    if not text.strip():
+        # Empty text usually means a swallowed API error: leave it unfingerprinted
+        # so the next incremental ingest extracts the file again
+        fingerprint = {}
+    return {
+        "path": path,
+        "name": fname,
+        "text": text,
+        "domain": detect_domain(fname),
+        "fingerprint": fingerprint,
+    }
+
+
+def plan_incremental_ingest(
+    paths: List[str], previous_files: Optional[List[Dict[str, Any]]]
+) -> Tuple[Dict[int, Dict[str, Any]], List[int]]:
+    """Split ``paths`` into records reusable from ``previous_files`` and indexes to extract.
+
+    A previous record is reused only when it has text and its fingerprint still matches
+    the file on disk; files that disappeared are dropped simply by not being in ``paths``.
+    """
+    by_path = {
+        item.get("path"): item for item in (previous_files or []) if isinstance(item, dict)
+    }
+    reused: Dict[int, Dict[str, Any]] = {}
+    to_extract: List[int] = []
+    for idx, path in enumerate(paths):
+        previous = by_path.get(path)
+        if previous is not None and not str(previous.get("text") or "").strip():
+            previous = None
+        fingerprint = fingerprint_matches(path, previous.get("fingerprint")) if previous else None
+        if previous is not None and fingerprint is not None:
+            reused[idx] = {**previous, "fingerprint": fingerprint}
+        else:
+            to_extract.append(idx)
+    return reused, to_extract
+
+
+def iter_extract_files(
+    llm: Any, paths: List[str], max_workers: Optional[int] = None
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Extract files concurrently, yielding ``(index, record)`` as each one finishes.
+
+    ``index`` is the position in ``paths`` so callers can rebuild a stable order.
+    """
+    if not paths:
+        return
+    workers = min(max_workers or _ingest_workers(), len(paths))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {
+            submit_with_scope(executor, build_file_record, llm, path): idx for idx, path in enumerate(paths)
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                record = future.result()
+            except Exception:
+                fname = os.path.basename(paths[idx])
+                record = {"path": paths[idx], "name": fname, "text": "", "domain": detect_domain(fname)}
+            yield idx, record
+    finally:
+        # If the consumer stops early (e.g. SSE client disconnected) drop queued work
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def ingest_files(state: GraphState) -> GraphState:
+    paths = list_input_paths(state["input_dir"])
+    previous = [] if state.get("full_reingest") else state.get("files", [])
+    reused, to_extract = plan_incremental_ingest(paths, previous)
+
+    files: List[Optional[Dict[str, Any]]] = [None] * len(paths)
+    for idx, record in reused.items():
+        files[idx] = record
+    pending = [paths[idx] for idx in to_extract]
+    for pending_idx, record in iter_extract_files(state["llm"], pending):
+        files[to_extract[pending_idx]] = record
+
+    previous_paths = {item.get("path") for item in previous if isinstance(item, dict)}
+    state["files"] = [f for f in files if f is not None]
+    state["ingest_stats"] = {
+        "reused": len(reused),
+        "extracted": len(to_extract),
+        "removed": len(previous_paths - set(paths)),
+    }
     return state
 
 
@@ -184,35 +342,88 @@ def _trim_text_for_summary(text: str, max_chars: int = 12000) -> str:
     return f"{head}\n\n...[TRUNCATED]...\n\n{tail}"
 
 
+SUMMARY_MAX_RETRIES = 3
+SUMMARY_RETRY_DELAY = 2  # seconds
+
+
+def _summary_group_prompt(title: str, files: List[Dict[str, str]]) -> str:
+    file_list = ", ".join(f.get("name", "") for f in files if f.get("name"))
+    compact_files = [
+        {
+            "file_name": f.get("name", ""),
+            "content": _trim_text_for_summary(f.get("text", "")),
+        }
+        for f in files
+    ]
+    return SUMMARY_GROUP_PROMPT.format(
+        group_title=title,
+        file_count=len(files),
+        file_list=file_list,
+        files_json=json.dumps(compact_files, ensure_ascii=False),
+    )
+
+
+def _summarize_domain(llm: Any, title: str, prompt: str) -> str:
+    # Each domain retries on its own so one flaky call doesn't redo the others
+    for attempt in range(1, SUMMARY_MAX_RETRIES + 1):
+        try:
+            result = invoke_llm(llm, [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)], step="summary")
+            return (result.content or "").strip()
+        except Exception as e:
+            print(f"  [summary {title}] attempt {attempt} failed: {str(e)[:100]}")
+            if attempt == SUMMARY_MAX_RETRIES:
+                raise
+            time.sleep(SUMMARY_RETRY_DELAY * attempt)
+    return ""
+
+
+def _summary_section_hash(model: str, prompt: str) -> str:
+    hasher = hashlib.sha256()
+    for part in (model, SYSTEM_BASE, prompt):
+        hasher.update(part.encode("utf-8"))
+    return hasher.hexdigest()
+
+
 def build_summary_profile(state: GraphState) -> GraphState:
     llm = state["llm"]
+    model = llm_model_name(llm)
     grouped = classify_files(state).get("grouped", {})
-    sections: List[str] = []
+    # {domain: {"hash", "text"}} from the previous run; only domains whose
+    # compact_files payload changed are sent to the model again.
+    memo = state.get("summary_sections") or {}
+    new_memo: Dict[str, Dict[str, str]] = {}
+    sections: Dict[str, str] = {}
+    prompts: Dict[str, str] = {}
 
     for domain, title in SUMMARY_DOMAIN_ORDER:
         files = grouped.get(domain, [])
         if not files:
-            sections.append(f"`{title}` có 0 file.")
+            sections[domain] = f"`{title}` có 0 file."
             continue
-
-        file_list = ", ".join(f.get("name", "") for f in files if f.get("name"))
-        compact_files = [
-            {
-                "file_name": f.get("name", ""),
-                "content": _trim_text_for_summary(f.get("text", "")),
+        prompt = _summary_group_prompt(title, files)
+        section_hash = _summary_section_hash(model, prompt)
+        cached = memo.get(domain) or {}
+        if cached.get("hash") == section_hash and cached.get("text"):
+            sections[domain] = cached["text"]
+            new_memo[domain] = cached
+            continue
+        prompts[domain] = prompt
+        new_memo[domain] = {"hash": section_hash, "text": ""}
+
+    if prompts:
+        titles = dict(SUMMARY_DOMAIN_ORDER)
+        with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+            futures = {
+                domain: submit_with_scope(executor, _summarize_domain, llm, titles[domain], prompt)
+                for domain, prompt in prompts.items()
             }
-            for f in files
-        ]
-        prompt = SUMMARY_GROUP_PROMPT.format(
-            group_title=title,
-            file_count=len(files),
-            file_list=file_list,
-            files_json=json.dumps(compact_files, ensure_ascii=False),
-        )
-        result = llm.invoke([SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)])
-        sections.append((result.content or "").strip())
+            for domain, future in futures.items():
+                sections[domain] = future.result()
+                new_memo[domain]["text"] = sections[domain]
 
-    state["summary_profile"] = "\n\n".join(s for s in sections if s).strip()
+    state["summary_sections"] = new_memo
+    ordered = [sections.get(domain, "") for domain, _ in SUMMARY_DOMAIN_ORDER]
+    state["summary_profile"] = "\n\n".join(s for s in ordered if s).strip()
     return state
 
 
@@ -234,8 +445,8 @@ def domain_agent(domain: str):
 
         content = "\n\n".join(t for t in texts if t)
         prompt = _domain_prompt(domain, content)
-        result = llm.invoke(
-            [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)]
+        result = invoke_llm(
+            llm, [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)], step=f"domain_{domain}"
         )
         parsed = _safe_json_loads(result.content)
         state.setdefault("extracted", {})[domain] = parsed
@@ -612,8 +823,7 @@ def _build_visa_relevance(extracted: Dict[str, Any]) -> List[str]:
     return items
 
 
-def letter_writer(state: GraphState) -> GraphState:
-    llm = state["llm"]
+def _letter_writer_messages(state: GraphState) -> List[Any]:
     summary_profile = (state.get("summary_profile") or "").strip()
     state["summary_profile"] = summary_profile
     prompt = LETTER_WRITER_PROMPT.format(summary_profile=summary_profile)
@@ -623,16 +833,32 @@ def letter_writer(state: GraphState) -> GraphState:
             "\n\nTHÔNG TIN BỔ SUNG TỪ NGƯỜI DÙNG (ƯU TIÊN SỬ DỤNG NẾU KHÔNG MÂU THUẪN INPUT):\n"
             f"{writer_context}\n"
         )
-    result = llm.invoke([SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)])
+    return [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)]
+
+
+def letter_writer(state: GraphState) -> GraphState:
+    result = invoke_llm(state["llm"], _letter_writer_messages(state), step="writer")
     state["letter_full"] = result.content
     return state
 
 
+def stream_letter_writer(state: GraphState) -> Iterator[str]:
+    """Like ``letter_writer`` but yields the letter chunk by chunk.
+
+    ``state["letter_full"]`` is only set once the whole letter has arrived.
+    """
+    parts: List[str] = []
+    for chunk in stream_llm(state["llm"], _letter_writer_messages(state), step="writer"):
+        parts.append(chunk)
+        yield chunk
+    state["letter_full"] = "".join(parts)
+
+
 def itinerary_writer(llm: Any, flight_text: str, hotel_text: str, summary_profile: str) -> str:
     prompt = ITINERARY_PROMPT.format(
         flight_text=flight_text,
         hotel_text=hotel_text,
         summary_profile=summary_profile,
     )
-    result = llm.invoke([SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)])
+    result = invoke_llm(llm, [SystemMessage(content=SYSTEM_BASE), HumanMessage(content=prompt)], step="itinerary")
     return result.content or ""
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.file_utils import file_content_hash
+from core.prompts import FILE_EXTRACT_TEXT_PROMPT, FILE_OCR_IMAGE_PROMPT, SYSTEM_BASE
+
+
+# Bump when the extraction pipeline changes in a way the prompt text does not capture
+# (render resolution, image encoding, page joining, ...).
+EXTRACT_PIPELINE_VERSION = "2"
+
+DEFAULT_CACHE_DIR = os.path.join("output", "cache", "extract")
+DEFAULT_CACHE_MAX_MB = 512
+
+
+def _prompt_version() -> str:
+    hasher = hashlib.sha256()
+    for part in (EXTRACT_PIPELINE_VERSION, SYSTEM_BASE, FILE_EXTRACT_TEXT_PROMPT, FILE_OCR_IMAGE_PROMPT):
+        hasher.update(part.encode("utf-8"))
+    return hasher.hexdigest()[:12]
+
+
+PROMPT_VERSION = _prompt_version()
+
+
+def llm_model_name(llm: Any) -> str:
+    return str(getattr(llm, "model_name", None) or getattr(llm, "model", None) or "")
+
+
+class ExtractionCache:
+    """On-disk cache of extracted text keyed by file content + model + prompt version.
+
+    Entries are small JSON files; the least recently used ones are evicted once the
+    directory grows past ``max_bytes``. Safe to share between request threads.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+
+    def make_key(self, content_hash: str, model: str) -> str:
+        raw = f"{content_hash}:{model}:{PROMPT_VERSION}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def key_for_file(self, path: str, model: str) -> str:
+        return self.make_key(file_content_hash(path), model)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # mtime doubles as the LRU clock
+            os.utime(path, None)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry.get("text", "")
+
+    def put(self, key: str, text: str, meta: Optional[Dict[str, Any]] = None) -> None:
+        path = self._entry_path(key)
+        entry = {"text": text, "prompt_version": PROMPT_VERSION, "created_at": time.time()}
+        if meta:
+            entry.update(meta)
+        payload = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            total = self._current_total_locked() + len(payload) - previous
+            self._total_bytes = total
+            if total > self.max_bytes:
+                self._evict_locked()
+
+    def _scan_entries(self) -> List[Tuple[float, int, str]]:
+        entries: List[Tuple[float, int, str]] = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for root, _, filenames in os.walk(self.cache_dir):
+            for fname in filenames:
+                if not fname.endswith(".json"):
+                    continue
+                path = os.path.join(root, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _current_total_locked(self) -> int:
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, size, _ in self._scan_entries())
+        return self._total_bytes
+
+    def _evict_locked(self) -> None:
+        entries = sorted(self._scan_entries())
+        total = sum(size for _, size, _ in entries)
+        # Evict down to 90% so we don't rescan on every subsequent put
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._total_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "cache_dir": self.cache_dir,
+                "prompt_version": PROMPT_VERSION,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "size_bytes": self._current_total_locked(),
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache: Optional[ExtractionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_extraction_cache() -> ExtractionCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache_dir = os.getenv("EXTRACT_CACHE_DIR", DEFAULT_CACHE_DIR)
+                try:
+                    max_mb = int(os.getenv("EXTRACT_CACHE_MAX_MB", str(DEFAULT_CACHE_MAX_MB)))
+                except ValueError:
+                    max_mb = DEFAULT_CACHE_MAX_MB
+                _cache = ExtractionCache(cache_dir, max_mb * 1024 * 1024)
+    return _cache
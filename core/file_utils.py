@@ -1,5 +1,44 @@
 from __future__ import annotations
 
+import hashlib
+import os
+from typing import Any, Dict, Optional
+
+
+def file_content_hash(path: str, chunk_size: int = 1024 * 1024) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def file_fingerprint(path: str, content_hash: Optional[str] = None) -> Dict[str, Any]:
+    st = os.stat(path)
+    return {
+        "mtime": st.st_mtime_ns,
+        "size": st.st_size,
+        "sha256": content_hash or file_content_hash(path),
+    }
+
+
+def fingerprint_matches(path: str, fingerprint: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Return an up-to-date fingerprint if ``path`` still has the content described by
+    ``fingerprint``, otherwise None. mtime+size is trusted as-is; a changed mtime with the
+    same size falls back to comparing the content hash (e.g. file copied or touched)."""
+    if not isinstance(fingerprint, dict) or not fingerprint.get("sha256"):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_size != fingerprint.get("size"):
+        return None
+    if st.st_mtime_ns == fingerprint.get("mtime"):
+        return fingerprint
+    current = file_fingerprint(path)
+    return current if current["sha256"] == fingerprint["sha256"] else None
+
 
 def read_text_file(path: str) -> str:
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+
+# ==================== CALL SCOPES ====================
+
+class _CallScope:
+    """Pipeline step + project attribution for LLM calls made inside a request.
+
+    Nested scopes share the parent's prompt registry, so identical prompts are
+    detected across every step of the same request.
+    """
+
+    def __init__(self, step: str, project_id: Optional[int], seen: Optional[Dict[str, int]] = None) -> None:
+        self.step = step
+        self.project_id = project_id
+        self.seen = seen if seen is not None else {}
+        self.lock = threading.Lock()
+
+    def mark_prompt(self, fingerprint: str) -> bool:
+        with self.lock:
+            count = self.seen.get(fingerprint, 0)
+            self.seen[fingerprint] = count + 1
+            return count > 0
+
+
+_current_scope: contextvars.ContextVar[Optional[_CallScope]] = contextvars.ContextVar(
+    "llm_call_scope", default=None
+)
+
+
+@contextmanager
+def llm_call_scope(step: str, project_id: Optional[int] = None) -> Iterator[None]:
+    """Attribute every LLM call in this block to ``step`` (and ``project_id``)."""
+    parent = _current_scope.get()
+    if parent is not None:
+        if project_id is None:
+            project_id = parent.project_id
+        scope = _CallScope(step, project_id, parent.seen)
+        scope.lock = parent.lock
+    else:
+        scope = _CallScope(step, project_id)
+    token = _current_scope.set(scope)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+
+
+def submit_with_scope(executor: Executor, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+    """``executor.submit`` that carries the current LLM call scope into the worker thread."""
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, fn, *args, **kwargs)
+
+
+# ==================== USAGE STATS ====================
+
+def _empty_counters() -> Dict[str, Any]:
+    return {
+        "calls": 0,
+        "errors": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "latency_ms": 0.0,
+        "duplicate_prompts": 0,
+    }
+
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, Dict[str, Any]]] = {"steps": {}, "projects": {}, "models": {}}
+
+
+def _record(
+    step: str,
+    project_id: Optional[int],
+    model: str,
+    latency_ms: float,
+    usage: Dict[str, int],
+    duplicate: bool,
+    error: bool,
+) -> None:
+    buckets = [("steps", step), ("models", model or "unknown")]
+    if project_id is not None:
+        buckets.append(("projects", str(project_id)))
+    with _stats_lock:
+        for group, key in buckets:
+            counters = _stats[group].setdefault(key, _empty_counters())
+            counters["calls"] += 1
+            counters["errors"] += int(error)
+            counters["input_tokens"] += usage.get("input_tokens", 0)
+            counters["output_tokens"] += usage.get("output_tokens", 0)
+            counters["latency_ms"] += latency_ms
+            counters["duplicate_prompts"] += int(duplicate)
+
+
+def get_llm_usage_snapshot() -> Dict[str, Any]:
+    with _stats_lock:
+        snapshot = {group: {k: dict(v) for k, v in values.items()} for group, values in _stats.items()}
+    for values in snapshot.values():
+        for counters in values.values():
+            calls = counters["calls"] or 1
+            counters["latency_ms"] = round(counters["latency_ms"], 1)
+            counters["avg_latency_ms"] = round(counters["latency_ms"] / calls, 1)
+    totals = _empty_counters()
+    for counters in snapshot["steps"].values():
+        for key in totals:
+            totals[key] += counters[key]
+    totals["latency_ms"] = round(totals["latency_ms"], 1)
+    snapshot["totals"] = totals
+    return snapshot
+
+
+def reset_llm_usage() -> None:
+    with _stats_lock:
+        for values in _stats.values():
+            values.clear()
+
+
+# ==================== CLIENT REGISTRY ====================
+
+# One HTTP connection pool per API host, shared by every chat model in the process,
+# so sequential pipeline calls reuse warm keep-alive connections instead of paying a
+# TLS handshake per request-scoped client.
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "50"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "20"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "60"))
+
+_registry_lock = threading.Lock()
+_http_clients: Dict[str, Tuple[httpx.Client, httpx.AsyncClient]] = {}
+_chat_models: Dict[Tuple[Any, ...], ChatOpenAI] = {}
+_http_stats: Dict[str, Dict[str, int]] = {}
+_model_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _api_host() -> str:
+    base_url = os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+    return urlsplit(base_url).netloc or base_url
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def _get_http_clients(host: str) -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """Shared sync/async httpx clients for ``host`` (caller holds ``_registry_lock``)."""
+    clients = _http_clients.get(host)
+    if clients is None:
+        stats = _http_stats.setdefault(host, {"requests": 0, "errors": 0})
+
+        def on_response(response: httpx.Response) -> None:
+            with _registry_lock:
+                stats["requests"] += 1
+                stats["errors"] += int(response.status_code >= 400)
+
+        async def on_response_async(response: httpx.Response) -> None:
+            on_response(response)
+
+        clients = (
+            httpx.Client(limits=_http_limits(), event_hooks={"response": [on_response]}),
+            httpx.AsyncClient(limits=_http_limits(), event_hooks={"response": [on_response_async]}),
+        )
+        _http_clients[host] = clients
+    return clients
+
+
+def get_chat_model(model: str, temperature: float = 0, **kwargs: Any) -> ChatOpenAI:
+    """Process-wide ``ChatOpenAI`` for ``model`` (+ settings), built once and reused.
+
+    Instances are stateless between calls and safe to share across request threads;
+    all of them talk to the API through the pooled clients of ``_get_http_clients``.
+    ``stream_usage`` is on by default so ``stream_llm`` sees token counts.
+    """
+    kwargs.setdefault("stream_usage", True)
+    host = _api_host()
+    key = (host, model, temperature) + tuple(sorted(kwargs.items()))
+    with _registry_lock:
+        counters = _model_stats.setdefault(model, {"clients": 0, "lookups": 0})
+        counters["lookups"] += 1
+        llm = _chat_models.get(key)
+        if llm is None:
+            http_client, http_async_client = _get_http_clients(host)
+            llm = ChatOpenAI(
+                model=model,
+                temperature=temperature,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                **kwargs,
+            )
+            _chat_models[key] = llm
+            counters["clients"] += 1
+        return llm
+
+
+def get_llm_client_stats() -> Dict[str, Any]:
+    with _registry_lock:
+        return {
+            "limits": {
+                "max_connections": LLM_HTTP_MAX_CONNECTIONS,
+                "max_keepalive_connections": LLM_HTTP_MAX_KEEPALIVE,
+                "keepalive_expiry_sec": LLM_HTTP_KEEPALIVE_EXPIRY,
+            },
+            "hosts": {host: dict(counters) for host, counters in _http_stats.items()},
+            "models": {model: dict(counters) for model, counters in _model_stats.items()},
+        }
+
+
+# ==================== INVOCATION ====================
+
+def _model_name(llm: Any) -> str:
+    return str(getattr(llm, "model_name", None) or getattr(llm, "model", None) or "")
+
+
+def _prompt_fingerprint(model: str, messages: List[Any]) -> str:
+    hasher = hashlib.sha256(model.encode("utf-8"))
+    for msg in messages:
+        content = getattr(msg, "content", msg)
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+        hasher.update(type(msg).__name__.encode("utf-8"))
+        hasher.update(content.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _usage_from_result(result: Any) -> Dict[str, int]:
+    usage = getattr(result, "usage_metadata", None) or {}
+    if usage:
+        return {
+            "input_tokens": int(usage.get("input_tokens", 0) or 0),
+            "output_tokens": int(usage.get("output_tokens", 0) or 0),
+        }
+    token_usage = (getattr(result, "response_metadata", None) or {}).get("token_usage") or {}
+    return {
+        "input_tokens": int(token_usage.get("prompt_tokens", 0) or 0),
+        "output_tokens": int(token_usage.get("completion_tokens", 0) or 0),
+    }
+
+
+def invoke_llm(llm: Any, messages: List[Any], step: str = "unscoped") -> Any:
+    """Call ``llm.invoke(messages)`` and account for it.
+
+    Calls, tokens and latency are recorded per pipeline step, per project and per
+    model. ``step`` is only a fallback label: an enclosing ``llm_call_scope`` wins,
+    so e.g. OCR done on behalf of the translation flow is counted as translation.
+    """
+    scope = _current_scope.get()
+    step_name = scope.step if scope else step
+    project_id = scope.project_id if scope else None
+    model = _model_name(llm)
+
+    duplicate = False
+    if scope is not None:
+        duplicate = scope.mark_prompt(_prompt_fingerprint(model, messages))
+        if duplicate:
+            print(f"  ⚠️ [LLM] Identical prompt sent again in step '{step_name}' (model={model})")
+
+    start = time.perf_counter()
+    try:
+        result = llm.invoke(messages)
+    except Exception:
+        _record(step_name, project_id, model, (time.perf_counter() - start) * 1000, {}, duplicate, True)
+        raise
+    _record(
+        step_name,
+        project_id,
+        model,
+        (time.perf_counter() - start) * 1000,
+        _usage_from_result(result),
+        duplicate,
+        False,
+    )
+    return result
+
+
+def stream_llm(llm: Any, messages: List[Any], step: str = "unscoped") -> Iterator[str]:
+    """Streaming counterpart of ``invoke_llm``: yields text chunks as the model emits them.
+
+    The call is recorded once the stream ends: exhausted, failed, or closed early
+    (GeneratorExit when the SSE client disconnects). Latency is the full generation
+    time, with time-to-first-token logged separately.
+    """
+    scope = _current_scope.get()
+    step_name = scope.step if scope else step
+    project_id = scope.project_id if scope else None
+    model = _model_name(llm)
+
+    duplicate = False
+    if scope is not None:
+        duplicate = scope.mark_prompt(_prompt_fingerprint(model, messages))
+        if duplicate:
+            print(f"  ⚠️ [LLM] Identical prompt sent again in step '{step_name}' (model={model})")
+
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    start = time.perf_counter()
+    first_token_at: Optional[float] = None
+    failed = True
+    try:
+        for chunk in llm.stream(messages):
+            chunk_usage = _usage_from_result(chunk)
+            usage["input_tokens"] += chunk_usage["input_tokens"]
+            usage["output_tokens"] += chunk_usage["output_tokens"]
+            text = chunk.content if isinstance(chunk.content, str) else ""
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                print(f"  [LLM] {step_name}: first token after {(first_token_at - start) * 1000:.0f} ms")
+            yield text
+        failed = False
+    except GeneratorExit:
+        # Consumer went away: a cancelled call, not an API error
+        failed = False
+        raise
+    finally:
+        _record(step_name, project_id, model, (time.perf_counter() - start) * 1000, usage, duplicate, failed)
@@ -3,11 +3,12 @@ from __future__ import annotations
 from typing import Any, Dict, List, TypedDict
 
 
-class FileItem(TypedDict):
+class FileItem(TypedDict, total=False):
     path: str
     name: str
     text: str
     domain: str
+    fingerprint: Dict[str, Any]  # {"mtime", "size", "sha256"} of the extracted bytes
 
 
 class GraphState(TypedDict, total=False):
@@ -16,9 +17,12 @@ class GraphState(TypedDict, total=False):
     model: str
     llm: Any
     files: List[FileItem]
+    full_reingest: bool
+    ingest_stats: Dict[str, int]
     grouped: Dict[str, List[Dict[str, str]]]
     contradictions: Dict[str, List[str]]
     summary_profile: str
+    summary_sections: Dict[str, Dict[str, str]]  # per-domain memo: {"hash", "text"}
     writer_context: str
     letter_vi: str
     letter_en: str
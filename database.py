@@ -3,25 +3,53 @@ Database module using SQLAlchemy ORM.
 SQLite for development, easily switchable to PostgreSQL for cloud deployment.
 """
 
+import contextvars
 import hashlib
 import json
 import os
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
 
 from sqlalchemy import (
-    Boolean, Column, DateTime, ForeignKey, Integer, String, Text,
-    create_engine, desc, func
+    Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, LargeBinary, String, Text,
+    create_engine, desc, event, func, literal, or_, and_, select, type_coerce, union_all
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.orm import Session, declarative_base, defer, sessionmaker, relationship
 
 # --- Configuration ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "visa_app.db")
 DATABASE_URL = f"sqlite:///{DB_PATH}"
 
+# How long a writer waits for the SQLite lock before "database is locked" (ms)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "15000"))
+
 engine = create_engine(DATABASE_URL, echo=False, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    """WAL lets SSE readers run alongside a writer; busy_timeout makes writers queue
+    instead of failing. journal_mode=WAL is persistent, so existing DB files convert
+    on first connect."""
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_conn.cursor()
+    try:
+        # busy_timeout first, so the WAL switch of a brand-new file also waits for the lock
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # Safe with WAL (no corruption on power loss, only the last commits may roll back)
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    finally:
+        cursor.close()
+
 Base = declarative_base()
 
 
@@ -29,6 +57,8 @@ Base = declarative_base()
 
 class Project(Base):
     __tablename__ = "projects"
+    # Keyset pagination order of list_projects_page
+    __table_args__ = (Index("ix_projects_updated_id", "updated_at", "id"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(255), nullable=False)
@@ -44,6 +74,7 @@ class Project(Base):
 
 class TripInfo(Base):
     __tablename__ = "trip_infos"
+    __table_args__ = (Index("ix_trip_infos_project_version", "project_id", "version"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
@@ -56,12 +87,13 @@ class TripInfo(Base):
 
 class Booking(Base):
     __tablename__ = "bookings"
+    __table_args__ = (Index("ix_bookings_project_version", "project_id", "version"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
     booking_data = Column(Text, nullable=False)  # JSON: AI selections + reasoning
-    hotel_htmls = Column(Text, nullable=False)   # JSON array of HTML strings
-    flight_html = Column(Text, nullable=False)
+    hotel_htmls = Column(Text, nullable=False)   # JSON array of HTML strings (or blob ref)
+    flight_html = Column(Text, nullable=False)   # HTML (or blob ref)
     reasoning = Column(Text, default="")
     version = Column(Integer, default=1)
     created_at = Column(DateTime, default=func.now())
@@ -71,11 +103,12 @@ class Booking(Base):
 
 class Itinerary(Base):
     __tablename__ = "itineraries"
+    __table_args__ = (Index("ix_itineraries_project_version", "project_id", "version"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
     context = Column(Text, nullable=False)  # JSON: participants, dates, purpose
-    html_content = Column(Text, default="")
+    html_content = Column(Text, default="")  # HTML (or blob ref)
     version = Column(Integer, default=1)
     created_at = Column(DateTime, default=func.now())
 
@@ -84,10 +117,11 @@ class Itinerary(Base):
 
 class LetterState(Base):
     __tablename__ = "letter_states"
+    __table_args__ = (Index("ix_letter_states_project_version", "project_id", "version"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
-    files_data = Column(Text, default="[]")      # JSON: ingested files
+    files_data = Column(Text, default="[]")      # JSON: ingested files (or blob ref)
     summary_profile = Column(Text, default="")
     writer_context = Column(Text, default="")
     letter_content = Column(Text, default="")
@@ -100,11 +134,78 @@ class LetterState(Base):
     project = relationship("Project", back_populates="letter_states")
 
 
+class SplitterJob(Base):
+    """AI PDF splitter job (durable queue: uploaded → queued → classifying/splitting → completed/error)."""
+    __tablename__ = "splitter_jobs"
+
+    id = Column(String(32), primary_key=True)  # file_id
+    filename = Column(String(255), nullable=False)
+    project_id = Column(Integer, nullable=True)
+    file_path = Column(Text, nullable=False)
+    page_count = Column(Integer, default=0)
+    status = Column(String(32), default="uploaded", index=True)
+    current_page = Column(Integer, default=0)
+    classifications = Column(Text, default="[]")   # JSON: live/final per-page results
+    batch_results = Column(Text, default="{}")     # JSON: {"p1,p2,...": raw batch results} for resume
+    output_files = Column(Text, default="[]")      # JSON
+    zip_path = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0)
+    queued_at = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now())  # heartbeat while running
+
+
+class PageClassification(Base):
+    """Cached AI splitter classification of one rendered page (see pdf_tools/page_cache.py)."""
+    __tablename__ = "page_classifications"
+
+    key = Column(String(64), primary_key=True)  # sha256(page dHash + model + prompt version)
+    document_type_en = Column(String(255), nullable=False)
+    person_name_en = Column(String(255), nullable=False)
+    confidence = Column(Float, default=0.0)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=func.now())
+    last_used_at = Column(DateTime, default=func.now())
+
+
+class Blob(Base):
+    """Content-addressed, zlib-compressed payload for large HTML / JSON text columns.
+    Rows keep ``blob:<sha256>`` in place of the value (see _put_blob / _load_blob)."""
+    __tablename__ = "blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, default=0)  # uncompressed bytes
+    created_at = Column(DateTime, default=func.now())
+
+
 # ==================== INIT ====================
 
 def init_db():
-    """Create all tables if they don't exist."""
-    Base.metadata.create_all(engine)
+    """Create all tables if they don't exist, then migrate existing ones.
+
+    Not run on import: serve.py calls it once in the master process before workers
+    start, server.py when run directly. Still safe if processes race: the schema is
+    checked and created under the SQLite write lock (DDL is transactional), so a
+    second process waits (busy_timeout) and then finds everything in place."""
+    with engine.connect() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        Base.metadata.create_all(conn)
+        _migrate_indexes(conn)
+        conn.commit()
+    prune_blobs()
+
+
+def _migrate_indexes(bind):
+    """create_all() skips tables that already exist, so indexes added to a model later
+    (e.g. the (project_id, version) ones) are created here for old visa_app.db files."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
 
 
 def get_session():
@@ -112,41 +213,236 @@ def get_session():
     return SessionLocal()
 
 
-# ==================== PROJECTS ====================
+_current_session: contextvars.ContextVar[Optional[Session]] = contextvars.ContextVar(
+    "db_session", default=None
+)
 
-def create_project(name: str) -> Dict[str, Any]:
+
+@contextmanager
+def unit_of_work() -> Iterator[Session]:
+    """One session + one transaction for everything in the block.
+
+    Helpers called inside join it instead of opening (and committing) their own, so a
+    route that reads and writes several records does it in a single transaction.
+    Commits on success, rolls back on error; nested blocks join the outer one.
+    """
+    session = _current_session.get()
+    if session is not None:
+        yield session
+        return
     session = get_session()
+    token = _current_session.set(session)
     try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        _current_session.reset(token)
+        session.close()
+
+
+@contextmanager
+def _session() -> Iterator[Session]:
+    """Session for one helper: the enclosing unit_of_work's, or a short-lived one."""
+    with unit_of_work() as session:
+        yield session
+
+
+# ==================== BLOB STORE ====================
+
+BLOB_REF_PREFIX = "blob:"
+# Values smaller than this stay inline (not worth a second lookup)
+BLOB_INLINE_MAX = 1024
+# Orphaned blobs are swept at startup and then every this many seconds (0 = startup only)
+BLOB_PRUNE_INTERVAL_SEC = int(os.getenv("BLOB_PRUNE_INTERVAL_SEC", "3600"))
+_BLOB_REF_RE = re.compile(r"blob:[0-9a-f]{64}")
+
+
+def _blob_columns():
+    return (Booking.hotel_htmls, Booking.flight_html, Itinerary.html_content, LetterState.files_data)
+
+
+def _put_blob(session: Session, text: Optional[str]) -> str:
+    """Store ``text`` once per distinct content; returns what the column should hold."""
+    raw = (text or "").encode("utf-8")
+    if len(raw) < BLOB_INLINE_MAX:
+        return text or ""
+    digest = hashlib.sha256(raw).hexdigest()
+    # Touch the existing row rather than just reading it: the write lock keeps a
+    # concurrent prune_blobs() from deleting it before this transaction commits
+    touched = session.query(Blob).filter_by(sha256=digest) \
+        .update({"size": len(raw)}, synchronize_session=False)
+    if not touched:
+        session.add(Blob(sha256=digest, data=zlib.compress(raw, 6), size=len(raw)))
+    return BLOB_REF_PREFIX + digest
+
+
+def _load_blob(session: Session, value: Optional[str], default: str = "") -> str:
+    """Resolve a column value: blob refs are fetched + decompressed, inline values
+    (including rows written before the blob store existed) pass through."""
+    if not value:
+        return default
+    if not _BLOB_REF_RE.fullmatch(value):
+        return value
+    row = session.query(Blob.data).filter_by(sha256=value[len(BLOB_REF_PREFIX):]).first()
+    if row is None:
+        return default
+    return zlib.decompress(row.data).decode("utf-8")
+
+
+def prune_blobs() -> int:
+    """Delete blobs no row refers to any more. One DELETE statement, so it runs
+    atomically under the write lock. It scans every ref column, so it only runs as
+    maintenance (init_db + start_blob_maintenance), never inside a save."""
+    columns = _blob_columns()
+    referenced = union_all(*[
+        select(column).where(column.like(BLOB_REF_PREFIX + "%")) for column in columns
+    ])
+    with _session() as session:
+        return session.query(Blob) \
+            .filter((literal(BLOB_REF_PREFIX) + Blob.sha256).notin_(referenced)) \
+            .delete(synchronize_session=False)
+
+
+_blob_maintenance_lock = threading.Lock()
+_blob_maintenance_started = False
+
+
+def _blob_maintenance_loop() -> None:
+    while True:
+        time.sleep(BLOB_PRUNE_INTERVAL_SEC)
+        try:
+            removed = prune_blobs()
+            if removed:
+                print(f"[DB] Pruned {removed} unreferenced blobs")
+        except Exception as e:
+            print(f"[DB] Blob prune failed: {e}")
+
+
+def start_blob_maintenance() -> None:
+    """Sweep orphaned blobs (replaced bookings, deleted projects...) in the background
+    every BLOB_PRUNE_INTERVAL_SEC. Idempotent; one thread per process."""
+    global _blob_maintenance_started
+    if BLOB_PRUNE_INTERVAL_SEC <= 0:
+        return
+    with _blob_maintenance_lock:
+        if _blob_maintenance_started:
+            return
+        _blob_maintenance_started = True
+        threading.Thread(target=_blob_maintenance_loop, name="blob-maintenance", daemon=True).start()
+
+
+# ==================== PROJECTS ====================
+
+def create_project(name: str) -> Dict[str, Any]:
+    with _session() as session:
         project = Project(name=name)
         session.add(project)
-        session.commit()
+        session.flush()
         session.refresh(project)
         return _project_to_dict(project)
-    finally:
-        session.close()
 
 
 def list_projects() -> List[Dict[str, Any]]:
-    session = get_session()
-    try:
+    with _session() as session:
         projects = session.query(Project).order_by(desc(Project.updated_at)).all()
         return [_project_to_dict(p) for p in projects]
-    finally:
-        session.close()
 
 
-def get_project(project_id: int) -> Optional[Dict[str, Any]]:
-    session = get_session()
+PROJECT_PAGE_MAX = 200
+
+
+# updated_at as stored: SQLite keeps func.now() and datetime.utcnow() values as text
+# in different formats, so a re-bound datetime would not compare equal to the row
+_PROJECT_UPDATED_KEY = type_coerce(Project.updated_at, String)
+
+
+def _decode_project_cursor(cursor: str):
     try:
+        stamp, raw_id = cursor.rsplit("|", 1)
+        return stamp, int(raw_id)
+    except ValueError:
+        raise ValueError("invalid cursor")
+
+
+def list_projects_page(limit: int = 50, cursor: Optional[str] = None,
+                       search: Optional[str] = None) -> Dict[str, Any]:
+    """One page of projects (newest first) with per-project counts, in a single query.
+
+    ``cursor`` is the ``next_cursor`` of the previous page (keyset paging on
+    updated_at, id: stable while projects are added, no OFFSET scan). ``search``
+    matches a substring of the name. Counts and letter step flags come from
+    correlated subqueries served by the (project_id, version) indexes.
+    """
+    limit = max(1, min(int(limit), PROJECT_PAGE_MAX))
+
+    def count_of(model):
+        return select(func.count(model.id)).where(model.project_id == Project.id) \
+            .correlate(Project).scalar_subquery()
+
+    def latest_letter(column):
+        return select(column).where(LetterState.project_id == Project.id) \
+            .order_by(desc(LetterState.version)).limit(1) \
+            .correlate(Project).scalar_subquery()
+
+    with _session() as session:
+        query = session.query(
+            Project,
+            count_of(TripInfo).label("trip_infos"),
+            count_of(Booking).label("bookings"),
+            count_of(Itinerary).label("itineraries"),
+            latest_letter(LetterState.step_ingest).label("step_ingest"),
+            latest_letter(LetterState.step_summary).label("step_summary"),
+            latest_letter(LetterState.step_writer).label("step_writer"),
+            _PROJECT_UPDATED_KEY.label("updated_key"),
+        )
+        if search:
+            pattern = "%" + search.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            query = query.filter(Project.name.ilike(pattern, escape="\\"))
+        if cursor:
+            after_updated, after_id = _decode_project_cursor(cursor)
+            if after_updated:
+                # NULL updated_at sorts last in DESC order
+                query = query.filter(or_(
+                    _PROJECT_UPDATED_KEY < after_updated,
+                    and_(_PROJECT_UPDATED_KEY == after_updated, Project.id < after_id),
+                    Project.updated_at.is_(None),
+                ))
+            else:
+                query = query.filter(Project.updated_at.is_(None), Project.id < after_id)
+        rows = query.order_by(desc(Project.updated_at), desc(Project.id)).limit(limit + 1).all()
+
+        projects = []
+        for row in rows[:limit]:
+            data = _project_to_dict(row.Project)
+            data["counts"] = {
+                "trip_infos": row.trip_infos or 0,
+                "bookings": row.bookings or 0,
+                "itineraries": row.itineraries or 0,
+            }
+            data["letter_steps"] = {
+                "ingest": bool(row.step_ingest),
+                "summary": bool(row.step_summary),
+                "writer": bool(row.step_writer),
+            }
+            projects.append(data)
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = f"{last.updated_key or ''}|{last.Project.id}"
+        return {"projects": projects, "next_cursor": next_cursor}
+
+
+def get_project(project_id: int) -> Optional[Dict[str, Any]]:
+    with _session() as session:
         project = session.query(Project).filter_by(id=project_id).first()
         return _project_to_dict(project) if project else None
-    finally:
-        session.close()
 
 
 def update_project(project_id: int, **kwargs) -> Optional[Dict[str, Any]]:
-    session = get_session()
-    try:
+    with _session() as session:
         project = session.query(Project).filter_by(id=project_id).first()
         if not project:
             return None
@@ -154,39 +450,31 @@ def update_project(project_id: int, **kwargs) -> Optional[Dict[str, Any]]:
             if hasattr(project, key):
                 setattr(project, key, value)
         project.updated_at = datetime.utcnow()
-        session.commit()
+        session.flush()
         session.refresh(project)
         return _project_to_dict(project)
-    finally:
-        session.close()
 
 
 def delete_project(project_id: int) -> bool:
-    session = get_session()
-    try:
+    with _session() as session:
         project = session.query(Project).filter_by(id=project_id).first()
         if not project:
             return False
         session.delete(project)
-        session.commit()
+        session.flush()
         return True
-    finally:
-        session.close()
 
 
 def clear_project_data(project_id: int) -> bool:
     """Xóa toàn bộ dữ liệu của hồ sơ (trip, booking, itinerary, letter) nhưng giữ lại project.
     Dùng khi 'Làm mới (người mới)' — chỉ cần 1 hồ sơ, xóa data rồi bỏ file mới vào."""
-    session = get_session()
-    try:
+    with _session() as session:
         session.query(TripInfo).filter_by(project_id=project_id).delete()
         session.query(Booking).filter_by(project_id=project_id).delete()
         session.query(Itinerary).filter_by(project_id=project_id).delete()
         session.query(LetterState).filter_by(project_id=project_id).delete()
-        session.commit()
+        session.flush()
         return True
-    finally:
-        session.close()
 
 
 def _project_to_dict(p: Project) -> Dict[str, Any]:
@@ -202,8 +490,7 @@ def _project_to_dict(p: Project) -> Dict[str, Any]:
 # ==================== TRIP INFO ====================
 
 def save_trip_info(project_id: int, data: Dict) -> Dict[str, Any]:
-    session = get_session()
-    try:
+    with _session() as session:
         # Get current max version
         latest = session.query(TripInfo).filter_by(project_id=project_id) \
             .order_by(desc(TripInfo.version)).first()
@@ -219,15 +506,12 @@ def save_trip_info(project_id: int, data: Dict) -> Dict[str, Any]:
         project = session.query(Project).filter_by(id=project_id).first()
         if project:
             project.updated_at = datetime.utcnow()
-        session.commit()
+        session.flush()
         return {"id": trip.id, "version": version, "data": data}
-    finally:
-        session.close()
 
 
 def get_latest_trip_info(project_id: int) -> Optional[Dict[str, Any]]:
-    session = get_session()
-    try:
+    with _session() as session:
         trip = session.query(TripInfo).filter_by(project_id=project_id) \
             .order_by(desc(TripInfo.version)).first()
         if not trip:
@@ -238,24 +522,21 @@ def get_latest_trip_info(project_id: int) -> Optional[Dict[str, Any]]:
             "data": json.loads(trip.data),
             "created_at": trip.created_at.isoformat() if trip.created_at else None,
         }
-    finally:
-        session.close()
 
 
 # ==================== BOOKINGS ====================
 
 def save_booking(project_id: int, booking_data: Dict, hotel_htmls: List[str],
                  flight_html: str, reasoning: str = "") -> Dict[str, Any]:
-    session = get_session()
-    try:
+    with _session() as session:
         # Delete previous bookings for this project (replace with new)
         session.query(Booking).filter_by(project_id=project_id).delete()
 
         booking = Booking(
             project_id=project_id,
             booking_data=json.dumps(booking_data, ensure_ascii=False),
-            hotel_htmls=json.dumps(hotel_htmls, ensure_ascii=False),
-            flight_html=flight_html,
+            hotel_htmls=_put_blob(session, json.dumps(hotel_htmls, ensure_ascii=False)),
+            flight_html=_put_blob(session, flight_html),
             reasoning=reasoning,
             version=1,
         )
@@ -263,15 +544,12 @@ def save_booking(project_id: int, booking_data: Dict, hotel_htmls: List[str],
         project = session.query(Project).filter_by(id=project_id).first()
         if project:
             project.updated_at = datetime.utcnow()
-        session.commit()
+        session.flush()
         return {"id": booking.id, "version": 1}
-    finally:
-        session.close()
 
 
 def get_latest_booking(project_id: int) -> Optional[Dict[str, Any]]:
-    session = get_session()
-    try:
+    with _session() as session:
         booking = session.query(Booking).filter_by(project_id=project_id) \
             .order_by(desc(Booking.version)).first()
         if not booking:
@@ -280,28 +558,25 @@ def get_latest_booking(project_id: int) -> Optional[Dict[str, Any]]:
             "id": booking.id,
             "version": booking.version,
             "booking_data": json.loads(booking.booking_data),
-            "hotel_htmls": json.loads(booking.hotel_htmls),
-            "flight_html": booking.flight_html,
+            "hotel_htmls": json.loads(_load_blob(session, booking.hotel_htmls, "[]")),
+            "flight_html": _load_blob(session, booking.flight_html),
             "reasoning": booking.reasoning,
             "created_at": booking.created_at.isoformat() if booking.created_at else None,
         }
-    finally:
-        session.close()
 
 
 # ==================== ITINERARIES ====================
 
 def save_itinerary_context(project_id: int, context: Dict) -> Dict[str, Any]:
     """Save or update itinerary context (without HTML yet)."""
-    session = get_session()
-    try:
+    with _session() as session:
         latest = session.query(Itinerary).filter_by(project_id=project_id) \
             .order_by(desc(Itinerary.version)).first()
 
         if latest and not latest.html_content:
             # Update existing context-only record
             latest.context = json.dumps(context, ensure_ascii=False)
-            session.commit()
+            session.flush()
             return {"id": latest.id, "version": latest.version}
 
         version = (latest.version + 1) if latest else 1
@@ -314,16 +589,13 @@ def save_itinerary_context(project_id: int, context: Dict) -> Dict[str, Any]:
         project = session.query(Project).filter_by(id=project_id).first()
         if project:
             project.updated_at = datetime.utcnow()
-        session.commit()
+        session.flush()
         return {"id": itinerary.id, "version": version}
-    finally:
-        session.close()
 
 
 def save_itinerary_html(project_id: int, context: Dict, html_content: str) -> Dict[str, Any]:
     """Save a complete itinerary (context + HTML)."""
-    session = get_session()
-    try:
+    with _session() as session:
         latest = session.query(Itinerary).filter_by(project_id=project_id) \
             .order_by(desc(Itinerary.version)).first()
         version = (latest.version + 1) if latest else 1
@@ -331,22 +603,19 @@ def save_itinerary_html(project_id: int, context: Dict, html_content: str) -> Di
         itinerary = Itinerary(
             project_id=project_id,
             context=json.dumps(context, ensure_ascii=False),
-            html_content=html_content,
+            html_content=_put_blob(session, html_content),
             version=version,
         )
         session.add(itinerary)
         project = session.query(Project).filter_by(id=project_id).first()
         if project:
             project.updated_at = datetime.utcnow()
-        session.commit()
+        session.flush()
         return {"id": itinerary.id, "version": version}
-    finally:
-        session.close()
 
 
 def get_latest_itinerary(project_id: int) -> Optional[Dict[str, Any]]:
-    session = get_session()
-    try:
+    with _session() as session:
         itinerary = session.query(Itinerary).filter_by(project_id=project_id) \
             .order_by(desc(Itinerary.version)).first()
         if not itinerary:
@@ -355,45 +624,42 @@ def get_latest_itinerary(project_id: int) -> Optional[Dict[str, Any]]:
             "id": itinerary.id,
             "version": itinerary.version,
             "context": json.loads(itinerary.context) if itinerary.context else {},
-            "html_content": itinerary.html_content or "",
+            "html_content": _load_blob(session, itinerary.html_content),
             "created_at": itinerary.created_at.isoformat() if itinerary.created_at else None,
         }
-    finally:
-        session.close()
 
 
 def get_latest_itinerary_context(project_id: int) -> Optional[Dict[str, Any]]:
     """Get the latest itinerary context (from any version)."""
-    session = get_session()
-    try:
+    with _session() as session:
         itinerary = session.query(Itinerary).filter_by(project_id=project_id) \
             .order_by(desc(Itinerary.version)).first()
         if not itinerary or not itinerary.context:
             return None
         return json.loads(itinerary.context)
-    finally:
-        session.close()
 
 
 # ==================== LETTER STATE ====================
 
 def save_letter_state(project_id: int, **kwargs) -> Dict[str, Any]:
-    """Create or update letter state for a project."""
-    session = get_session()
-    try:
+    """Create or update letter state for a project.
+    Returns the state without ``files_data`` (use get_latest_letter_state for it)."""
+    with _session() as session:
         latest = session.query(LetterState).filter_by(project_id=project_id) \
+            .options(defer(LetterState.files_data)) \
             .order_by(desc(LetterState.version)).first()
 
         if latest:
             # Update existing record
             for key, value in kwargs.items():
                 if hasattr(latest, key):
-                    if key == "files_data" and isinstance(value, (list, dict)):
-                        value = json.dumps(value, ensure_ascii=False)
+                    if key == "files_data":
+                        if isinstance(value, (list, dict)):
+                            value = json.dumps(value, ensure_ascii=False)
+                        value = _put_blob(session, value)
                     setattr(latest, key, value)
-            session.commit()
-            session.refresh(latest)
-            return _letter_state_to_dict(latest)
+            session.flush()
+            return _letter_state_to_dict(latest, session, include_files=False)
         else:
             # Create new
             files_data = kwargs.get("files_data", [])
@@ -401,7 +667,7 @@ def save_letter_state(project_id: int, **kwargs) -> Dict[str, Any]:
                 files_data = json.dumps(files_data, ensure_ascii=False)
             state = LetterState(
                 project_id=project_id,
-                files_data=files_data,
+                files_data=_put_blob(session, files_data),
                 summary_profile=kwargs.get("summary_profile", ""),
                 writer_context=kwargs.get("writer_context", ""),
                 letter_content=kwargs.get("letter_content", ""),
@@ -413,30 +679,65 @@ def save_letter_state(project_id: int, **kwargs) -> Dict[str, Any]:
             project = session.query(Project).filter_by(id=project_id).first()
             if project:
                 project.updated_at = datetime.utcnow()
-            session.commit()
+            session.flush()
             session.refresh(state)
-            return _letter_state_to_dict(state)
-    finally:
-        session.close()
+            return _letter_state_to_dict(state, session, include_files=False)
 
 
-def get_latest_letter_state(project_id: int) -> Optional[Dict[str, Any]]:
-    session = get_session()
-    try:
-        state = session.query(LetterState).filter_by(project_id=project_id) \
-            .order_by(desc(LetterState.version)).first()
+def get_latest_letter_state(project_id: int, include_files: bool = True) -> Optional[Dict[str, Any]]:
+    """Latest letter state. ``include_files=False`` skips loading/decoding ``files_data``
+    (the full extracted text of every document) and leaves it out of the result."""
+    with _session() as session:
+        query = session.query(LetterState).filter_by(project_id=project_id)
+        if not include_files:
+            query = query.options(defer(LetterState.files_data))
+        state = query.order_by(desc(LetterState.version)).first()
         if not state:
             return None
-        return _letter_state_to_dict(state)
-    finally:
-        session.close()
+        return _letter_state_to_dict(state, session, include_files=include_files)
+
+
+def get_letter_status(project_id: int) -> Optional[Dict[str, Any]]:
+    """Step flags + payload sizes of the latest letter state, from a column-only query
+    (nothing is decoded; the files size of blob-stored data comes from ``blobs.size``)."""
+    with _session() as session:
+        row = session.query(
+            LetterState.id,
+            LetterState.version,
+            LetterState.step_ingest,
+            LetterState.step_summary,
+            LetterState.step_writer,
+            func.coalesce(Blob.size, func.length(LetterState.files_data)).label("files_size"),
+            func.length(LetterState.summary_profile).label("summary_size"),
+            func.length(LetterState.letter_content).label("letter_size"),
+            LetterState.created_at,
+        ).outerjoin(Blob, and_(
+            LetterState.files_data.like(BLOB_REF_PREFIX + "%"),
+            # Expression on the LetterState side so blobs is probed by primary key
+            Blob.sha256 == func.substr(LetterState.files_data, len(BLOB_REF_PREFIX) + 1),
+        )) \
+            .filter(LetterState.project_id == project_id) \
+            .order_by(desc(LetterState.version)).first()
+        if not row:
+            return None
+        return {
+            "id": row.id,
+            "version": row.version,
+            "step_ingest": bool(row.step_ingest),
+            "step_summary": bool(row.step_summary),
+            "step_writer": bool(row.step_writer),
+            "files_size": row.files_size or 0,
+            "summary_size": row.summary_size or 0,
+            "letter_size": row.letter_size or 0,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+        }
 
 
 def reset_letter_downstream(project_id: int, from_step: str):
     """Reset downstream steps when a step is re-run."""
-    session = get_session()
-    try:
+    with _session() as session:
         state = session.query(LetterState).filter_by(project_id=project_id) \
+            .options(defer(LetterState.files_data)) \
             .order_by(desc(LetterState.version)).first()
         if not state:
             return
@@ -450,22 +751,14 @@ def reset_letter_downstream(project_id: int, from_step: str):
             state.summary_profile = ""
         if "writer" in steps[idx + 1:]:
             state.letter_content = ""
-        session.commit()
-    finally:
-        session.close()
+        session.flush()
 
 
-def _letter_state_to_dict(state: LetterState) -> Dict[str, Any]:
-    files_data = state.files_data or "[]"
-    try:
-        files = json.loads(files_data)
-    except (json.JSONDecodeError, TypeError):
-        files = []
-    return {
+def _letter_state_to_dict(state: LetterState, session: Session, include_files: bool = True) -> Dict[str, Any]:
+    data = {
         "id": state.id,
         "project_id": state.project_id,
         "version": state.version,
-        "files_data": files,
         "summary_profile": state.summary_profile or "",
         "writer_context": state.writer_context or "",
         "letter_content": state.letter_content or "",
@@ -474,25 +767,273 @@ def _letter_state_to_dict(state: LetterState) -> Dict[str, Any]:
         "step_writer": bool(state.step_writer),
         "created_at": state.created_at.isoformat() if state.created_at else None,
     }
+    if include_files:
+        files_data = _load_blob(session, state.files_data, "[]")
+        try:
+            data["files_data"] = json.loads(files_data)
+        except (json.JSONDecodeError, TypeError):
+            data["files_data"] = []
+    return data
+
+
+# ==================== SPLITTER JOBS ====================
+
+SPLITTER_RUNNING_STATUSES = ("classifying", "splitting")
+_SPLITTER_JSON_FIELDS = ("classifications", "batch_results", "output_files")
+
+
+def create_splitter_job(file_id: str, filename: str, file_path: str, page_count: int,
+                        project_id: Optional[int] = None) -> Dict[str, Any]:
+    with _session() as session:
+        job = SplitterJob(
+            id=file_id,
+            filename=filename,
+            file_path=file_path,
+            page_count=page_count,
+            project_id=project_id,
+            status="uploaded",
+        )
+        session.add(job)
+        session.flush()
+        session.refresh(job)
+        return _splitter_job_to_dict(job)
+
+
+def get_splitter_job(file_id: str) -> Optional[Dict[str, Any]]:
+    with _session() as session:
+        job = session.query(SplitterJob).filter_by(id=file_id).first()
+        return _splitter_job_to_dict(job) if job else None
+
+
+def get_splitter_progress(file_id: str) -> Optional[Dict[str, Any]]:
+    """Status columns + classifications only (no batch_results), for progress streams."""
+    with _session() as session:
+        row = session.query(
+            SplitterJob.status, SplitterJob.page_count, SplitterJob.current_page,
+            SplitterJob.error, SplitterJob.classifications, SplitterJob.output_files,
+        ).filter(SplitterJob.id == file_id).first()
+        if not row:
+            return None
+        data = {
+            "status": row.status,
+            "page_count": row.page_count or 0,
+            "current_page": row.current_page or 0,
+            "error": row.error,
+        }
+        for field in ("classifications", "output_files"):
+            try:
+                data[field] = json.loads(getattr(row, field) or "[]")
+            except (json.JSONDecodeError, TypeError):
+                data[field] = []
+        return data
+
+
+def update_splitter_job(file_id: str, **kwargs) -> None:
+    """Update job fields; also refreshes the heartbeat (updated_at)."""
+    values = {}
+    for key, value in kwargs.items():
+        if key in _SPLITTER_JSON_FIELDS and not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        values[key] = value
+    values["updated_at"] = datetime.utcnow()
+    with _session() as session:
+        session.query(SplitterJob).filter_by(id=file_id).update(values)
+        session.flush()
+
+
+def enqueue_splitter_job(file_id: str) -> bool:
+    """Queue a job for processing from scratch (clears progress and stored batches)."""
+    now = datetime.utcnow()
+    with _session() as session:
+        updated = session.query(SplitterJob) \
+            .filter(SplitterJob.id == file_id,
+                    SplitterJob.status.notin_(("queued",) + SPLITTER_RUNNING_STATUSES)) \
+            .update({
+                "status": "queued",
+                "current_page": 0,
+                "classifications": "[]",
+                "batch_results": "{}",
+                "output_files": "[]",
+                "zip_path": None,
+                "error": None,
+                "queued_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "updated_at": now,
+            }, synchronize_session=False)
+        session.flush()
+        return updated == 1
+
+
+def claim_next_splitter_job(stale_after_sec: int) -> Optional[Dict[str, Any]]:
+    """Atomically take the oldest queued job, or a running job whose heartbeat went stale
+    (its worker died). Safe across threads and processes: the claim is a conditional
+    UPDATE that only one caller can win."""
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=stale_after_sec)
+    session = get_session()
+    try:
+        claimable = or_(
+            SplitterJob.status == "queued",
+            and_(SplitterJob.status.in_(SPLITTER_RUNNING_STATUSES),
+                 SplitterJob.updated_at < stale_before),
+        )
+        candidates = session.query(SplitterJob.id).filter(claimable) \
+            .order_by(SplitterJob.queued_at, SplitterJob.created_at) \
+            .limit(5).all()
+        for (job_id,) in candidates:
+            # Re-checking the condition inside the UPDATE makes the claim atomic
+            claimed = session.query(SplitterJob) \
+                .filter(SplitterJob.id == job_id, claimable) \
+                .update({
+                    "status": "classifying",
+                    "attempts": SplitterJob.attempts + 1,
+                    "started_at": now,
+                    "updated_at": now,
+                }, synchronize_session=False)
+            session.commit()
+            if claimed == 1:
+                job = session.query(SplitterJob).filter_by(id=job_id).first()
+                return _splitter_job_to_dict(job)
+        return None
+    finally:
+        session.close()
+
+
+def record_splitter_batch(file_id: str, page_nums: List[int], results: List[Dict]) -> None:
+    """Store one classified batch so a restarted job can skip it.
+
+    Keyed by the exact page numbers: batch boundaries depend on page-cache hits,
+    so a resumed run may start a batch on the same page with different pages."""
+    with _session() as session:
+        job = session.query(SplitterJob).filter_by(id=file_id).first()
+        if not job:
+            return
+        try:
+            batches = json.loads(job.batch_results or "{}")
+        except (json.JSONDecodeError, TypeError):
+            batches = {}
+        batches[",".join(str(p) for p in page_nums)] = results
+        job.batch_results = json.dumps(batches, ensure_ascii=False)
+        job.updated_at = datetime.utcnow()
+        session.flush()
+
+
+def splitter_queue_position(file_id: str) -> Optional[int]:
+    """1-based position among queued jobs, or None if the job is not queued."""
+    with _session() as session:
+        job = session.query(SplitterJob).filter_by(id=file_id).first()
+        if not job or job.status != "queued":
+            return None
+        ahead = session.query(func.count(SplitterJob.id)) \
+            .filter(SplitterJob.status == "queued", SplitterJob.queued_at < job.queued_at) \
+            .scalar()
+        return (ahead or 0) + 1
+
+
+def get_splitter_queue_stats() -> Dict[str, Any]:
+    with _session() as session:
+        counts = dict(
+            session.query(SplitterJob.status, func.count(SplitterJob.id))
+            .group_by(SplitterJob.status).all()
+        )
+        oldest = session.query(func.min(SplitterJob.queued_at)) \
+            .filter(SplitterJob.status == "queued").scalar()
+        return {
+            "by_status": counts,
+            "queued": counts.get("queued", 0),
+            "running": sum(counts.get(s, 0) for s in SPLITTER_RUNNING_STATUSES),
+            "oldest_queued_sec": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+        }
+
+
+def delete_finished_splitter_jobs() -> int:
+    with _session() as session:
+        deleted = session.query(SplitterJob) \
+            .filter(SplitterJob.status.notin_(("queued",) + SPLITTER_RUNNING_STATUSES)) \
+            .delete(synchronize_session=False)
+        session.flush()
+        return deleted
+
+
+def _splitter_job_to_dict(job: SplitterJob) -> Dict[str, Any]:
+    data = {
+        "id": job.id,
+        "filename": job.filename,
+        "project_id": job.project_id,
+        "file_path": job.file_path,
+        "page_count": job.page_count or 0,
+        "status": job.status,
+        "current_page": job.current_page or 0,
+        "zip_path": job.zip_path,
+        "error": job.error,
+        "attempts": job.attempts or 0,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+    for field in _SPLITTER_JSON_FIELDS:
+        raw = getattr(job, field) or ("{}" if field == "batch_results" else "[]")
+        try:
+            data[field] = json.loads(raw)
+        except (json.JSONDecodeError, TypeError):
+            data[field] = {} if field == "batch_results" else []
+    return data
+
+
+# ==================== PAGE CLASSIFICATION CACHE ====================
+
+def get_page_classifications(keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up cached page classifications; bumps hit counters for the ones found."""
+    if not keys:
+        return {}
+    with _session() as session:
+        rows = session.query(PageClassification).filter(PageClassification.key.in_(keys)).all()
+        now = datetime.utcnow()
+        found = {}
+        for row in rows:
+            row.hits = (row.hits or 0) + 1
+            row.last_used_at = now
+            found[row.key] = {
+                "document_type_en": row.document_type_en,
+                "person_name_en": row.person_name_en,
+                "confidence": row.confidence or 0.0,
+            }
+        if rows:
+            session.flush()
+        return found
+
+
+def save_page_classifications(entries: Dict[str, Dict[str, Any]]) -> None:
+    with _session() as session:
+        for key, entry in entries.items():
+            session.merge(PageClassification(
+                key=key,
+                document_type_en=entry["document_type_en"],
+                person_name_en=entry["person_name_en"],
+                confidence=entry.get("confidence", 0.0),
+            ))
+        session.flush()
 
 
 # ==================== INPUT HASHING ====================
 
 def compute_input_hash(input_dir: str) -> str:
-    """Compute MD5 hash of all files in input directory for change detection."""
+    """Compute MD5 hash of all files in input directory for change detection.
+    Cheap folder-level check (name, size, mtime); per-file content fingerprints
+    used for incremental ingest live on each entry of ``files_data``."""
     if not os.path.isdir(input_dir):
         return ""
     hasher = hashlib.md5()
-    for root, _, filenames in os.walk(input_dir):
+    for root, dirs, filenames in os.walk(input_dir):
+        dirs.sort()
         for fname in sorted(filenames):
             fpath = os.path.join(root, fname)
             try:
-                hasher.update(fname.encode("utf-8"))
-                hasher.update(str(os.path.getsize(fpath)).encode("utf-8"))
+                st = os.stat(fpath)
+                hasher.update(os.path.relpath(fpath, input_dir).encode("utf-8"))
+                hasher.update(str(st.st_size).encode("utf-8"))
+                hasher.update(str(st.st_mtime_ns).encode("utf-8"))
             except OSError:
                 continue
     return hasher.hexdigest()
 
-
-# Initialize DB on import
-init_db()
@@ -238,32 +238,82 @@ const btnCreateProject = document.getElementById("btnCreateProject");
 const btnNewProject = document.getElementById("btnNewProject");
 const btnRenameProject = document.getElementById("btnRenameProject");
 const btnDeleteProject = document.getElementById("btnDeleteProject");
+const projectSearchEl = document.getElementById("projectSearch");
+
+const PROJECT_PAGE_SIZE = 50;
+const LOAD_MORE_VALUE = "__more__";
+let projectNextCursor = null;
 
 function getProjectId() {
   return currentProjectId;
 }
 
-async function loadProjects() {
+function addProjectOption(p) {
+  const opt = document.createElement("option");
+  opt.value = p.id;
+  opt.textContent = p.name;
+  if (p.counts) {
+    opt.title = `${p.counts.trip_infos} trip info · ${p.counts.bookings} booking · ${p.counts.itineraries} lịch trình`;
+  }
+  projectSelectEl.appendChild(opt);
+}
+
+// Tải danh sách hồ sơ theo trang (server phân trang + lọc theo tên).
+// append=true: nối trang tiếp theo vào dropdown ("Tải thêm").
+async function loadProjects(append = false) {
   try {
-    const res = await fetch("/api/projects");
+    const params = new URLSearchParams({ limit: PROJECT_PAGE_SIZE });
+    const q = projectSearchEl ? projectSearchEl.value.trim() : "";
+    if (q) params.set("q", q);
+    if (append && projectNextCursor) params.set("cursor", projectNextCursor);
+    const res = await fetch(`/api/projects?${params}`);
     const data = await res.json();
-    projectSelectEl.innerHTML = '<option value="">-- Chọn hồ sơ --</option>';
+
+    if (append) {
+      const more = projectSelectEl.querySelector(`option[value="${LOAD_MORE_VALUE}"]`);
+      if (more) more.remove();
+    } else {
+      projectSelectEl.innerHTML = '<option value="">-- Chọn hồ sơ --</option>';
+    }
     (data.projects || []).forEach(p => {
+      if (!projectSelectEl.querySelector(`option[value="${p.id}"]`)) addProjectOption(p);
+    });
+
+    // Hồ sơ đang chọn có thể nằm ở trang sau: thêm riêng để dropdown vẫn hiển thị đúng
+    if (currentProjectId && !q && !projectSelectEl.querySelector(`option[value="${currentProjectId}"]`)) {
+      const curRes = await fetch(`/api/projects/${currentProjectId}`);
+      if (curRes.ok) addProjectOption(await curRes.json());
+    }
+
+    projectNextCursor = data.next_cursor || null;
+    if (projectNextCursor) {
       const opt = document.createElement("option");
-      opt.value = p.id;
-      opt.textContent = p.name;
+      opt.value = LOAD_MORE_VALUE;
+      opt.textContent = "⬇ Tải thêm hồ sơ…";
       projectSelectEl.appendChild(opt);
-    });
-    if (currentProjectId) {
-      projectSelectEl.value = currentProjectId;
     }
+    projectSelectEl.value = currentProjectId && projectSelectEl.querySelector(`option[value="${currentProjectId}"]`)
+      ? currentProjectId
+      : "";
   } catch (e) {
     console.error("Failed to load projects:", e);
   }
 }
 
+if (projectSearchEl) {
+  let searchTimer = null;
+  projectSearchEl.addEventListener("input", () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => loadProjects(), 300);
+  });
+}
+
 projectSelectEl.addEventListener("change", async () => {
   const val = projectSelectEl.value;
+  if (val === LOAD_MORE_VALUE) {
+    await loadProjects(true);
+    return;
+  }
   currentProjectId = val ? parseInt(val) : null;
   btnRenameProject.style.display = currentProjectId ? "" : "none";
   btnDeleteProject.style.display = currentProjectId ? "" : "none";
@@ -330,7 +380,7 @@ btnCreateProject.addEventListener("click", async () => {
     currentProjectId = newProject.id || newProject.project_id;
     if (!currentProjectId) {
       // In case the API returns the project id under a different key but usually it's `id`
-      const listRes = await fetch("/api/projects");
+      const listRes = await fetch(`/api/projects?limit=${PROJECT_PAGE_SIZE}&q=${encodeURIComponent(name.trim())}`);
       const listData = await listRes.json();
       const projects = listData.projects || [];
       if (projects.length > 0) {
@@ -394,7 +444,7 @@ btnDeleteProject.addEventListener("click", async () => {
 
 // Đảm bảo luôn có ít nhất 1 hồ sơ (chỉ cần 1 hồ sơ, làm mới khi đổi người)
 async function ensureOneProject() {
-  const res = await fetch("/api/projects");
+  const res = await fetch("/api/projects?limit=1");
   const data = await res.json();
   const projects = data.projects || [];
   if (projects.length === 0) {
@@ -405,7 +455,7 @@ async function ensureOneProject() {
     });
   }
   await loadProjects();
-  const list = (await fetch("/api/projects").then((r) => r.json())).projects || [];
+  const list = (await fetch("/api/projects?limit=1").then((r) => r.json())).projects || [];
   if (list.length > 0 && !currentProjectId) {
     currentProjectId = list[0].id;
     localStorage.setItem("currentProjectId", currentProjectId);
@@ -1911,6 +1961,75 @@ async function runIngestStream(force = false) {
   });
 }
 
+async function runWriterStream(force = false) {
+  const inputDir = inputDirEl.value.trim() || "input";
+  const outputPath = outputPathEl.value.trim() || "output/letter.txt";
+  setStepLog("writer", "");
+  if (force) resetDownstreamLogs("writer");
+  showStepLog("writer", true);
+  appendStepLog("writer", `Bắt đầu: ${formatStage("writer")}`);
+
+  const res = await fetch("/api/run_writer_stream", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      input_dir: inputDir,
+      output: outputPath,
+      force,
+      writer_context: getWriterContextValue(),
+      project_id: getProjectId(),
+    }),
+  });
+
+  if (!res.ok) {
+    const data = await res.json().catch(() => ({}));
+    if (data.error === "missing_prerequisite") {
+      appendStepLog("writer", `Thiếu bước trước: ${formatStage(data.missing)} (hãy chạy trước)`);
+    } else {
+      appendStepLog("writer", "Lỗi khi chạy bước.");
+    }
+    return;
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let letter = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    const lines = buffer.split("\n");
+    buffer = lines.pop();
+
+    for (const line of lines) {
+      if (!line.startsWith("data: ")) continue;
+      let evt;
+      try {
+        evt = JSON.parse(line.slice(6));
+      } catch (e) {
+        continue;
+      }
+      if (evt.type === "token") {
+        letter += evt.text;
+        resultEl.textContent = letter;
+      } else if (evt.type === "done") {
+        resultEl.textContent = evt.letter || letter || "Không có kết quả.";
+        appendStepLog(
+          "writer",
+          evt.status === "cached" ? `Đã có cache: ${formatStage("writer")}` : `Hoàn thành: ${formatStage("writer")}`
+        );
+      } else if (evt.type === "error") {
+        appendStepLog("writer", `Lỗi khi chạy bước: ${evt.message}`);
+      }
+    }
+  }
+
+  await loadSteps();
+}
+
 async function runStep(step, force = false) {
   const inputDir = inputDirEl.value.trim() || "input";
   const outputPath = outputPathEl.value.trim() || "output/letter.txt";
@@ -1919,6 +2038,10 @@ async function runStep(step, force = false) {
     await loadSteps();
     return;
   }
+  if (step === "writer") {
+    await runWriterStream(force);
+    return;
+  }
 
   setStepLog(step, "");
   if (force) resetDownstreamLogs(step);
@@ -4306,6 +4429,49 @@ async function deleteAllSplitter() {
   } catch (e) { alert(`Lỗi: ${e.message}`); }
 }
 
+// Follow a splitter job over SSE (/api/ai-splitter/events): only new pages and status
+// changes are sent. onUpdate(state) runs after every event; resolves with the final state.
+function watchSplitterJob(fileId, onUpdate) {
+  const state = {
+    status: "queued", page_count: 0, current_page: 0, queue_position: null,
+    classifications: [], output_files: [], error: null,
+  };
+  return new Promise((resolve) => {
+    const source = new EventSource(`/api/ai-splitter/events/${fileId}`);
+    const finish = () => { source.close(); resolve(state); };
+    source.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === "reset") {
+        state.classifications = [];
+      } else if (data.type === "pages") {
+        state.classifications.push(...data.pages);
+      } else if (data.type === "status") {
+        state.status = data.status;
+        state.page_count = data.page_count;
+        state.current_page = data.current_page;
+        state.queue_position = data.queue_position || null;
+      } else if (data.type === "done") {
+        state.status = "completed";
+        state.classifications = data.classifications;
+        state.output_files = data.output_files;
+      } else if (data.type === "error") {
+        state.status = "error";
+        state.error = data.error;
+      }
+      onUpdate(state, data);
+      if (data.type === "done" || data.type === "error") finish();
+    };
+    source.onerror = () => {
+      // The browser reconnects on its own (resuming via Last-Event-ID) unless the server refused
+      if (source.readyState === EventSource.CLOSED) {
+        state.status = "error";
+        state.error = state.error || "connection_lost";
+        finish();
+      }
+    };
+  });
+}
+
 // Split all files sequentially with combined results
 async function splitAllFiles() {
   const listEl = document.getElementById("splitterFileList");
@@ -4358,63 +4524,47 @@ async function splitAllFiles() {
 
       const fileId = data.file_id;
 
-      // Poll until this file is done — show live status
-      await new Promise((resolve) => {
-        let dots = 0;
-        const checkDone = setInterval(async () => {
-          try {
-            const statusRes = await fetch(`/api/ai-splitter/status/${fileId}`);
-            const statusData = await statusRes.json();
-
-            // Live progress update
-            dots = (dots + 1) % 4;
-            const dotStr = ".".repeat(dots);
-            const statusMap = {
-              converting: `🔄 Chuyển PDF → ảnh${dotStr}`,
-              classifying: `🤖 Phân loại trang ${statusData.current_page || "?"}/${statusData.page_count || "?"}${dotStr}`,
-              splitting: `✂️ Đang tách file${dotStr}`,
-              processing: `⚙️ Đang xử lý${dotStr}`,
-            };
-            if (statusText) {
-              statusText.textContent = `📄 [${i + 1}/${totalFiles}] ${fname} — ${statusMap[statusData.status] || statusData.status}`;
-            }
-
-            // Update sub-progress bar
-            if (statusData.page_count > 0 && progressBar) {
-              const filePct = (statusData.current_page || 0) / statusData.page_count;
-              const overallPct = Math.round(((i + filePct) / totalFiles) * 100);
-              progressBar.value = overallPct;
-            }
+      // Follow this file over SSE until it is done — show live status
+      const finalState = await watchSplitterJob(fileId, (statusData) => {
+        const statusMap = {
+          converting: "🔄 Chuyển PDF → ảnh...",
+          classifying: `🤖 Phân loại trang ${statusData.current_page || "?"}/${statusData.page_count || "?"}...`,
+          splitting: "✂️ Đang tách file...",
+          processing: "⚙️ Đang xử lý...",
+          queued: `⏳ Đang chờ trong hàng đợi${statusData.queue_position ? ` (vị trí ${statusData.queue_position})` : ""}...`,
+        };
+        if (statusText) {
+          statusText.textContent = `📄 [${i + 1}/${totalFiles}] ${fname} — ${statusMap[statusData.status] || statusData.status}`;
+        }
 
-            if (statusData.status === "completed") {
-              clearInterval(checkDone);
-              completedCount++;
-              // Collect this file's output files
-              if (statusData.output_files && statusData.output_files.length > 0) {
-                allOutputFiles.push({
-                  file_id: fileId,
-                  source_filename: fname,
-                  output_files: statusData.output_files,
-                });
-              }
-              // Collect classifications
-              if (statusData.classifications) {
-                for (const c of statusData.classifications) {
-                  allClassifications.push({ ...c, source_file: fname });
-                }
-              }
-              // Cập nhật ngay phần "Tất cả file đã tách" sau mỗi file tách xong
-              await loadOutputHistory();
-              resolve();
-            } else if (statusData.status === "error") {
-              clearInterval(checkDone);
-              console.error(`Error splitting ${fname}: ${statusData.error}`);
-              resolve();
-            }
-          } catch { clearInterval(checkDone); resolve(); }
-        }, 1500);
+        // Update sub-progress bar
+        if (statusData.page_count > 0 && progressBar) {
+          const filePct = (statusData.current_page || 0) / statusData.page_count;
+          const overallPct = Math.round(((i + filePct) / totalFiles) * 100);
+          progressBar.value = overallPct;
+        }
       });
 
+      if (finalState.status === "completed") {
+        completedCount++;
+        // Collect this file's output files
+        if (finalState.output_files.length > 0) {
+          allOutputFiles.push({
+            file_id: fileId,
+            source_filename: fname,
+            output_files: finalState.output_files,
+          });
+        }
+        // Collect classifications
+        for (const c of finalState.classifications) {
+          allClassifications.push({ ...c, source_file: fname });
+        }
+        // Cập nhật ngay phần "Tất cả file đã tách" sau mỗi file tách xong
+        await loadOutputHistory();
+      } else {
+        console.error(`Error splitting ${fname}: ${finalState.error}`);
+      }
+
     } catch (e) { console.error(`Error splitting ${fname}:`, e); }
   }
 
@@ -4536,7 +4686,7 @@ document.addEventListener("click", async (e) => {
   if (!uploadBtn) return; // safety check
 
   let currentFileId = null;
-  let pollTimer = null;
+  let watchToken = 0;
 
   const DOC_ICONS = {
     Passport: "🛂", Birth_Certificate: "👶", Marriage_Certificate: "💍",
@@ -4587,8 +4737,8 @@ document.addEventListener("click", async (e) => {
       // 2. Start processing
       await fetch(`/api/ai-splitter/process/${currentFileId}`, { method: "POST" });
 
-      // 3. Poll status
-      startPolling();
+      // 3. Follow progress
+      startWatching();
     } catch (err) {
       statusText.textContent = `Lỗi: ${err.message}`;
       uploadBtn.disabled = false;
@@ -4596,9 +4746,27 @@ document.addEventListener("click", async (e) => {
     }
   });
 
-  function startPolling() {
-    if (pollTimer) clearInterval(pollTimer);
-    pollTimer = setInterval(checkStatus, 1000);
+  async function startWatching() {
+    // A newer job replaces the one on screen; updates from the old stream are ignored
+    const token = ++watchToken;
+    const fileId = currentFileId;
+    const data = await watchSplitterJob(fileId, (state) => {
+      if (token === watchToken) renderStatus(state);
+    });
+    if (token !== watchToken) return;
+
+    // Completed
+    if (data.status === "completed") {
+      progressBar.value = 100;
+      progressText.textContent = "100%";
+      statusText.textContent = `✅ Hoàn thành! Đã tách thành ${data.output_files.length} file.`;
+      renderOutputFiles(data.output_files);
+      await loadOutputHistory();
+    } else {
+      statusText.textContent = `❌ Lỗi: ${data.error}`;
+    }
+    uploadBtn.disabled = false;
+    uploadBtn.textContent = "📤 Upload & Tách";
   }
 
   // Listen for process-local events (from file list Tách buttons)
@@ -4611,53 +4779,29 @@ document.addEventListener("click", async (e) => {
     progressText.textContent = "0%";
     classificationsCard.style.display = "none";
     resultsCard.style.display = "none";
-    startPolling();
+    startWatching();
   });
 
-  async function checkStatus() {
-    if (!currentFileId) return;
-    try {
-      const res = await fetch(`/api/ai-splitter/status/${currentFileId}`);
-      const data = await res.json();
-
-      // Update progress
-      const pct = data.page_count > 0
-        ? Math.round((data.current_page / data.page_count) * 100) : 0;
-      progressBar.value = pct;
-      progressBar.max = 100;
-      progressText.textContent = `${pct}%`;
-
-      const statusMap = {
-        converting: "Đang chuyển PDF thành ảnh...",
-        classifying: `Đang phân loại trang ${data.current_page}/${data.page_count}...`,
-        splitting: "Đang tách file...",
-        processing: "Đang xử lý...",
-      };
-      statusText.textContent = statusMap[data.status] || data.status;
-
-      // Show live classifications
-      if (data.classifications && data.classifications.length > 0) {
-        renderClassifications(data.classifications);
-      }
+  function renderStatus(data) {
+    // Update progress
+    const pct = data.page_count > 0
+      ? Math.round((data.current_page / data.page_count) * 100) : 0;
+    progressBar.value = pct;
+    progressBar.max = 100;
+    progressText.textContent = `${pct}%`;
+
+    const statusMap = {
+      converting: "Đang chuyển PDF thành ảnh...",
+      classifying: `Đang phân loại trang ${data.current_page}/${data.page_count}...`,
+      splitting: "Đang tách file...",
+      processing: "Đang xử lý...",
+      queued: `Đang chờ trong hàng đợi${data.queue_position ? ` (vị trí ${data.queue_position})` : ""}...`,
+    };
+    statusText.textContent = statusMap[data.status] || data.status;
 
-      // Completed
-      if (data.status === "completed") {
-        clearInterval(pollTimer);
-        progressBar.value = 100;
-        progressText.textContent = "100%";
-        statusText.textContent = `✅ Hoàn thành! Đã tách thành ${data.output_files.length} file.`;
-        renderOutputFiles(data.output_files);
-        await loadOutputHistory();
-        uploadBtn.disabled = false;
-        uploadBtn.textContent = "📤 Upload & Tách";
-      } else if (data.status === "error") {
-        clearInterval(pollTimer);
-        statusText.textContent = `❌ Lỗi: ${data.error}`;
-        uploadBtn.disabled = false;
-        uploadBtn.textContent = "📤 Upload & Tách";
-      }
-    } catch (err) {
-      console.error("Poll error:", err);
+    // Show live classifications
+    if (data.classifications.length > 0) {
+      renderClassifications(data.classifications);
     }
   }
 
@@ -3,62 +3,111 @@ AI Classification Service
 Uses OpenAI Vision API to classify document pages and extract names.
 Features:
 - Batch processing (5 pages/batch for accuracy)
-- Parallel waves (5 concurrent batches for speed)
-- Automatic Gemini fallback on OpenAI rate limits
+- Sliding-window scheduling (up to 5 batches in flight, next one starts as soon as any finishes)
+- Streaming input: pages are rendered lazily and classified as soon as a batch is ready
+- Page-level cache: previously seen pages (by perceptual hash) skip the API
+- Text-layer fast path: digital pages are classified from their text with a cheap text-only prompt
+- Shared per-provider rate limiter (token bucket + AIMD, honours Retry-After)
+- Native async HTTP clients (one pooled client per event loop), no thread per in-flight call
+- Automatic Gemini fallback on OpenAI rate limits, decided per job
 - Smart post-processing to fix cross-batch issues
 """
 
+import base64
 import json
 import os
 import re
 import time
 import asyncio
-from typing import Dict, List, Optional
+import itertools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 from dotenv import load_dotenv
 
-import openai
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+from pdf_tools.rate_limit import get_rate_limiter, is_rate_limit_error, retry_after_seconds
 
 load_dotenv()
 
-_openai_client = None
+# Per-call timeout for vision/text classification requests (seconds)
+API_CALL_TIMEOUT = float(os.getenv("SPLITTER_API_TIMEOUT", "60"))
+# Connection pool size of each event loop's OpenAI client
+HTTP_MAX_CONNECTIONS = int(os.getenv("SPLITTER_HTTP_MAX_CONNECTIONS", "100"))
+
 _gemini_configured = False
-_gemini_model = None
 
-# Global state to track if we should preferentially use Gemini because OpenAI ran out of credits
-gemini_fallback_active = False
+# Async clients are bound to the event loop that first uses them, and every splitter
+# worker thread runs its own loop, so clients are kept per loop (dropped with it).
+_openai_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+_gemini_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, glm.GenerativeServiceAsyncClient]" = weakref.WeakKeyDictionary()
 
 
-def get_openai_client() -> OpenAI:
-    global _openai_client
-    if _openai_client is None:
+def get_openai_client() -> AsyncOpenAI:
+    """AsyncOpenAI client for the running event loop (one pooled connection set per loop)."""
+    loop = asyncio.get_running_loop()
+    client = _openai_clients.get(loop)
+    if client is None:
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key or api_key == "your_openai_api_key_here":
             raise ValueError("OPENAI_API_KEY not configured.")
-        _openai_client = OpenAI(api_key=api_key)
-    return _openai_client
+        client = AsyncOpenAI(
+            api_key=api_key,
+            # Retries and 429 back-off are handled by classify_batch + the rate limiter
+            max_retries=0,
+            timeout=API_CALL_TIMEOUT,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+        _openai_clients[loop] = client
+    return client
 
 def configure_gemini():
-    global _gemini_configured, _gemini_model
+    global _gemini_configured
     if not _gemini_configured:
         gemini_api_key = os.getenv("GEMINI_API_KEY")
         if gemini_api_key and gemini_api_key != "your_gemini_api_key_here":
             genai.configure(api_key=gemini_api_key)
-            model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash").strip()
-            _gemini_model = genai.GenerativeModel(model_name)
             _gemini_configured = True
     return _gemini_configured
 
-def get_gemini_model():
-    configure_gemini()
-    return _gemini_model
+def get_gemini_model() -> str:
+    return os.getenv("GEMINI_MODEL", "gemini-1.5-flash").strip()
+
+def get_gemini_client():
+    """Gemini async client for the running event loop.
+
+    GenerativeModel.generate_content_async shares one process-wide grpc_asyncio client,
+    bound to the first loop that used it, so each loop gets its own client instead.
+    """
+    if not configure_gemini():
+        return None
+    loop = asyncio.get_running_loop()
+    client = _gemini_clients.get(loop)
+    if client is None:
+        client = glm.GenerativeServiceAsyncClient(
+            client_options={"api_key": os.getenv("GEMINI_API_KEY")},
+        )
+        _gemini_clients[loop] = client
+    return client
 
 
 def get_openai_model() -> str:
     return os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini").strip()
 
 
+def get_openai_text_model() -> str:
+    return os.getenv("OPENAI_SPLITTER_TEXT_MODEL", "gpt-4o-mini").strip()
+
+
 # ----- Prompts -----
 
 BATCH_PROMPT = """You are a document classification expert. I will show you {num_pages} scanned page images (pages {start_idx} to {end_idx}).
@@ -90,6 +139,9 @@ For each page, return:
    - IMPORTANT: If the page layout/format CHANGES (different headers, different document style), it is NOT a continuation even if person name is the same.
    - A Passport page CANNOT be a continuation of a Contract.
    - A Birth Certificate CANNOT be a continuation of a Contract.
+
+4. confidence: 0.0-1.0, how sure you are of document_type_en for THIS page. Use below 0.7 for
+   blank, illegible or ambiguous pages.
 {previous_context}
 
 RULES:
@@ -100,10 +152,46 @@ RULES:
 
 Return ONLY a JSON array:
 [
-  {{"page_index": {start_idx}, "document_type_en": "Contract", "person_name_en": "NGUYEN_VAN_A", "is_continuation": false}},
-  {{"page_index": {start_idx_plus_1}, "document_type_en": "Contract", "person_name_en": "NGUYEN_VAN_A", "is_continuation": true}}
+  {{"page_index": {start_idx}, "document_type_en": "Contract", "person_name_en": "NGUYEN_VAN_A", "is_continuation": false, "confidence": 0.95}},
+  {{"page_index": {start_idx_plus_1}, "document_type_en": "Contract", "person_name_en": "NGUYEN_VAN_A", "is_continuation": true, "confidence": 0.9}}
+]"""
+
+
+TEXT_BATCH_PROMPT = """You are a document classification expert. Below is the extracted text layer of {num_pages} PDF pages (pages {start_idx} to {end_idx}), one block per page.
+
+For EACH page, classify it INDEPENDENTLY from its text and return:
+1. document_type_en: The document type of THIS page, e.g. Account_Statement, Contract, Agreement, Decision,
+   Social_Insurance_Record, Receipt_Voucher, Registration_Form, Commitment_Letter, Price_Quotation,
+   Power_of_Attorney, Birth_Certificate, Marriage_Certificate, Passport, CCCD, Land_Certificate, or another type as appropriate.
+2. person_name_en: Primary person's name in UPPERCASE, no diacritics, underscores for spaces (e.g., NGUYEN_VAN_A).
+   For bank statements use the ACCOUNT HOLDER, not transaction counterparties.
+3. is_continuation: true ONLY if this page continues the SAME document as the PREVIOUS page.
+4. confidence: 0.0-1.0, how sure you are of document_type_en for THIS page (below 0.7 if ambiguous).
+{previous_context}
+
+RULES:
+- For multi-person documents (contracts with 2+ signers): use the FIRST person's name for ALL pages.
+- Return EXACTLY {num_pages} JSON objects, in page order.
+
+{pages_text}
+
+Return ONLY a JSON array:
+[
+  {{"page_index": {start_idx}, "document_type_en": "Account_Statement", "person_name_en": "NGUYEN_VAN_A", "is_continuation": false, "confidence": 0.95}}
 ]"""
 
+TEXT_PAGE_MAX_CHARS = 2000  # Head + tail of each page is enough to classify it
+
+
+def _format_pages_text(page_texts: List[str], start_idx: int) -> str:
+    blocks = []
+    for i, text in enumerate(page_texts):
+        text = (text or "").strip()
+        if len(text) > TEXT_PAGE_MAX_CHARS:
+            text = text[:1600] + "\n...[TRUNCATED]...\n" + text[-300:]
+        blocks.append(f"===== PAGE {start_idx + i} =====\n{text}")
+    return "\n\n".join(blocks)
+
 
 # ----- Response Parsing -----
 
@@ -200,61 +288,66 @@ async def call_openai(model_name: str, prompt: str, images_base64: List[str]) ->
         api_params["max_tokens"] = 1500
         api_params["temperature"] = 0.1
         
-    # Running blocking call in thread pool to prevent blocking asyncio loop
-    loop = asyncio.get_event_loop()
-    response = await loop.run_in_executor(
-        None, 
-        lambda: get_openai_client().chat.completions.create(**api_params)
-    )
+    response = await get_openai_client().chat.completions.create(**api_params, timeout=API_CALL_TIMEOUT)
     return response.choices[0].message.content
 
 
 async def call_gemini(prompt: str, images_base64: List[str]) -> str:
-    gemini_model = get_gemini_model()
-    if not gemini_model:
+    gemini_client = get_gemini_client()
+    if not gemini_client:
         raise ValueError("Gemini is not configured.")
         
-    contents = [prompt]
+    parts = [glm.Part(text=prompt)]
     for b64 in images_base64:
-        contents.append({
-            "mime_type": "image/jpeg",
-            "data": b64
-        })
+        parts.append(glm.Part(inline_data=glm.Blob(
+            mime_type="image/jpeg",
+            data=base64.b64decode(b64),
+        )))
         
-    generation_config = genai.types.GenerationConfig(
-        temperature=0.1,
-        max_output_tokens=1500,
+    request = glm.GenerateContentRequest(
+        model=f"models/{get_gemini_model()}",
+        contents=[glm.Content(role="user", parts=parts)],
+        generation_config=glm.GenerationConfig(
+            temperature=0.1,
+            max_output_tokens=1500,
+        ),
     )
     
-    loop = asyncio.get_event_loop()
-    response = await loop.run_in_executor(
-        None,
-        lambda: gemini_model.generate_content(
-            contents, 
-            generation_config=generation_config
-        )
-    )
-    return response.text
+    response = await gemini_client.generate_content(request, timeout=API_CALL_TIMEOUT)
+    return genai.types.GenerateContentResponse.from_response(response).text
 
 
 # ----- API Call with Retry & Fallback -----
 
 MAX_RETRIES = 3
 RETRY_DELAY = 2  # seconds
+# Switch a job to Gemini only if OpenAI asks us to back off longer than this
+GEMINI_FALLBACK_MIN_WAIT = float(os.getenv("GEMINI_FALLBACK_MIN_WAIT", "10"))
+
+
+def new_job_state() -> Dict:
+    """Per-job provider state (fallback is decided per job, never process-wide)."""
+    return {"gemini_fallback": False}
 
 
 async def classify_batch(
     images_base64: List[str],
     start_idx: int,
     previous_classification: Optional[Dict] = None,
-    openai_model: str = None
+    openai_model: str = None,
+    job_state: Optional[Dict] = None,
+    page_texts: Optional[List[str]] = None
 ) -> List[Dict]:
-    global gemini_fallback_active
-    
-    if openai_model is None:
+    """Classify one batch of page images, or of page text layers when ``page_texts`` is given."""
+    if job_state is None:
+        job_state = new_job_state()
+    if page_texts is not None:
+        images_base64 = []
+        openai_model = get_openai_text_model()
+    elif openai_model is None:
         openai_model = get_openai_model()
 
-    num_pages = len(images_base64)
+    num_pages = len(page_texts) if page_texts is not None else len(images_base64)
     end_idx = start_idx + num_pages - 1
     
     prev_context = ""
@@ -265,13 +358,23 @@ async def classify_batch(
     else:
         prev_context = f"\nPage {start_idx} is the first page or follows an unknown page, so its is_continuation should be false."
 
-    prompt = BATCH_PROMPT.format(
-        num_pages=num_pages,
-        start_idx=start_idx,
-        end_idx=end_idx,
-        start_idx_plus_1=start_idx + 1,
-        previous_context=prev_context
-    )
+    if page_texts is not None:
+        prompt = TEXT_BATCH_PROMPT.format(
+            num_pages=num_pages,
+            start_idx=start_idx,
+            end_idx=end_idx,
+            previous_context=prev_context,
+            pages_text=_format_pages_text(page_texts, start_idx)
+        )
+    else:
+        prompt = BATCH_PROMPT.format(
+            num_pages=num_pages,
+            start_idx=start_idx,
+            end_idx=end_idx,
+            start_idx_plus_1=start_idx + 1,
+            previous_context=prev_context
+        )
+    kind = "text" if page_texts is not None else "vision"
     
     # Retry loop
     last_error = None
@@ -279,24 +382,35 @@ async def classify_batch(
         try:
             result_text = None
             
-            # Use Gemini if fallback is active
-            use_gemini = gemini_fallback_active and configure_gemini()
+            # Use Gemini if this job has fallen back to it
+            use_gemini = job_state.get("gemini_fallback") and configure_gemini()
             
             if use_gemini:
-                print(f"  [AI] Gemini → batch {start_idx}-{end_idx}")
-                result_text = await call_gemini(prompt, images_base64)
+                print(f"  [AI] Gemini ({kind}) → batch {start_idx}-{end_idx}")
+                result_text = await get_rate_limiter("gemini").call(
+                    lambda: call_gemini(prompt, images_base64)
+                )
             else:
                 try:
-                    print(f"  [AI] OpenAI ({openai_model}) → batch {start_idx}-{end_idx}")
-                    result_text = await call_openai(openai_model, prompt, images_base64)
-                except openai.RateLimitError as e:
-                    print(f"  ⚠️ OpenAI Rate Limit (429)")
-                    if configure_gemini():
-                        print(f"  🔄 Switching to Gemini!")
-                        gemini_fallback_active = True
-                        result_text = await call_gemini(prompt, images_base64)
+                    print(f"  [AI] OpenAI ({openai_model}, {kind}) → batch {start_idx}-{end_idx}")
+                    result_text = await get_rate_limiter("openai").call(
+                        lambda: call_openai(openai_model, prompt, images_base64)
+                    )
+                except Exception as e:
+                    if not is_rate_limit_error(e):
+                        raise
+                    # The limiter has already backed off for Retry-After; only give up on
+                    # OpenAI for this job when the wait is long and Gemini is available.
+                    wait = retry_after_seconds(e)
+                    print(f"  ⚠️ OpenAI Rate Limit (429), retry-after={wait}")
+                    if (wait is None or wait >= GEMINI_FALLBACK_MIN_WAIT) and configure_gemini():
+                        print(f"  🔄 Switching this job to Gemini!")
+                        job_state["gemini_fallback"] = True
+                        result_text = await get_rate_limiter("gemini").call(
+                            lambda: call_gemini(prompt, images_base64)
+                        )
                     else:
-                        raise e
+                        raise
             
             if not result_text or not result_text.strip():
                 print(f"  [attempt {attempt}] Empty response, retrying...")
@@ -319,8 +433,10 @@ async def classify_batch(
             
         except Exception as e:
             last_error = str(e)
+            rate_limited = is_rate_limit_error(e)
             print(f"  [attempt {attempt}] Error: {last_error[:100]}")
-            if attempt < MAX_RETRIES:
+            # Throttled calls wait inside the rate limiter (Retry-After), no extra sleep here
+            if attempt < MAX_RETRIES and not rate_limited:
                 await asyncio.sleep(RETRY_DELAY * attempt)
     
     # All retries failed
@@ -333,6 +449,22 @@ async def classify_batch(
 def post_process_classifications(classifications: List[Dict]) -> List[Dict]:
     """Fix continuations, normalize names, and fill Error pages."""
     results = [c.copy() for c in classifications]
+
+    # Pass 0: Page-cache hits carry no person name (the cache is shared by every
+    # customer); take it from the nearest page of the same document type
+    for i in range(len(results)):
+        if results[i].get("person_name_en"):
+            continue
+        doc_type = results[i].get("document_type_en")
+        for step in (-1, 1):
+            j = i + step
+            while 0 <= j < len(results) and results[j].get("document_type_en") == doc_type:
+                if results[j].get("person_name_en"):
+                    results[i]["person_name_en"] = results[j]["person_name_en"]
+                    break
+                j += step
+            if results[i].get("person_name_en"):
+                break
     
     # Pass 1: Normalize all person names to UPPERCASE
     for i in range(len(results)):
@@ -402,75 +534,209 @@ async def classify_all_pages(
     model: str = None,
     progress_callback=None
 ) -> List[Dict]:
-    global gemini_fallback_active
-    
-    # Reset fallback at the start of a new run to give OpenAI a try again
-    gemini_fallback_active = False
+    """Classify pages that are already rendered (in memory)."""
+    return await classify_page_stream(
+        images_base64, len(images_base64), model=model, progress_callback=progress_callback
+    )
+
+
+PREFETCH_BATCHES = 2  # Rendered batches waiting for a free classify slot
+
+
+async def classify_page_stream(
+    pages: Iterable[str],
+    total_pages: int,
+    model: str = None,
+    progress_callback=None,
+    completed_batches: Optional[Dict[Tuple[int, ...], List[Dict]]] = None,
+    batch_callback=None,
+    page_cache=None
+) -> List[Dict]:
+    """
+    Classify pages produced lazily by ``pages``: base64 JPEG strings (e.g.
+    pdf_service.iter_page_images) or {"image": ...} / {"text": ...} dicts from
+    pdf_service.iter_page_inputs. Text pages are classified with the text-only prompt,
+    image pages with the vision model. Every batch is a run of consecutive pages of
+    one kind: a change of kind or a cache hit closes the current batch, so the page
+    numbers in the prompt and the is_continuation judgement match the real pages.
+
+    A single worker thread pulls BATCH_SIZE pages at a time from the iterator and
+    hands each batch to the classifiers through a bounded queue, so only the batches
+    in flight plus PREFETCH_BATCHES are ever held in memory.
+
+    ``completed_batches`` ({(page numbers...): results}) lets a resumed job skip batches
+    it already paid for; ``batch_callback(page_nums, results)`` is awaited after each
+    successfully classified batch so callers can persist it. A stored batch is reused
+    only for exactly the same pages (cache hits can shift batch boundaries).
+
+    ``page_cache`` (pdf_tools.page_cache.PageClassificationCache) resolves pages seen
+    before; only the remaining pages are grouped into batches for the API.
+    """
+    completed_batches = completed_batches or {}
+    # Each run starts on OpenAI; a fallback to Gemini only affects this job
+    job_state = new_job_state()
     
     if model is None:
         model = get_openai_model()
 
-    total_pages = len(images_base64)
-    
-    # Build list of all batch tasks: [(batch_images, start_idx), ...]
-    batch_tasks = []
-    for i in range(0, total_pages, BATCH_SIZE):
-        batch_images = images_base64[i:i + BATCH_SIZE]
-        start_idx = i + 1
-        batch_tasks.append((batch_images, start_idx))
-    
-    total_batches = len(batch_tasks)
+    total_batches = (total_pages + BATCH_SIZE - 1) // BATCH_SIZE
     
     print(f"\n{'='*60}")
-    print(f"[AI] {total_pages} pages | {BATCH_SIZE} pages/batch | {total_batches} batches | {MAX_PARALLEL} parallel")
+    print(f"[AI] {total_pages} pages | {BATCH_SIZE} pages/batch | up to {total_batches} batches | {MAX_PARALLEL} parallel")
     print(f"{'='*60}")
     
-    # Process batches in parallel waves of MAX_PARALLEL
-    all_results = [None] * total_batches  # Preserve order
-    pages_done = 0
-    
-    for wave_start in range(0, total_batches, MAX_PARALLEL):
-        wave_end = min(wave_start + MAX_PARALLEL, total_batches)
-        wave_indices = list(range(wave_start, wave_end))
-        
-        wave_batch_info = [batch_tasks[idx] for idx in wave_indices]
-        
-        page_range = f"{wave_batch_info[0][1]}-{wave_batch_info[-1][1] + len(wave_batch_info[-1][0]) - 1}"
-        print(f"\n{'─'*40}")
-        print(f"[Wave] {len(wave_indices)} batches parallel (pages {page_range})")
-        
-        # Create async tasks for this wave
-        async_tasks = []
-        for batch_images, start_idx in wave_batch_info:
-            task = classify_batch(batch_images, start_idx, None, model)
-            async_tasks.append(task)
-        
-        # Run all batches in this wave simultaneously
-        wave_results = await asyncio.gather(*async_tasks, return_exceptions=True)
-        
-        # Collect results in order
-        for i, (batch_idx, result) in enumerate(zip(wave_indices, wave_results)):
-            if isinstance(result, Exception):
-                print(f"  ❌ Batch {batch_idx + 1} failed: {result}")
-                num_pages = len(batch_tasks[batch_idx][0])
-                start_idx = batch_tasks[batch_idx][1]
-                all_results[batch_idx] = _generate_error_batch(str(result), num_pages, start_idx)
+    loop = asyncio.get_running_loop()
+    # One thread owns the iterator (fitz documents must not be used concurrently)
+    render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="page-render")
+    page_iter = iter(pages)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PREFETCH_BATCHES)
+
+    # Sliding window: MAX_PARALLEL consumers, each picks the next batch as soon as
+    # it finishes the previous one (no waiting on a whole wave).
+    page_results: Dict[int, Dict] = {}  # 1-based page number -> result
+    progress_lock = asyncio.Lock()
+    next_to_report = 1
+    cache_hits = 0
+    text_pages = 0
+    producer_error: Optional[BaseException] = None
+
+    async def flush_progress():
+        # Report pages strictly in page order: only the contiguous prefix of finished pages
+        nonlocal next_to_report
+        async with progress_lock:
+            while next_to_report in page_results:
+                page_num = next_to_report
+                next_to_report += 1
+                if progress_callback:
+                    await progress_callback(page_num, total_pages, page_results[page_num])
+
+    def hash_item(item: Dict[str, str]) -> str:
+        if "text" in item:
+            return page_cache.hash_text(item["text"])
+        return page_cache.hash_page(item["image"])
+
+    def render_next():
+        # Runs on the render thread: render, hash and look up the next pages
+        items = [
+            item if isinstance(item, dict) else {"image": item}
+            for item in itertools.islice(page_iter, BATCH_SIZE)
+        ]
+        if not items or page_cache is None:
+            return items, [None] * len(items), {}
+        try:
+            hashes = [hash_item(item) for item in items]
+            return items, hashes, page_cache.get_many(hashes)
+        except Exception as e:
+            print(f"  ⚠️ Page cache unavailable: {e}")
+            return items, [None] * len(items), {}
+
+    async def produce():
+        nonlocal producer_error, cache_hits, text_pages
+        batch_idx = 0
+        page_num = 1
+        # Consecutive pages of one kind not resolved by the cache: [(page_num, payload, phash)]
+        pending: list = []
+        pending_kind = None
+
+        async def close_batch():
+            nonlocal batch_idx
+            if pending:
+                await queue.put((batch_idx, pending_kind, pending[:]))
+                pending.clear()
+                batch_idx += 1
+
+        try:
+            while True:
+                items, hashes, hits = await loop.run_in_executor(render_pool, render_next)
+                if not items:
+                    break
+                for item, phash in zip(items, hashes):
+                    kind = "text" if "text" in item else "image"
+                    if phash is not None and phash in hits:
+                        await close_batch()
+                        page_results[page_num] = dict(hits[phash])
+                        cache_hits += 1
+                        print(f"  ⚡ P{page_num}: {hits[phash]['document_type_en']} | {hits[phash]['person_name_en']} (cached)")
+                    else:
+                        if kind != pending_kind:
+                            await close_batch()
+                            pending_kind = kind
+                        pending.append((page_num, item[kind], phash))
+                        text_pages += int(kind == "text")
+                        if len(pending) >= BATCH_SIZE:
+                            await close_batch()
+                    page_num += 1
+                if hits:
+                    await flush_progress()
+            await close_batch()
+        except Exception as e:
+            producer_error = e
+            print(f"  ❌ Page rendering failed: {e}")
+        # Not in a finally: when cancelled the consumers are cancelled too, and a full
+        # queue would block this put forever
+        for _ in range(MAX_PARALLEL):
+            await queue.put(None)
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            batch_idx, kind, batch = item
+            page_nums = [entry[0] for entry in batch]
+            payloads = [entry[1] for entry in batch]
+            start_idx = page_nums[0]
+            cached = completed_batches.get(tuple(page_nums))
+            if cached is not None and len(cached) == len(payloads):
+                print(f"  ↺ Batch {batch_idx + 1} restored from previous run")
+                result = cached
             else:
-                all_results[batch_idx] = result
-            
-            # Send progress for this batch
-            if progress_callback:
-                batch_result = all_results[batch_idx]
-                batch_start = batch_tasks[batch_idx][1]
-                for j, res in enumerate(batch_result):
-                    pages_done += 1
-                    await progress_callback(batch_start + j, total_pages, res)
-    
-    # Flatten all batch results into a single list (in correct page order)
-    classifications = []
-    for batch_result in all_results:
-        if batch_result:
-            classifications.extend(batch_result)
+                try:
+                    if kind == "text":
+                        result = await classify_batch([], start_idx, None, model, job_state, page_texts=payloads)
+                    else:
+                        result = await classify_batch(payloads, start_idx, None, model, job_state)
+                except Exception as e:
+                    print(f"  ❌ Batch {batch_idx + 1} failed: {e}")
+                    result = _generate_error_batch(str(e), len(payloads), start_idx)
+                # Failed batches are not stored, so a resumed run retries them
+                if batch_callback and not any(r.get("document_type_en") == "Error" for r in result):
+                    await batch_callback(page_nums, result)
+            if page_cache is not None:
+                fresh = {entry[2]: res for entry, res in zip(batch, result) if entry[2] is not None}
+                if fresh:
+                    try:
+                        await loop.run_in_executor(None, page_cache.put_many, fresh)
+                    except Exception as e:
+                        print(f"  ⚠️ Page cache write failed: {e}")
+            for page_num, res in zip(page_nums, result):
+                page_results[page_num] = res
+            await flush_progress()
+
+    tasks = [asyncio.ensure_future(produce())]
+    tasks += [asyncio.ensure_future(consume()) for _ in range(MAX_PARALLEL)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # gather() leaves the siblings running when one task raises (e.g. a callback's
+        # DB error); the worker reuses this loop for its next job, so stop them here
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        close = getattr(page_iter, "close", None)
+        if close is not None:
+            await loop.run_in_executor(render_pool, close)
+        render_pool.shutdown(wait=False)
+
+    if producer_error is not None:
+        raise producer_error
+
+    # Flatten all page results into a single list (in correct page order)
+    classifications = [page_results[p] for p in sorted(page_results)]
+    if cache_hits:
+        print(f"\n[Page cache] {cache_hits}/{len(classifications)} pages resolved without the API")
+    if text_pages:
+        print(f"[Text layer] {text_pages}/{len(classifications)} pages classified from text (no vision)")
     
     # Post-process to fix cross-batch continuity and errors
     print(f"\n[Post-processing {len(classifications)} pages...]")
@@ -0,0 +1,156 @@
+"""
+Page Classification Cache
+Remembers vision classifications per rendered page so re-uploaded pages
+(same passport / ID card / statement inside a different bundle) skip the API.
+- Key: perceptual difference hash (dHash) of the rendered page (or a hash of its
+  text layer for digital pages) + model + prompt version
+- Value: document_type_en, confidence (stored in SQLite)
+The hash is a wide 32x32 dHash matched exactly: robust to JPEG/render noise,
+but strict enough that two people's documents on the same template don't collide.
+
+The cache is shared by every project, and many pages are identical for every
+customer (blank separators, blank scan backs, bank T&C and contract boilerplate).
+So the person name is never cached: hits come back without one and
+post-processing takes it from the neighbouring page of the same document.
+Near-uniform images and short text pages are not cached at all.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import statistics
+import threading
+from typing import Dict, Iterable, Optional
+
+from PIL import Image
+
+import database as db
+from pdf_tools.ai_service import BATCH_PROMPT, TEXT_BATCH_PROMPT, get_openai_model, get_openai_text_model
+
+HASH_SIZE = 32  # 33x32 grayscale grid -> 1024-bit dHash
+MIN_CONFIDENCE = float(os.getenv("PAGE_CACHE_MIN_CONFIDENCE", "0.7"))
+# Below this grayscale spread the page is blank / a uniform scan back: not worth a key
+MIN_PIXEL_STDDEV = 6.0
+# Text pages shorter than this (after whitespace folding) carry too little to identify
+MIN_TEXT_CHARS = 300
+
+PROMPT_VERSION = hashlib.sha256((BATCH_PROMPT + TEXT_BATCH_PROMPT).encode("utf-8")).hexdigest()[:12]
+
+
+def page_image_hash(image_b64: str) -> Optional[str]:
+    """Difference hash of a base64 JPEG page image (hex string), or None for a
+    near-uniform page (blank, scan back) that must not be cached."""
+    img = Image.open(io.BytesIO(base64.b64decode(image_b64)))
+    # Let the JPEG decoder downscale while decoding, much cheaper than a full decode
+    img.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+    img = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(img.getdata())
+    if statistics.pstdev(pixels) < MIN_PIXEL_STDDEV:
+        return None
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            bits = (bits << 1) | int(pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+class PageClassificationCache:
+    """Duck-typed cache used by ai_service.classify_page_stream (hash_page / get_many / put_many)."""
+
+    def __init__(self, model: Optional[str] = None):
+        self.model = model or get_openai_model()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def _key(self, phash: str) -> str:
+        # Text-layer pages are classified by the text model, not the vision one
+        model = get_openai_text_model() if phash.startswith("text:") else self.model
+        raw = f"{phash}:{model}:{PROMPT_VERSION}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def hash_page(self, image_b64: str) -> Optional[str]:
+        return page_image_hash(image_b64)
+
+    def hash_text(self, text: str) -> Optional[str]:
+        normalized = " ".join(text.split())
+        if len(normalized) < MIN_TEXT_CHARS:
+            return None
+        return "text:" + hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get_many(self, phashes: Iterable[Optional[str]]) -> Dict[str, Dict]:
+        keys = {self._key(h): h for h in phashes if h is not None}
+        found = db.get_page_classifications(list(keys))
+        results = {}
+        for key, entry in found.items():
+            # Empty name: filled from the neighbouring page by post-processing
+            results[keys[key]] = {
+                "document_type_en": entry["document_type_en"],
+                "person_name_en": "",
+                "document_type": entry["document_type_en"],
+                "person_name": "",
+                "is_continuation": False,
+                "confidence": entry["confidence"],
+                "notes": "Cached classification",
+            }
+        with self._lock:
+            self.hits += len(results)
+            self.misses += len(keys) - len(results)
+        return results
+
+    def put_many(self, results: Dict[str, Dict]) -> None:
+        entries = {}
+        for phash, result in results.items():
+            if result.get("document_type_en") in ("Error", "Unknown_Document"):
+                continue
+            if float(result.get("confidence", 0.0)) < MIN_CONFIDENCE:
+                continue
+            if phash is None:
+                continue
+            entries[self._key(phash)] = {
+                "document_type_en": result.get("document_type_en", ""),
+                "person_name_en": "",  # never shared across customers
+                "confidence": float(result.get("confidence", 0.0)),
+            }
+        if entries:
+            db.save_page_classifications(entries)
+            with self._lock:
+                self.stores += len(entries)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model,
+                "prompt_version": PROMPT_VERSION,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stored": self.stores,
+            }
+
+
+_caches: Dict[str, PageClassificationCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_page_cache(model: Optional[str] = None) -> Optional[PageClassificationCache]:
+    """Shared cache per model; None when disabled with PAGE_CACHE_ENABLED=0."""
+    if os.getenv("PAGE_CACHE_ENABLED", "1").strip().lower() in ("0", "false", "no"):
+        return None
+    model = model or get_openai_model()
+    with _caches_lock:
+        cache = _caches.get(model)
+        if cache is None:
+            cache = PageClassificationCache(model)
+            _caches[model] = cache
+        return cache
+
+
+def get_page_cache_stats() -> Dict[str, Dict]:
+    with _caches_lock:
+        caches = dict(_caches)
+    return {model: cache.stats() for model, cache in caches.items()}
@@ -7,49 +7,255 @@ import fitz  # PyMuPDF
 import base64
 import os
 import io
+import multiprocessing
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
-from typing import List, Dict, Tuple
+from typing import Iterator, List, Dict, Optional, Tuple
 
 
-def pdf_to_images(pdf_path: str, dpi: int = 150) -> List[str]:
+def render_page_jpeg(
+    page,
+    dpi: int = 150,
+    max_size: int = 1500,
+    quality: int = 85,
+    fit_to_max: bool = False
+) -> bytes:
+    """
+    Render a single fitz page to JPEG bytes, downsized to at most ``max_size`` px.
+
+    Shared by the AI splitter and the letter ingest OCR so both send the same
+    compact images to the vision models. With ``fit_to_max`` the zoom is chosen so
+    MuPDF rasterizes straight at the target size, skipping the LANCZOS downscale.
+    """
+    zoom = dpi / 72
+    if fit_to_max:
+        longest = max(page.rect.width, page.rect.height)
+        if longest > 0:
+            zoom = min(zoom, max_size / longest)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+
+    # Convert to PIL Image
+    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+    # Resize if too large (max 1500px) to reduce API cost
+    if max(img.size) > max_size:
+        ratio = max_size / max(img.size)
+        new_size = (int(img.width * ratio), int(img.height * ratio))
+        img = img.resize(new_size, Image.LANCZOS)
+
+    # Convert to JPEG (much smaller than PNG)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+# ----- Process-pool rasterization -----
+
+RENDER_CHUNK_PAGES = 5  # Pages per task when streaming through the pool
+MIN_PAGES_FOR_POOL = 4  # Smaller files are faster to render in-process
+
+
+def _render_workers() -> int:
+    try:
+        workers = int(os.getenv("PDF_RENDER_WORKERS", str(os.cpu_count() or 1)))
+    except ValueError:
+        workers = os.cpu_count() or 1
+    return max(1, workers)
+
+
+def _render_fit_to_max() -> bool:
+    return os.getenv("PDF_RENDER_AT_TARGET_SIZE", "1").strip().lower() not in ("0", "false", "no")
+
+
+# One pool per size, so an explicit ``workers`` argument is honoured; callers that
+# use the defaults (PDF_RENDER_WORKERS / PDF_SPLIT_WORKERS) only ever create one each
+_render_pools: Dict[int, ProcessPoolExecutor] = {}
+_render_pool_lock = threading.Lock()
+# Never fork: by the time a pool is created the server runs request threads, splitter
+# loops and holds SQLite/httpx locks, and a forked child can deadlock on any of them
+_POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _get_render_pool(workers: int) -> ProcessPoolExecutor:
+    with _render_pool_lock:
+        pool = _render_pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=_POOL_CONTEXT)
+            _render_pools[workers] = pool
+        return pool
+
+
+def _reset_render_pool(workers: int) -> None:
+    with _render_pool_lock:
+        pool = _render_pools.pop(workers, None)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def usable_text_layer(page, min_chars: int) -> str:
+    """
+    Return the page's text layer if it is good enough to classify without vision
+    (at least ``min_chars`` characters, mostly letters/digits), else "".
+    """
+    if min_chars <= 0:
+        return ""
+    text = (page.get_text("text") or "").strip()
+    if len(text) < min_chars:
+        return ""
+    meaningful = sum(1 for ch in text if ch.isalnum())
+    non_space = sum(1 for ch in text if not ch.isspace())
+    if not non_space or meaningful / non_space < 0.6:
+        return ""
+    return text
+
+
+def _page_input(page, dpi: int, fit_to_max: bool, min_text_chars: int) -> Dict[str, str]:
+    text = usable_text_layer(page, min_text_chars)
+    if text:
+        return {"text": text}
+    jpeg_bytes = render_page_jpeg(page, dpi=dpi, fit_to_max=fit_to_max)
+    return {"image": base64.b64encode(jpeg_bytes).decode("utf-8")}
+
+
+def _render_page_range(
+    pdf_path: str, start: int, end: int, dpi: int, fit_to_max: bool, min_text_chars: int = 0
+) -> List[Dict[str, str]]:
+    """Worker: open the PDF in this process and prepare pages [start, end)."""
+    doc = fitz.open(pdf_path)
+    try:
+        return [
+            _page_input(doc[i], dpi, fit_to_max, min_text_chars)
+            for i in range(start, min(end, len(doc)))
+        ]
+    finally:
+        doc.close()
+
+
+def _page_ranges(page_count: int, chunk: int) -> List[Tuple[int, int]]:
+    return [(i, min(i + chunk, page_count)) for i in range(0, page_count, chunk)]
+
+
+def _iter_pages_in_process(
+    pdf_path: str, dpi: int, fit_to_max: bool, first_page: int = 0, min_text_chars: int = 0
+) -> Iterator[Dict[str, str]]:
+    doc = fitz.open(pdf_path)
+    try:
+        for page_num in range(first_page, len(doc)):
+            yield _page_input(doc[page_num], dpi, fit_to_max, min_text_chars)
+    finally:
+        doc.close()
+
+
+def pdf_to_images(
+    pdf_path: str,
+    dpi: int = 150,
+    workers: Optional[int] = None,
+    fit_to_max: Optional[bool] = None
+) -> List[str]:
     """
     Convert each page of a PDF to base64-encoded JPEG images.
     
     Args:
         pdf_path: Path to the PDF file
         dpi: Resolution for image conversion (150 = good balance of quality/speed)
+        workers: Processes to shard page ranges across (default: PDF_RENDER_WORKERS / CPU count)
+        fit_to_max: Rasterize straight at the 1500px target instead of render + downscale
+            (default: PDF_RENDER_AT_TARGET_SIZE, on)
     
     Returns:
         List of base64-encoded JPEG strings, one per page
     """
-    doc = fitz.open(pdf_path)
-    images_base64 = []
-    
-    zoom = dpi / 72
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        pix = page.get_pixmap(matrix=matrix)
-        
-        # Convert to PIL Image
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        # Resize if too large (max 1500px) to reduce API cost
-        max_size = 1500
-        if max(img.size) > max_size:
-            ratio = max_size / max(img.size)
-            new_size = (int(img.width * ratio), int(img.height * ratio))
-            img = img.resize(new_size, Image.LANCZOS)
-        
-        # Convert to JPEG base64 (much smaller than PNG)
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG", quality=85)
-        img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        images_base64.append(img_base64)
+    workers = _render_workers() if workers is None else max(1, workers)
+    fit_to_max = _render_fit_to_max() if fit_to_max is None else fit_to_max
+    page_count = get_page_count(pdf_path)
+
+    if workers > 1 and page_count >= MIN_PAGES_FOR_POOL:
+        # One contiguous shard per worker, each worker opens the document itself
+        shard = -(-page_count // workers)
+        try:
+            pool = _get_render_pool(workers)
+            futures = [
+                pool.submit(_render_page_range, pdf_path, start, end, dpi, fit_to_max)
+                for start, end in _page_ranges(page_count, shard)
+            ]
+            images_base64 = []
+            for future in futures:
+                images_base64.extend(item["image"] for item in future.result())
+            return images_base64
+        except BrokenProcessPool as e:
+            print(f"[PDF] Render pool unavailable ({e}), rendering in-process")
+            _reset_render_pool(workers)
+
+    return [item["image"] for item in _iter_pages_in_process(pdf_path, dpi, fit_to_max)]
+
+
+def iter_page_inputs(
+    pdf_path: str,
+    dpi: int = 150,
+    workers: Optional[int] = None,
+    fit_to_max: Optional[bool] = None,
+    min_text_chars: int = 0
+) -> Iterator[Dict[str, str]]:
+    """
+    Lazily prepare a PDF page by page for classification, in page order.
     
-    doc.close()
-    return images_base64
+    Yields {"text": ...} for pages whose text layer is usable (only when
+    ``min_text_chars`` > 0; these pages are never rasterized) and
+    {"image": <base64 JPEG>} for everything else. With a process pool, chunks of
+    RENDER_CHUNK_PAGES are prepared ahead by at most ``workers`` chunks, so memory
+    stays bounded while callers start working on early pages.
+    """
+    workers = _render_workers() if workers is None else max(1, workers)
+    fit_to_max = _render_fit_to_max() if fit_to_max is None else fit_to_max
+    page_count = get_page_count(pdf_path)
+
+    if workers <= 1 or page_count < MIN_PAGES_FOR_POOL:
+        yield from _iter_pages_in_process(pdf_path, dpi, fit_to_max, min_text_chars=min_text_chars)
+        return
+
+    pending = deque()
+    ranges = iter(_page_ranges(page_count, RENDER_CHUNK_PAGES))
+    yielded = 0
+    try:
+        pool = _get_render_pool(workers)
+        for start, end in ranges:
+            pending.append(pool.submit(_render_page_range, pdf_path, start, end, dpi, fit_to_max, min_text_chars))
+            if len(pending) >= workers:
+                break
+        while pending:
+            chunk = pending.popleft().result()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                pending.append(pool.submit(
+                    _render_page_range, pdf_path, *next_range, dpi, fit_to_max, min_text_chars
+                ))
+            for item in chunk:
+                yield item
+                yielded += 1
+    except BrokenProcessPool as e:
+        print(f"[PDF] Render pool unavailable ({e}), rendering in-process")
+        _reset_render_pool(workers)
+        yield from _iter_pages_in_process(
+            pdf_path, dpi, fit_to_max, first_page=yielded, min_text_chars=min_text_chars
+        )
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def iter_page_images(
+    pdf_path: str,
+    dpi: int = 150,
+    workers: Optional[int] = None,
+    fit_to_max: Optional[bool] = None
+) -> Iterator[str]:
+    """Lazily render a PDF page by page, yielding base64-encoded JPEG strings in order."""
+    for item in iter_page_inputs(pdf_path, dpi=dpi, workers=workers, fit_to_max=fit_to_max):
+        yield item["image"]
 
 
 def get_page_count(pdf_path: str) -> int:
@@ -60,6 +266,163 @@ def get_page_count(pdf_path: str) -> int:
     return count
 
 
+# ----- Split engine -----
+
+def _page_runs(pages: List[int]) -> List[Tuple[int, int]]:
+    """Collapse page numbers into (first, last) runs of consecutive pages."""
+    runs: List[Tuple[int, int]] = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], page)
+        else:
+            runs.append((page, page))
+    return runs
+
+
+def _build_document(src_doc, pages: List[int]) -> bytes:
+    new_doc = fitz.open()  # Create empty PDF
+    try:
+        for first, last in _page_runs(pages):
+            new_doc.insert_pdf(src_doc, from_page=first, to_page=last)
+        return new_doc.tobytes()
+    finally:
+        new_doc.close()
+
+
+def _write_documents_worker(pdf_path: str, documents: List[Dict]) -> None:
+    """Worker: open the source once in this process and write its share of documents."""
+    src_doc = fitz.open(pdf_path)
+    try:
+        for document in documents:
+            with open(document["path"], "wb") as f:
+                f.write(_build_document(src_doc, document["pages"]))
+    finally:
+        src_doc.close()
+
+
+def _split_workers() -> int:
+    try:
+        return max(1, int(os.getenv("PDF_SPLIT_WORKERS", "1")))
+    except ValueError:
+        return 1
+
+
+def write_split_documents(
+    pdf_path: str,
+    documents: List[Dict],
+    workers: Optional[int] = None
+) -> List[Dict]:
+    """
+    Write several output PDFs from one source, parsing the source only once.
+    
+    Args:
+        pdf_path: Source PDF path
+        documents: [{"pages": [0-indexed page numbers], "path": output path}, ...]
+        workers: Shard documents across the process pool, each worker opening the
+            source once (default: PDF_SPLIT_WORKERS, 1 = single handle in-process)
+    
+    Returns:
+        The documents actually written (out-of-range pages dropped, empty documents skipped)
+    """
+    workers = _split_workers() if workers is None else max(1, workers)
+    src_doc = fitz.open(pdf_path)
+    try:
+        total = len(src_doc)
+        written = []
+        for document in documents:
+            pages = [p for p in document["pages"] if 0 <= p < total]
+            if pages:
+                written.append({**document, "pages": pages})
+
+        if workers > 1 and len(written) > workers:
+            src_doc.close()
+            src_doc = None
+            # Balance shards by page count (largest documents first)
+            shards: List[List[Dict]] = [[] for _ in range(workers)]
+            loads = [0] * workers
+            for document in sorted(written, key=lambda d: len(d["pages"]), reverse=True):
+                idx = loads.index(min(loads))
+                shards[idx].append(document)
+                loads[idx] += len(document["pages"])
+            try:
+                pool = _get_render_pool(workers)
+                futures = [pool.submit(_write_documents_worker, pdf_path, shard) for shard in shards if shard]
+                for future in futures:
+                    future.result()
+            except BrokenProcessPool as e:
+                print(f"[PDF] Split pool unavailable ({e}), writing in-process")
+                _reset_render_pool(workers)
+                _write_documents_worker(pdf_path, written)
+            return written
+
+        for document in written:
+            with open(document["path"], "wb") as f:
+                f.write(_build_document(src_doc, document["pages"]))
+        return written
+    finally:
+        if src_doc is not None:
+            src_doc.close()
+
+
+# ----- Streaming ZIP -----
+
+ZIP_STREAM_CHUNK = 1024 * 1024
+# Already-compressed formats gain nothing from deflate
+_STORED_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".zip")
+
+
+class _ZipChunkBuffer(io.RawIOBase):
+    """Write-only, non-seekable sink: zipfile writes into it, the generator drains it."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip_stream(files: List[Tuple[str, str]], chunk_size: int = ZIP_STREAM_CHUNK) -> Iterator[bytes]:
+    """
+    Build a ZIP of ``files`` ([(path, arcname), ...]) on the fly, yielding it chunk by chunk.
+    
+    Nothing is written to disk and at most ~one chunk is buffered. PDFs and images
+    are stored uncompressed; anything else is deflated.
+    """
+    sink = _ZipChunkBuffer()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, arcname in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            if arcname.lower().endswith(_STORED_EXTENSIONS):
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as src, zf.open(info, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dest:
+                while True:
+                    block = src.read(chunk_size)
+                    if not block:
+                        break
+                    dest.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # Central directory is written when the archive closes
+    data = sink.drain()
+    if data:
+        yield data
+
+
 def extract_pages_to_pdf(pdf_path: str, page_numbers: List[int], output_path: str) -> str:
     """
     Extract specific pages from a PDF and save as a new PDF.
@@ -72,17 +435,7 @@ def extract_pages_to_pdf(pdf_path: str, page_numbers: List[int], output_path: st
     Returns:
         Path to the created PDF
     """
-    src_doc = fitz.open(pdf_path)
-    new_doc = fitz.open()  # Create empty PDF
-    
-    for page_num in page_numbers:
-        if 0 <= page_num < len(src_doc):
-            new_doc.insert_pdf(src_doc, from_page=page_num, to_page=page_num)
-    
-    new_doc.save(output_path)
-    new_doc.close()
-    src_doc.close()
-    
+    write_split_documents(pdf_path, [{"pages": page_numbers, "path": output_path}], workers=1)
     return output_path
 
 
@@ -104,7 +457,7 @@ def create_output_files(
         pdf_path: Source PDF path
         classifications: List of classification results from AI, one per page.
             Each dict has: document_type_en, person_name_en, is_continuation
-        output_dir: Directory to save output files
+        output_dir: Directory to save output files (ZIPs are streamed on demand by iter_zip_stream)
     
     Returns:
         List of dicts with info about created files:
@@ -145,7 +498,7 @@ def create_output_files(
     if current_doc is not None:
         documents.append(current_doc)
     
-    # Create output files
+    # Name output files, then write them all from a single open of the source
     output_files = []
     # Track duplicate names to add numbering
     name_counter = {}
@@ -165,9 +518,6 @@ def create_output_files(
         
         output_path = os.path.join(output_dir, filename)
         
-        # Extract pages and create new PDF
-        extract_pages_to_pdf(pdf_path, doc["pages"], output_path)
-        
         output_files.append({
             "filename": filename,
             "document_type": doc["document_type"],
@@ -176,4 +526,8 @@ def create_output_files(
             "path": output_path,
         })
     
+    write_split_documents(
+        pdf_path,
+        [{"pages": doc["pages"], "path": f["path"]} for doc, f in zip(documents, output_files)],
+    )
     return output_files
@@ -0,0 +1,200 @@
+"""
+Adaptive rate limiting for vision API calls.
+One limiter per provider, shared by every splitter job in the process:
+- Token bucket caps the request rate (requests/second + burst)
+- AIMD concurrency window: +1 slot per window of successes, halved on each 429
+- Retry-After / retry-after-ms headers pause the whole provider until they expire
+Splitter jobs run on separate event loops (one per worker thread), so state is
+guarded by a threading.Lock and waiting is done with short asyncio.sleep polls
+instead of loop-bound asyncio primitives.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+MAX_WAIT_SLICE = 0.5  # seconds between re-checks while waiting for a slot
+
+
+class AdaptiveRateLimiter:
+    def __init__(
+        self,
+        name: str,
+        rate_per_sec: float,
+        burst: int,
+        max_concurrency: int,
+        min_concurrency: int = 1,
+    ):
+        self.name = name
+        self.rate_per_sec = max(rate_per_sec, 0.01)
+        self.burst = max(burst, 1)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._window = float(self.max_concurrency)
+        self._in_flight = 0
+        self._blocked_until = 0.0
+
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def _refill_locked(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate_per_sec)
+        self._last_refill = now
+
+    def _try_acquire_locked(self, now: float) -> float:
+        """Take a slot and return 0, or return how long to wait before trying again."""
+        self._refill_locked(now)
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self._in_flight >= int(self._window):
+            return 0.05
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate_per_sec
+        self._tokens -= 1
+        self._in_flight += 1
+        self.requests += 1
+        return 0.0
+
+    async def acquire(self) -> None:
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                wait = self._try_acquire_locked(time.monotonic())
+                if wait <= 0:
+                    self.wait_seconds += time.monotonic() - started
+                    return
+            await asyncio.sleep(min(wait, MAX_WAIT_SLICE))
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None,
+                completed: bool = True) -> None:
+        """Free a slot. ``completed=False`` (cancelled call) leaves the window unchanged."""
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            if not completed:
+                return
+            if throttled:
+                self.throttled += 1
+                # Multiplicative decrease
+                self._window = max(float(self.min_concurrency), self._window / 2)
+                pause = retry_after if retry_after and retry_after > 0 else 1.0
+                self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+                self._tokens = 0.0
+            else:
+                # Additive increase: roughly +1 slot per full window of successes
+                self._window = min(float(self.max_concurrency), self._window + 1.0 / self._window)
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run ``fn()`` inside a slot, feeding 429s back into the limiter."""
+        await self.acquire()
+        # The slot is always returned, including on cancellation (CancelledError is a
+        # BaseException): a leaked slot would shrink the process-wide window for good
+        throttled, retry_after, completed = False, None, False
+        try:
+            result = await fn()
+            completed = True
+            return result
+        except Exception as e:
+            completed = True
+            if is_rate_limit_error(e):
+                throttled, retry_after = True, retry_after_seconds(e)
+            raise
+        finally:
+            self.release(throttled=throttled, retry_after=retry_after, completed=completed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "rate_per_sec": self.rate_per_sec,
+                "burst": self.burst,
+                "concurrency_window": round(self._window, 2),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._in_flight,
+                "blocked_for_sec": round(max(0.0, self._blocked_until - now), 2),
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "wait_seconds": round(self.wait_seconds, 2),
+            }
+
+
+# ----- Error inspection -----
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    if getattr(exc, "status_code", None) == 429 or getattr(exc, "code", None) == 429:
+        return True
+    return type(exc).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Read Retry-After (seconds or HTTP date) / retry-after-ms from an SDK error's response."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            return float(ms) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+# ----- Per-provider registry -----
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+_PROVIDER_DEFAULTS = {
+    # provider: (env prefix, requests/sec, max concurrency)
+    "openai": ("OPENAI_VISION", 8.0, 10),
+    "gemini": ("GEMINI", 4.0, 5),
+}
+
+_limiters: Dict[str, AdaptiveRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str) -> AdaptiveRateLimiter:
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            prefix, rps, concurrency = _PROVIDER_DEFAULTS.get(provider, (provider.upper(), 4.0, 5))
+            rate = _env_float(f"{prefix}_RPS", rps)
+            max_concurrency = int(_env_float(f"{prefix}_MAX_CONCURRENCY", concurrency))
+            limiter = AdaptiveRateLimiter(
+                provider,
+                rate_per_sec=rate,
+                burst=max(1, int(rate)),
+                max_concurrency=max_concurrency,
+            )
+            _limiters[provider] = limiter
+        return limiter
+
+
+def get_rate_limiter_stats() -> Dict[str, Dict[str, Any]]:
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
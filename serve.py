@@ -0,0 +1,100 @@
+"""
+Production entry point.
+`python server.py` runs the Werkzeug dev server (reloader + debugger, one process).
+`python serve.py` runs the same Flask app on a real WSGI server:
+- Windows: waitress (threads only, no fork)
+- Linux/macOS: gunicorn with gthread workers (processes x threads)
+
+Every long SSE stream (writer, booking, translate, splitter progress) holds one
+thread for its whole duration, so size WEB_THREADS for the number of concurrent
+streams, not requests per second.
+
+State that must be shared between worker processes lives outside the process:
+splitter jobs in SQLite (`splitter_jobs`), translation uploads on disk
+(output/translation/uploads). What stays per process: LLM usage metrics,
+rate limiter state (limits apply per process) and the splitter worker pool.
+"""
+
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HOST = os.getenv("WEB_HOST", "127.0.0.1")
+PORT = int(os.getenv("WEB_PORT", "8000"))
+# gunicorn only; waitress always runs a single process
+WORKERS = max(1, int(os.getenv("WEB_WORKERS", "2")))
+THREADS = max(1, int(os.getenv("WEB_THREADS", "16")))
+# Seconds a finishing worker gets to drain in-flight requests on SIGTERM / reload
+GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+# Idle seconds before a keep-alive connection is closed
+KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", "5"))
+# Idle seconds before a silent connection (e.g. an SSE stream waiting on a slow LLM call) is dropped
+STREAM_IDLE_TIMEOUT = int(os.getenv("WEB_STREAM_IDLE_TIMEOUT", "600"))
+
+
+def init_database():
+    """Create/migrate the schema and prune blobs once, before any worker imports the
+    app (concurrent workers would race on the same SQLite file)."""
+    import database as db
+
+    db.init_db()
+    # Don't hand pooled connections to forked workers
+    db.engine.dispose()
+    os.environ["VISA_DB_INITIALIZED"] = "1"
+
+
+def serve_waitress():
+    from waitress import serve
+    from server import app
+
+    print(f"[serve] waitress on http://{HOST}:{PORT} ({THREADS} threads)")
+    serve(
+        app,
+        host=HOST,
+        port=PORT,
+        threads=THREADS,
+        channel_timeout=STREAM_IDLE_TIMEOUT,
+        connection_limit=max(100, THREADS * 4),
+        ident="visa-letter",
+    )
+
+
+def serve_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class FlaskApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{HOST}:{PORT}",
+                "workers": WORKERS,
+                "threads": THREADS,
+                "worker_class": "gthread",
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "keepalive": KEEPALIVE,
+                # gthread workers heartbeat from their main loop, so long-running
+                # request threads (SSE) do not trip this; it only catches hung workers
+                "timeout": max(60, GRACEFUL_TIMEOUT * 2),
+                # Import the app in each worker after fork: SQLite connections,
+                # process pools and splitter threads must not be shared across fork
+                "preload_app": False,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from server import app
+            return app
+
+    print(f"[serve] gunicorn on http://{HOST}:{PORT} ({WORKERS} workers x {THREADS} threads)")
+    FlaskApplication().run()
+
+
+if __name__ == "__main__":
+    init_database()
+    if sys.platform.startswith("win"):
+        serve_waitress()
+    else:
+        serve_gunicorn()
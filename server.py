@@ -5,23 +5,36 @@ import os
 import re
 import shutil
 import base64
-import tempfile
+import time
 import uuid
 from io import BytesIO
 from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from flask import Flask, Response, jsonify, request, send_from_directory
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 
 from core.agents import (
+    build_file_record,
     build_summary_profile,
     detect_domain,
     extract_text_with_openai,
     ingest_files,
+    iter_extract_files,
     itinerary_writer,
     letter_writer,
+    list_input_paths,
+    plan_incremental_ingest,
+    stream_letter_writer,
+)
+from core.extract_cache import get_extraction_cache
+from core.llm import (
+    get_chat_model,
+    get_llm_client_stats,
+    get_llm_usage_snapshot,
+    invoke_llm,
+    llm_call_scope,
+    submit_with_scope,
 )
 from core.prompts import (
     OCR_VIETNAMESE_ADMIN_PROMPT,
@@ -30,6 +43,7 @@ from core.prompts import (
 )
 from classifier.agent import classify_files_in_folder
 from pypdf import PdfReader, PdfWriter
+from pdf_tools.pdf_service import write_split_documents
 from core.state import GraphState
 import database as db
 
@@ -53,7 +67,10 @@ TRANSLATE_TEMPLATE_DIR = os.path.join("dich", "HTML template")
 TRANSLATE_OUTPUT_DIR = os.path.join("output", "translation")
 TRANSLATE_HTML_SAVE_DIR = os.path.join("dich", "html")
 TRANSLATE_DEFAULT_TEMPLATE = "a4.html"
-translation_upload_cache: Dict[str, Dict[str, str]] = {}
+# Uploaded translation sources + their metadata live on disk (not in process memory)
+# so any worker process can serve the follow-up translate request.
+TRANSLATE_UPLOAD_DIR = os.path.join(TRANSLATE_OUTPUT_DIR, "uploads")
+TRANSLATE_UPLOAD_TTL_SEC = 24 * 3600
 
 def _default_translate_template_html() -> str:
     return """<!doctype html>
@@ -87,6 +104,56 @@ def _ensure_translate_template_dir() -> None:
             f.write(_default_translate_template_html())
 
 
+def _translation_upload_meta_path(token: str) -> Optional[str]:
+    if not re.fullmatch(r"[0-9a-f]{32}", token or ""):
+        return None
+    return os.path.join(TRANSLATE_UPLOAD_DIR, f"{token}.json")
+
+
+def _purge_stale_translation_uploads() -> None:
+    """Drop uploads that were never translated (older than TRANSLATE_UPLOAD_TTL_SEC)."""
+    if not os.path.isdir(TRANSLATE_UPLOAD_DIR):
+        return
+    cutoff = time.time() - TRANSLATE_UPLOAD_TTL_SEC
+    for fname in os.listdir(TRANSLATE_UPLOAD_DIR):
+        path = os.path.join(TRANSLATE_UPLOAD_DIR, fname)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _save_translation_upload(token: str, meta: Dict[str, str]) -> None:
+    meta_path = _translation_upload_meta_path(token)
+    tmp_path = f"{meta_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+
+def _get_translation_upload(token: str) -> Dict[str, str]:
+    meta_path = _translation_upload_meta_path(token)
+    if not meta_path:
+        return {}
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _pop_translation_upload(token: str) -> Dict[str, str]:
+    meta = _get_translation_upload(token)
+    meta_path = _translation_upload_meta_path(token)
+    if meta_path:
+        try:
+            os.remove(meta_path)
+        except OSError:
+            pass
+    return meta
+
+
 def _safe_name(name: str) -> str:
     cleaned = re.sub(r"[\\/:*?\"<>|]+", " ", (name or "")).strip()
     return re.sub(r"\s+", " ", cleaned)
@@ -97,14 +164,14 @@ def _resolve_translate_source_path(input_dir: str, file_ref: str) -> Optional[st
 
     Supports:
     - files inside input_dir (same as other modules)
-    - uploaded files in temp cache using prefix: "upload_token:<token>"
+    - uploaded files in the upload store using prefix: "upload_token:<token>"
     """
     if not file_ref:
         return None
     file_ref = file_ref.strip().replace("\\", "/")
     if file_ref.startswith("upload_token:"):
         token = file_ref.split(":", 1)[1].strip()
-        meta = translation_upload_cache.get(token) or {}
+        meta = _get_translation_upload(token)
         candidate = meta.get("temp_path", "")
         if candidate and os.path.exists(candidate):
             return candidate
@@ -127,7 +194,7 @@ def _ocr_image_bytes(llm: Any, image_bytes: bytes, page_idx: int, total_pages: i
             {"type": "image_url", "image_url": {"url": _img_bytes_to_data_url(image_bytes)}},
         ]
     )
-    result = llm.invoke([SystemMessage(content="Bạn là OCR engine chính xác."), msg])
+    result = invoke_llm(llm, [SystemMessage(content="Bạn là OCR engine chính xác."), msg], step="translate")
     return (result.content or "").strip()
 
 
@@ -170,7 +237,9 @@ def _ocr_document_for_translation(llm: Any, file_path: str) -> str:
 
 def _translate_ocr_text(llm: Any, ocr_text: str) -> str:
     prompt = TRANSLATE_TO_EN_PROMPT.format(ocr_text=ocr_text)
-    result = llm.invoke([SystemMessage(content="You are a strict legal translator."), HumanMessage(content=prompt)])
+    result = invoke_llm(
+        llm, [SystemMessage(content="You are a strict legal translator."), HumanMessage(content=prompt)], step="translate"
+    )
     return (result.content or "").strip()
 
 
@@ -185,7 +254,9 @@ def _build_translation_html(
         template_html=template_html,
         translated_text=translated_text,
     )
-    result = llm.invoke([SystemMessage(content="You output valid HTML only."), HumanMessage(content=prompt)])
+    result = invoke_llm(
+        llm, [SystemMessage(content="You output valid HTML only."), HumanMessage(content=prompt)], step="translate"
+    )
     html_text = (result.content or "").strip()
     if not html_text:
         html_text = template_html.replace("{{CONTENT}}", translated_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
@@ -262,6 +333,7 @@ def _save_state(cache_dir: str, state: GraphState) -> None:
         "files": state.get("files", []),
         "grouped": state.get("grouped", {}),
         "summary_profile": state.get("summary_profile", ""),
+        "summary_sections": state.get("summary_sections", {}),
         "writer_context": state.get("writer_context", ""),
         "letter_full": state.get("letter_full", ""),
     }
@@ -362,8 +434,17 @@ def create_project():
 
 @app.get("/api/projects")
 def list_projects():
-    projects = db.list_projects()
-    return jsonify({"projects": projects})
+    # ?limit / ?cursor / ?q -> one page with counts; no params -> full list (old clients)
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor") or None
+    search = (request.args.get("q") or "").strip() or None
+    if limit is None and cursor is None and search is None:
+        return jsonify({"projects": db.list_projects()})
+    try:
+        page = db.list_projects_page(limit=limit or 50, cursor=cursor, search=search)
+    except ValueError:
+        return jsonify({"error": "invalid_cursor"}), 400
+    return jsonify(page)
 
 
 @app.get("/api/projects/<int:project_id>")
@@ -398,10 +479,11 @@ def delete_project(project_id):
 @app.post("/api/projects/<int:project_id>/clear")
 def clear_project(project_id: int):
     """Xóa toàn bộ dữ liệu của hồ sơ (DB + file tách AI) để làm người mới. Giữ lại project."""
-    project = db.get_project(project_id)
-    if not project:
-        return jsonify({"error": "Project not found"}), 404
-    db.clear_project_data(project_id)
+    with db.unit_of_work():
+        project = db.get_project(project_id)
+        if not project:
+            return jsonify({"error": "Project not found"}), 404
+        db.clear_project_data(project_id)
     # Xóa file trong splitter_uploads có prefix p{id}__
     base_dir = os.path.dirname(os.path.abspath(__file__))
     upload_dir = os.path.join(base_dir, "splitter_uploads")
@@ -453,6 +535,21 @@ def list_files():
     return jsonify({"input_dir": input_dir, "files": files})
 
 
+@app.get("/api/metrics/extract_cache")
+def extract_cache_metrics():
+    return jsonify(get_extraction_cache().stats())
+
+
+@app.get("/api/metrics/llm")
+def llm_metrics():
+    return jsonify(get_llm_usage_snapshot())
+
+
+@app.get("/api/metrics/llm_clients")
+def llm_client_metrics():
+    return jsonify(get_llm_client_stats())
+
+
 # ==================== PRE-CHECK ENDPOINTS ====================
 
 def _vision_detect_pdf_documents(llm, pdf_path: str, filename: str, total_pages: int):
@@ -497,10 +594,10 @@ Return ONLY JSON, nothing else."""}
     doc.close()
     
     from langchain_core.messages import HumanMessage, SystemMessage
-    result = llm.invoke([
+    result = invoke_llm(llm, [
         SystemMessage(content="You are a document classifier. Answer only with JSON."),
         HumanMessage(content=content_parts),
-    ])
+    ], step="precheck")
     
     # Parse response
     import re
@@ -545,11 +642,10 @@ def precheck_scan():
     if not os.path.isdir(input_dir):
         return jsonify({"error": "folder_not_found", "input_dir": input_dir}), 404
 
-    from langchain_openai import ChatOpenAI
     from classifier.agent import _extract_pdf_pages_text, _classify_multi_page_pdf
     from concurrent.futures import ThreadPoolExecutor, as_completed
 
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
 
     # Collect all files first
     all_files = []
@@ -596,9 +692,9 @@ def precheck_scan():
 
     # Process files in parallel (5 workers)
     results = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    with llm_call_scope("precheck"), ThreadPoolExecutor(max_workers=5) as executor:
         futures = {
-            executor.submit(_scan_one_file, fname, path, ext, rel_path): fname
+            submit_with_scope(executor, _scan_one_file, fname, path, ext, rel_path): fname
             for fname, path, ext, rel_path in all_files
         }
         for future in as_completed(futures):
@@ -753,7 +849,8 @@ def run_classifier():
 
     # If save_output is False, use a temp dir so classifier doesn't write to real output
     actual_output = output_dir if save_output else os.path.join("phanloai", "_temp_output")
-    result = classify_files_in_folder(input_dir=input_dir, output_dir=actual_output, model=model)
+    with llm_call_scope("classifier"):
+        result = classify_files_in_folder(input_dir=input_dir, output_dir=actual_output, model=model)
     # Store the temp dir in result so save-output can use it
     result["_temp_output"] = actual_output
     result["_final_output"] = output_dir
@@ -990,6 +1087,75 @@ def _safe_join(base: str, rel_path: str) -> str:
     return candidate
 
 
+def _write_manual_segments(
+    src_path: str,
+    total_pages: int,
+    segments: List[Any],
+    output_dir: str,
+    manual_id: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Validate manual split segments and write them all from a single open of the source."""
+    created: List[Dict[str, Any]] = []
+    documents: List[Dict[str, Any]] = []
+    reserved: set = set()
+
+    def _sanitize_name(value: str, fallback: str) -> str:
+        text = (value or "").strip()
+        text = re.sub(r"[\\/:*?\"<>|]+", " ", text)
+        text = re.sub(r"\s+", " ", text).strip()
+        return text or fallback
+
+    def _pick_unique(dest_dir: str, stem: str, ext: str) -> str:
+        candidate = os.path.join(dest_dir, f"{stem}{ext}")
+        idx = 1
+        # Outputs are written together at the end, so also skip names taken in this batch
+        while os.path.exists(candidate) or candidate in reserved:
+            candidate = os.path.join(dest_dir, f"{stem} ({idx}){ext}")
+            idx += 1
+        reserved.add(candidate)
+        return candidate
+
+    for seg in segments:
+        if not isinstance(seg, dict):
+            continue
+        name = _sanitize_name(seg.get("output_name") or "", "DOCUMENT")
+        try:
+            s = int(seg.get("start_page"))
+            e = int(seg.get("end_page"))
+        except Exception:
+            continue
+        if s < 1 or e < 1 or s > total_pages or e > total_pages:
+            continue
+        if s > e:
+            s, e = e, s
+        out_path = _pick_unique(output_dir, name, ".pdf")
+        documents.append({"pages": list(range(s - 1, e)), "path": out_path})
+        entry = {
+            "output_name": name,
+            "start_page": s,
+            "end_page": e,
+            "to": os.path.relpath(out_path, output_dir).replace("\\", "/"),
+        }
+        if manual_id:
+            entry["file_id"] = manual_id
+        created.append(entry)
+
+    try:
+        write_split_documents(src_path, documents)
+    except Exception as exc:
+        # One bad segment must not fail the whole request: write them one by one
+        print(f"[Split] Batch write failed ({exc}), retrying per segment")
+        written = set()
+        for document in documents:
+            try:
+                write_split_documents(src_path, [document], workers=1)
+                written.add(document["path"])
+            except Exception:
+                continue
+        created = [entry for entry, document in zip(created, documents) if document["path"] in written]
+    return created
+
+
 @app.post("/api/classifier/split_manual")
 def split_manual():
     """Manual PDF splitting. Outputs go to splitter_outputs/manual_<uuid>/.
@@ -1029,63 +1195,19 @@ def split_manual():
         return jsonify({"error": "source_not_pdf"}), 400
 
     try:
-        reader = PdfReader(src_path)
+        total_pages = get_page_count(src_path)
     except Exception as exc:
         return jsonify({"error": "read_pdf_failed", "detail": str(exc)}), 500
 
-    total_pages = len(reader.pages)
-
     # Output goes to splitter_outputs/manual_<uuid>/
     manual_id = f"manual_{uuid.uuid4().hex[:8]}"
     output_dir = str(SPLITTER_OUTPUT_DIR / manual_id)
     os.makedirs(output_dir, exist_ok=True)
 
-    created: list[dict[str, Any]] = []
-
-    def _sanitize_name(value: str, fallback: str) -> str:
-        text = (value or "").strip()
-        text = re.sub(r"[\\/:*?\"<>|]+", " ", text)
-        text = re.sub(r"\s+", " ", text).strip()
-        return text or fallback
-
-    def _pick_unique(dest_dir: str, stem: str, ext: str) -> str:
-        candidate = os.path.join(dest_dir, f"{stem}{ext}")
-        idx = 1
-        while os.path.exists(candidate):
-            candidate = os.path.join(dest_dir, f"{stem} ({idx}){ext}")
-            idx += 1
-        return candidate
-
-    for seg in segments:
-        if not isinstance(seg, dict):
-            continue
-        name = _sanitize_name(seg.get("output_name") or "", "DOCUMENT")
-        try:
-            s = int(seg.get("start_page"))
-            e = int(seg.get("end_page"))
-        except Exception:
-            continue
-        if s < 1 or e < 1 or s > total_pages or e > total_pages:
-            continue
-        if s > e:
-            s, e = e, s
-        writer = PdfWriter()
-        for i in range(s - 1, e):
-            writer.add_page(reader.pages[i])
-        out_path = _pick_unique(output_dir, name, ".pdf")
-        try:
-            with open(out_path, "wb") as f:
-                writer.write(f)
-        except Exception:
-            continue
-        created.append(
-            {
-                "output_name": name,
-                "start_page": s,
-                "end_page": e,
-                "to": os.path.relpath(out_path, output_dir).replace("\\", "/"),
-            }
-        )
+    try:
+        created = _write_manual_segments(src_path, total_pages, segments, output_dir)
+    except Exception as exc:
+        return jsonify({"error": "split_failed", "detail": str(exc)}), 500
 
     # If splitting from AI result, remove the original AI file so it won't be
     # transferred to classifier (only the new manual splits will be transferred).
@@ -1333,7 +1455,7 @@ def pdf_rename_suggest_name():
     if not input_text:
         return jsonify({"error": "missing_input_text"}), 400
 
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
 
     system = SystemMessage(
         content=(
@@ -1349,7 +1471,7 @@ def pdf_rename_suggest_name():
     )
 
     try:
-        result = llm.invoke([system, human])
+        result = invoke_llm(llm, [system, human], step="pdf_rename")
     except Exception as exc:
         return jsonify({"error": "llm_error", "detail": str(exc)}), 500
 
@@ -1461,7 +1583,7 @@ def edit_pdf():
 def list_steps():
     project_id = request.args.get("project_id", type=int)
     if project_id:
-        state = db.get_latest_letter_state(project_id)
+        state = db.get_letter_status(project_id)
         if state:
             steps = [
                 {"name": "ingest", "done": state["step_ingest"]},
@@ -1484,7 +1606,7 @@ def list_steps():
 def get_summary():
     project_id = request.args.get("project_id", type=int)
     if project_id:
-        state = db.get_latest_letter_state(project_id)
+        state = db.get_latest_letter_state(project_id, include_files=False)
         summary = state["summary_profile"] if state else ""
         return jsonify({"summary_profile": summary})
     output_path = request.args.get("output", os.path.join("output", "letter.txt"))
@@ -1503,7 +1625,7 @@ def get_summary():
 def get_writer_context():
     project_id = request.args.get("project_id", type=int)
     if project_id:
-        state = db.get_latest_letter_state(project_id)
+        state = db.get_latest_letter_state(project_id, include_files=False)
         return jsonify({"writer_context": state["writer_context"] if state else ""})
     output_path = request.args.get("output", os.path.join("output", "letter.txt"))
     cache_dir = _cache_dir(output_path)
@@ -1517,11 +1639,12 @@ def ingest_stream():
     output_path = request.args.get("output", os.path.join("output", "letter.txt"))
     model = request.args.get("model") or get_vision_model()  # ingest reads images
     force = request.args.get("force", "0") == "1"
+    full = request.args.get("full", "0") == "1"
     project_id = request.args.get("project_id", type=int)
 
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
     cache_dir = _cache_dir(output_path)
-    files: List[Dict[str, str]] = []
+    files: List[Dict[str, Any]] = []
 
     if force:
         _reset_downstream_steps(cache_dir, "ingest")
@@ -1529,26 +1652,46 @@ def ingest_stream():
     def sse(data: Dict) -> str:
         return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
+    def _previous_files() -> List[Dict[str, Any]]:
+        if full:
+            return []
+        if project_id:
+            letter_state = db.get_latest_letter_state(project_id)
+            if letter_state and letter_state.get("files_data"):
+                return letter_state["files_data"]
+        return _load_state(cache_dir).get("files", [])
+
     def generate():
-        for root, _, filenames in os.walk(input_dir):
-            for fname in filenames:
-                path = os.path.join(root, fname)
-                yield sse({"type": "progress", "message": f"Đang trích xuất: {fname}"})
-                text = extract_text_with_openai(llm, path)
-                files.append(
-                    {
-                        "path": path,
-                        "name": fname,
-                        "text": text,
-                        "domain": detect_domain(fname),
-                    }
-                )
+        paths = list_input_paths(input_dir)
+        reused, to_extract = plan_incremental_ingest(paths, _previous_files())
+        results: List[Optional[Dict[str, Any]]] = [None] * len(paths)
+        for idx, record in reused.items():
+            results[idx] = record
+        total = len(to_extract)
+        if reused:
+            yield sse({"type": "progress", "message": f"Dùng lại {len(reused)} file không thay đổi"})
+        yield sse({"type": "progress", "message": f"Đang trích xuất {total} file..."})
+        done = 0
+        with llm_call_scope("ingest", project_id):
+            for pending_idx, record in iter_extract_files(llm, [paths[i] for i in to_extract]):
+                results[to_extract[pending_idx]] = record
+                done += 1
+                yield sse({"type": "progress", "message": f"Đã trích xuất ({done}/{total}): {record['name']}"})
+        files.extend(r for r in results if r is not None)
+        # Keep the cached downstream fields: summary_sections is keyed by each
+        # domain's prompt hash, so only domains whose files changed are re-summarized
+        state_cache = _load_state(cache_dir)
         state: GraphState = {
             "input_dir": input_dir,
             "output_path": output_path,
             "model": model,
             "llm": llm,
             "files": files,
+            "grouped": state_cache.get("grouped", {}),
+            "summary_profile": state_cache.get("summary_profile", ""),
+            "summary_sections": state_cache.get("summary_sections", {}),
+            "writer_context": state_cache.get("writer_context", ""),
+            "letter_full": state_cache.get("letter_full", ""),
         }
         _save_state(cache_dir, state)
         _save_step_output(cache_dir, "ingest", state)
@@ -1691,6 +1834,7 @@ def run_step():
     step = payload.get("step")
     model = payload.get("model") or get_vision_model()  # ingest step reads images
     force = bool(payload.get("force", False))
+    full = bool(payload.get("full", False))  # ignore fingerprints and re-extract every file
     writer_context = (payload.get("writer_context") or "").strip()
     project_id = payload.get("project_id", type=int) if isinstance(payload.get("project_id"), int) else None
 
@@ -1709,7 +1853,10 @@ def run_step():
         _reset_downstream_steps(cache_dir, step)
 
     state_cache = _load_state(cache_dir)
-    llm = ChatOpenAI(model=model, temperature=0)
+    if force and step == "summary":
+        # An explicit re-run of the summary step regenerates every section
+        state_cache["summary_sections"] = {}
+    llm = get_chat_model(model)
     state: GraphState = {
         "input_dir": input_dir,
         "output_path": output_path,
@@ -1718,11 +1865,14 @@ def run_step():
         "files": state_cache.get("files", []),
         "grouped": state_cache.get("grouped", {}),
         "summary_profile": state_cache.get("summary_profile", ""),
+        "summary_sections": state_cache.get("summary_sections", {}),
         "writer_context": writer_context or state_cache.get("writer_context", ""),
         "letter_full": state_cache.get("letter_full", ""),
+        "full_reingest": full,
     }
 
-    state = _run_single_step(step, state)
+    with llm_call_scope(step, project_id):
+        state = _run_single_step(step, state)
     _save_state(cache_dir, state)
     _save_step_output(cache_dir, step, state)
 
@@ -1737,6 +1887,8 @@ def run_step():
         db.save_letter_state(project_id, **db_updates)
 
     response: Dict[str, Any] = {"status": "done", "step": step}
+    if step == "ingest":
+        response["ingest_stats"] = state.get("ingest_stats", {})
     if step == "summary":
         response["summary_profile"] = state.get("summary_profile", "")
     if step == "writer":
@@ -1746,6 +1898,81 @@ def run_step():
     return jsonify(response)
 
 
+@app.post("/api/run_writer_stream")
+def run_writer_stream():
+    """Run the writer step and stream the letter over SSE as the model produces it."""
+    payload = request.get_json(force=True) or {}
+    input_dir = payload.get("input_dir", "input")
+    output_path = payload.get("output", os.path.join("output", "letter.txt"))
+    model = payload.get("model") or get_vision_model()  # same default as /api/run_step
+    force = bool(payload.get("force", False))
+    writer_context = (payload.get("writer_context") or "").strip()
+    project_id = payload.get("project_id") if isinstance(payload.get("project_id"), int) else None
+
+    cache_dir = _cache_dir(output_path)
+    missing = _missing_prereq_step(cache_dir, "writer")
+    if missing and not force:
+        return jsonify({"error": "missing_prerequisite", "missing": missing}), 400
+
+    def sse(data: Dict) -> str:
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    state_cache = _load_state(cache_dir)
+    if _is_step_done(cache_dir, "writer") and not force:
+        def cached():
+            yield sse({
+                "type": "done",
+                "status": "cached",
+                "letter": state_cache.get("letter_full", ""),
+                "output_path": output_path,
+            })
+        return Response(cached(), mimetype="text/event-stream")
+
+    if force:
+        _reset_downstream_steps(cache_dir, "writer")
+
+    state: GraphState = {
+        "input_dir": input_dir,
+        "output_path": output_path,
+        "model": model,
+        "llm": get_chat_model(model),
+        "files": state_cache.get("files", []),
+        "grouped": state_cache.get("grouped", {}),
+        "summary_profile": state_cache.get("summary_profile", ""),
+        "summary_sections": state_cache.get("summary_sections", {}),
+        "writer_context": writer_context or state_cache.get("writer_context", ""),
+        "letter_full": state_cache.get("letter_full", ""),
+    }
+
+    def generate():
+        yield sse({"type": "start"})
+        try:
+            with llm_call_scope("writer", project_id):
+                for chunk in stream_letter_writer(state):
+                    yield sse({"type": "token", "text": chunk})
+        except Exception as e:
+            yield sse({"type": "error", "message": str(e)})
+            return
+
+        # Persist exactly like /api/run_step does for the writer step
+        _save_state(cache_dir, state)
+        _save_step_output(cache_dir, "writer", state)
+        if project_id:
+            db.save_letter_state(
+                project_id,
+                step_writer=True,
+                writer_context=state.get("writer_context", ""),
+                letter_content=state.get("letter_full", ""),
+            )
+        yield sse({"type": "done", "status": "done", "letter": state.get("letter_full", ""), "output_path": output_path})
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/run_all")
 def run_all():
     payload = request.get_json(force=True) or {}
@@ -1753,12 +1980,16 @@ def run_all():
     output_path = payload.get("output", os.path.join("output", "letter.txt"))
     model = payload.get("model") or get_vision_model()  # pipeline includes ingest (images)
     force = bool(payload.get("force", False))
+    full = bool(payload.get("full", False))  # ignore fingerprints and re-extract every file
     writer_context = (payload.get("writer_context") or "").strip()
-    project_id = payload.get("project_id", type=int) if isinstance(payload.get("project_id"), int) else None
+    project_id = payload.get("project_id") if isinstance(payload.get("project_id"), int) else None
 
     cache_dir = _cache_dir(output_path)
     state_cache = _load_state(cache_dir)
-    llm = ChatOpenAI(model=model, temperature=0)
+    if force:
+        # Same as /api/run_step with force on the summary step: regenerate every section
+        state_cache["summary_sections"] = {}
+    llm = get_chat_model(model)
     state: GraphState = {
         "input_dir": input_dir,
         "output_path": output_path,
@@ -1767,14 +1998,17 @@ def run_all():
         "files": state_cache.get("files", []),
         "grouped": state_cache.get("grouped", {}),
         "summary_profile": state_cache.get("summary_profile", ""),
+        "summary_sections": state_cache.get("summary_sections", {}),
         "writer_context": writer_context or state_cache.get("writer_context", ""),
         "letter_full": state_cache.get("letter_full", ""),
+        "full_reingest": full,
     }
 
     for step in STEP_ORDER:
         if _is_step_done(cache_dir, step) and not force:
             continue
-        state = _run_single_step(step, state)
+        with llm_call_scope(step, project_id):
+            state = _run_single_step(step, state)
         _save_state(cache_dir, state)
         _save_step_output(cache_dir, step, state)
 
@@ -1802,6 +2036,7 @@ def run_add_file():
     file_ref = payload.get("file")
     model = payload.get("model") or get_vision_model()  # reads input files (images/PDFs)
     writer_context = (payload.get("writer_context") or "").strip()
+    project_id = payload.get("project_id") if isinstance(payload.get("project_id"), int) else None
 
     if not file_ref:
         return jsonify({"error": "missing_file"}), 400
@@ -1812,7 +2047,7 @@ def run_add_file():
 
     cache_dir = _cache_dir(output_path)
     state_cache = _load_state(cache_dir)
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
     state: GraphState = {
         "input_dir": input_dir,
         "output_path": output_path,
@@ -1821,24 +2056,20 @@ def run_add_file():
         "files": state_cache.get("files", []),
         "grouped": state_cache.get("grouped", {}),
         "summary_profile": state_cache.get("summary_profile", ""),
+        "summary_sections": state_cache.get("summary_sections", {}),
         "writer_context": writer_context or state_cache.get("writer_context", ""),
         "letter_full": state_cache.get("letter_full", ""),
     }
 
-    filename = os.path.basename(resolved_path)
-    text = extract_text_with_openai(llm, resolved_path)
-    new_file = {
-        "path": resolved_path,
-        "name": filename,
-        "text": text,
-        "domain": detect_domain(filename),
-    }
+    with llm_call_scope("ingest", project_id):
+        new_file = build_file_record(llm, resolved_path)
     state["files"] = _upsert_file_record(state.get("files", []), new_file)
     _save_state(cache_dir, state)
     _save_step_output(cache_dir, "ingest", state)
 
     for step in ["summary", "writer"]:
-        state = _run_single_step(step, state)
+        with llm_call_scope(step, project_id):
+            state = _run_single_step(step, state)
         _save_state(cache_dir, state)
         _save_step_output(cache_dir, step, state)
 
@@ -1891,7 +2122,7 @@ def run_itinerary():
     if not summary_profile:
         summary_profile = "Create itinerary from the provided flight and hotel booking data."
 
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
 
     # ── Load flight/hotel text from DB or files ──
     if from_db and project_id:
@@ -1985,7 +2216,7 @@ def run_itinerary_stream():
         if not summary_profile:
             summary_profile = "Create itinerary from the provided flight and hotel booking data."
 
-        llm = ChatOpenAI(model=model, temperature=0)
+        llm = get_chat_model(model)
 
         try:
             # Step 1: Load booking data
@@ -2298,7 +2529,7 @@ def extract_trip():
         if saved_ti and saved_ti.get("data", {}).get("guest_names"):
             saved_guest_names = saved_ti["data"]["guest_names"]
 
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model(model)
 
     try:
         trip_info = extract_trip_info(llm, input_dir, guest_names=saved_guest_names)
@@ -2319,10 +2550,11 @@ def extract_trip():
 
     # Save to DB
     if project_id:
-        db.save_trip_info(int(project_id), trip_info)
-        # Update input hash
         input_hash = db.compute_input_hash(input_dir)
-        db.update_project(int(project_id), input_hash=input_hash)
+        with db.unit_of_work():
+            db.save_trip_info(int(project_id), trip_info)
+            # Update input hash
+            db.update_project(int(project_id), input_hash=input_hash)
 
     return jsonify({"status": "success", "trip_info": trip_info})
 
@@ -2423,7 +2655,7 @@ def ai_generate_booking():
             with open(trip_cache_path, "r", encoding="utf-8") as f:
                 trip_info = json.load(f)
 
-        llm = ChatOpenAI(model=model, temperature=0)
+        llm = get_chat_model(model)
 
         try:
             trip_info, booking_data = generate_ai_booking(llm, input_dir, trip_info)
@@ -2555,7 +2787,7 @@ def ai_generate_booking_stream():
                 with open(trip_cache_path, "r", encoding="utf-8") as f:
                     trip_info = json.load(f)
 
-            llm = ChatOpenAI(model=model, temperature=0)
+            llm = get_chat_model(model)
 
             def progress_cb(step, msg):
                 pass  # Can't yield inside callback; we handle steps inline
@@ -2586,7 +2818,7 @@ def ai_generate_booking_stream():
                     yield from send_event(2, "⏳ AI đang chọn chuyến bay...")
                 else:
                     yield from send_event(2, "⏳ AI đang chọn khách sạn & chuyến bay...")
-                booking_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+                booking_llm = get_chat_model("gpt-4o-mini")
                 booking_data = ai_select_bookings(booking_llm, trip_info)
                 if target == "hotel":
                     yield from send_event(2, "✅ AI đã chọn xong khách sạn")
@@ -2894,12 +3126,13 @@ def generate_flight_from_serp():
 
 import uuid
 import shutil
-import zipfile
 import threading
 from pathlib import Path as SplitterPath
 
-from pdf_tools.pdf_service import pdf_to_images, get_page_count, create_output_files
-from pdf_tools.ai_service import classify_all_pages
+from pdf_tools.pdf_service import iter_page_inputs, get_page_count, create_output_files, iter_zip_stream
+from pdf_tools.ai_service import classify_page_stream
+from pdf_tools.page_cache import get_page_cache, get_page_cache_stats
+from pdf_tools.rate_limit import get_rate_limiter_stats
 
 # Directories for AI splitter
 SPLITTER_UPLOAD_DIR = SplitterPath(__file__).parent / "splitter_uploads"
@@ -2907,62 +3140,157 @@ SPLITTER_OUTPUT_DIR = SplitterPath(__file__).parent / "splitter_outputs"
 SPLITTER_UPLOAD_DIR.mkdir(exist_ok=True)
 SPLITTER_OUTPUT_DIR.mkdir(exist_ok=True)
 
-# In-memory job tracking for AI splitter
-splitter_jobs: Dict[str, Dict] = {}
+# Durable job queue for AI splitter: jobs live in the `splitter_jobs` table and a
+# bounded pool of worker threads (one event loop each) claims them one at a time.
+SPLITTER_MAX_WORKERS = max(1, int(os.getenv("SPLITTER_MAX_WORKERS", "2")))
+SPLITTER_JOB_STALE_SEC = int(os.getenv("SPLITTER_JOB_STALE_SEC", "120"))
+SPLITTER_HEARTBEAT_SEC = 30
+# Pages with at least this many characters of text layer skip vision (0 = always use vision)
+SPLITTER_TEXT_MIN_CHARS = int(os.getenv("SPLITTER_TEXT_MIN_CHARS", "200"))
+SPLITTER_POLL_SEC = 2.0
+# Progress streams re-read the DB at least this often (jobs may run in another process)
+SPLITTER_EVENTS_POLL_SEC = 2.0
+SPLITTER_EVENTS_KEEPALIVE_SEC = 15.0
+
+_splitter_wakeup = threading.Event()
+_splitter_progress = threading.Condition()
+_splitter_progress_versions: Dict[str, int] = {}
+_splitter_workers_lock = threading.Lock()
+_splitter_workers_started = False
+_splitter_busy_workers = 0
+
+
+def _ensure_splitter_workers():
+    """Start the worker pool (once per process). Called at startup so jobs left running
+    by a crashed process are reclaimed once their heartbeat goes stale."""
+    global _splitter_workers_started
+    with _splitter_workers_lock:
+        if _splitter_workers_started:
+            return
+        _splitter_workers_started = True
+        for i in range(SPLITTER_MAX_WORKERS):
+            threading.Thread(
+                target=_splitter_worker_loop, name=f"splitter-worker-{i}", daemon=True
+            ).start()
+
+
+def _wake_splitter_workers():
+    _ensure_splitter_workers()
+    _splitter_wakeup.set()
+
+
+def _notify_splitter_progress(file_id: str):
+    """Wake progress streams watching this job (call after persisting a change)."""
+    with _splitter_progress:
+        _splitter_progress_versions[file_id] = _splitter_progress_versions.get(file_id, 0) + 1
+        _splitter_progress.notify_all()
+
+
+def _wait_splitter_progress(file_id: str, seen: int, timeout: float) -> int:
+    """Block until the job's version moves past ``seen`` or ``timeout`` elapses."""
+    with _splitter_progress:
+        _splitter_progress.wait_for(
+            lambda: _splitter_progress_versions.get(file_id, 0) != seen, timeout
+        )
+        return _splitter_progress_versions.get(file_id, 0)
 
 
-def _run_splitter_job(file_id: str):
-    """Run AI PDF splitting in a background thread with its own event loop."""
+def _splitter_worker_loop():
+    """Claim queued (or stale) jobs from the DB and run them on this thread's event loop."""
+    global _splitter_busy_workers
     import asyncio
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(_process_splitter_job(file_id))
-    finally:
-        loop.close()
+    while True:
+        try:
+            job = db.claim_next_splitter_job(SPLITTER_JOB_STALE_SEC)
+        except Exception as e:
+            print(f"[AI Splitter] Queue error: {e}")
+            job = None
+        if job is None:
+            _splitter_wakeup.wait(SPLITTER_POLL_SEC)
+            _splitter_wakeup.clear()
+            continue
+        with _splitter_workers_lock:
+            _splitter_busy_workers += 1
+        _notify_splitter_progress(job["id"])
+        try:
+            loop.run_until_complete(_process_splitter_job(job))
+        finally:
+            with _splitter_workers_lock:
+                _splitter_busy_workers -= 1
 
 
-async def _process_splitter_job(file_id: str):
-    """Process a PDF file: convert → classify → split."""
-    job = splitter_jobs[file_id]
+async def _splitter_heartbeat(file_id: str):
+    import asyncio
+    while True:
+        await asyncio.sleep(SPLITTER_HEARTBEAT_SEC)
+        db.update_splitter_job(file_id)
+
+
+async def _process_splitter_job(job: Dict):
+    """Process a PDF file: render + classify (streamed) → split."""
+    import asyncio
+    file_id = job["id"]
+    heartbeat = asyncio.create_task(_splitter_heartbeat(file_id))
     try:
-        # Step 1: Convert PDF pages to images
-        job["status"] = "converting"
-        images = pdf_to_images(job["file_path"])
+        # Step 1+2: Render pages lazily and classify each batch as soon as it is ready
+        total_pages = job.get("page_count") or get_page_count(job["file_path"])
+        completed = {
+            tuple(int(p) for p in k.split(",")): v for k, v in (job.get("batch_results") or {}).items()
+        }
+        if completed:
+            print(f"[AI Splitter] Resuming {file_id}: {len(completed)} batches already classified")
+        db.update_splitter_job(file_id, status="classifying", current_page=0, classifications=[], error=None)
+        _notify_splitter_progress(file_id)
 
-        # Step 2: Classify each page with AI
-        job["status"] = "classifying"
+        progress: List[Dict] = []
+        last_saved = 0
 
         async def progress_callback(page_num, total, result):
-            job["current_page"] = page_num
-            job["classifications"].append({
+            nonlocal last_saved
+            progress.append({
                 "page": page_num,
                 "document_type_en": result.get("document_type_en", ""),
                 "person_name_en": result.get("person_name_en", ""),
                 "is_continuation": result.get("is_continuation", False),
             })
-
-        classifications = await classify_all_pages(
-            images, progress_callback=progress_callback
+            # Persist roughly once per batch
+            if page_num - last_saved >= 5 or page_num >= total:
+                last_saved = page_num
+                db.update_splitter_job(file_id, current_page=page_num, classifications=progress)
+                _notify_splitter_progress(file_id)
+
+        async def batch_callback(page_nums, results):
+            db.record_splitter_batch(file_id, page_nums, results)
+
+        classifications = await classify_page_stream(
+            iter_page_inputs(job["file_path"], min_text_chars=SPLITTER_TEXT_MIN_CHARS), total_pages,
+            progress_callback=progress_callback,
+            completed_batches=completed,
+            batch_callback=batch_callback,
+            page_cache=get_page_cache(),
         )
 
         # Update with post-processed data
-        job["classifications"] = []
-        for idx, cls in enumerate(classifications):
-            job["classifications"].append({
+        final_classifications = [
+            {
                 "page": idx + 1,
                 "document_type_en": cls.get("document_type_en", ""),
                 "person_name_en": cls.get("person_name_en", ""),
                 "is_continuation": cls.get("is_continuation", False),
-            })
+            }
+            for idx, cls in enumerate(classifications)
+        ]
 
         # Step 3: Create output files
-        job["status"] = "splitting"
+        db.update_splitter_job(file_id, status="splitting", classifications=final_classifications)
+        _notify_splitter_progress(file_id)
         job_output_dir = str(SPLITTER_OUTPUT_DIR / file_id)
-        output_files = create_output_files(
-            job["file_path"], classifications, job_output_dir
+        # Off the event loop: writing the PDFs can take minutes and would starve the heartbeat
+        output_files = await asyncio.get_running_loop().run_in_executor(
+            None, create_output_files, job["file_path"], classifications, job_output_dir
         )
-        job["output_files"] = output_files
 
         # Save source metadata for persistent display
         source_meta = {"source_filename": job["filename"], "source_type": "ai"}
@@ -2972,18 +3300,20 @@ async def _process_splitter_job(file_id: str):
         with open(os.path.join(job_output_dir, "_source.json"), "w", encoding="utf-8") as mf:
             json.dump(source_meta, mf, ensure_ascii=False)
 
-        # Step 4: Create ZIP
-        zip_path = str(SPLITTER_OUTPUT_DIR / f"{file_id}.zip")
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-            for f in output_files:
-                zf.write(f["path"], f["filename"])
-        job["zip_path"] = zip_path
-        job["status"] = "completed"
+        # ZIP is built on demand by /download-zip, nothing more to write here
+        db.update_splitter_job(
+            file_id,
+            status="completed",
+            output_files=output_files,
+            finished_at=datetime.utcnow(),
+        )
 
     except Exception as e:
-        job["status"] = "error"
-        job["error"] = str(e)
+        db.update_splitter_job(file_id, status="error", error=str(e), finished_at=datetime.utcnow())
         print(f"[AI Splitter] Error processing {file_id}: {e}")
+    finally:
+        heartbeat.cancel()
+        _notify_splitter_progress(file_id)
 
 
 @app.get("/api/ai-splitter/list")
@@ -3077,8 +3407,6 @@ def splitter_process_local():
     if not src_path.is_file():
         return jsonify({"error": "file_not_found"}), 404
 
-    import threading
-
     # Normalise project_id to int if possible
     if isinstance(project_id, int):
         pid: Optional[int] = project_id
@@ -3096,22 +3424,11 @@ def splitter_process_local():
 
     page_count = get_page_count(str(file_path))
 
-    splitter_jobs[file_id] = {
-        "status": "uploaded",
-        "filename": filename,
-        "project_id": pid,
-        "file_path": str(file_path),
-        "page_count": page_count,
-        "current_page": 0,
-        "classifications": [],
-        "output_files": [],
-        "error": None,
-        "zip_path": None,
-    }
-
-    # Run in background thread (same as upload flow)
-    thread = threading.Thread(target=_run_splitter_job, args=(file_id,), daemon=True)
-    thread.start()
+    with db.unit_of_work():
+        db.create_splitter_job(file_id, filename, str(file_path), page_count, project_id=pid)
+        db.enqueue_splitter_job(file_id)
+    _notify_splitter_progress(file_id)
+    _wake_splitter_workers()
 
     return jsonify({"file_id": file_id, "filename": filename, "page_count": page_count})
 
@@ -3137,18 +3454,7 @@ def splitter_upload():
 
     page_count = get_page_count(str(file_path))
 
-    splitter_jobs[file_id] = {
-        "status": "uploaded",
-        "filename": file.filename,
-        "project_id": pid,
-        "file_path": str(file_path),
-        "page_count": page_count,
-        "current_page": 0,
-        "classifications": [],
-        "output_files": [],
-        "error": None,
-        "zip_path": None,
-    }
+    db.create_splitter_job(file_id, file.filename, str(file_path), page_count, project_id=pid)
 
     return jsonify({
         "file_id": file_id,
@@ -3159,32 +3465,36 @@ def splitter_upload():
 
 @app.post("/api/ai-splitter/process/<file_id>")
 def splitter_process(file_id: str):
-    if file_id not in splitter_jobs:
-        return jsonify({"error": "not_found"}), 404
-    job = splitter_jobs[file_id]
-    if job["status"] in ("processing", "classifying", "converting", "splitting"):
-        return jsonify({"message": "already_processing"})
-    if job["status"] == "completed":
-        return jsonify({"message": "already_completed"})
-
-    job["status"] = "processing"
-    job["current_page"] = 0
-    job["classifications"] = []
-    job["output_files"] = []
-    job["error"] = None
-
-    # Run in background thread (separate event loop for async code)
-    t = threading.Thread(target=_run_splitter_job, args=(file_id,), daemon=True)
-    t.start()
+    with db.unit_of_work():
+        job = db.get_splitter_job(file_id)
+        if not job:
+            return jsonify({"error": "not_found"}), 404
+        if job["status"] == "queued" or job["status"] in db.SPLITTER_RUNNING_STATUSES:
+            return jsonify({"message": "already_processing"})
+        if job["status"] == "completed":
+            return jsonify({"message": "already_completed"})
+
+        if not db.enqueue_splitter_job(file_id):
+            return jsonify({"message": "already_processing"})
+    # Workers only see the job once the transaction above has committed
+    _notify_splitter_progress(file_id)
+    _wake_splitter_workers()
 
-    return jsonify({"message": "processing_started", "file_id": file_id})
+    return jsonify({
+        "message": "processing_started",
+        "file_id": file_id,
+        "queue_position": db.splitter_queue_position(file_id),
+    })
 
 
 @app.get("/api/ai-splitter/status/<file_id>")
 def splitter_status(file_id: str):
-    if file_id not in splitter_jobs:
+    job = db.get_splitter_job(file_id)
+    if not job:
         return jsonify({"error": "not_found"}), 404
-    job = splitter_jobs[file_id]
+    if job["status"] == "queued":
+        # Make sure this process is working the queue (e.g. right after a restart)
+        _ensure_splitter_workers()
     resp = {
         "file_id": file_id,
         "filename": job["filename"],
@@ -3194,6 +3504,8 @@ def splitter_status(file_id: str):
         "error": job["error"],
         "classifications": job.get("classifications", []),
     }
+    if job["status"] == "queued":
+        resp["queue_position"] = db.splitter_queue_position(file_id)
     if job["status"] == "completed":
         resp["output_files"] = [
             {
@@ -3207,9 +3519,118 @@ def splitter_status(file_id: str):
     return jsonify(resp)
 
 
+@app.get("/api/ai-splitter/events/<file_id>")
+def splitter_events(file_id: str):
+    """
+    SSE progress stream for one splitter job.
+    Sends only what changed: new page classifications ("pages"), status/progress
+    transitions ("status"), then "done" or "error". The event id is the number of
+    pages already sent, so a reconnecting EventSource resumes via Last-Event-ID.
+    """
+    if db.get_splitter_progress(file_id) is None:
+        return jsonify({"error": "not_found"}), 404
+    raw_cursor = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "0"
+    try:
+        start_cursor = max(0, int(raw_cursor))
+    except ValueError:
+        start_cursor = 0
+
+    def sse(data: Dict, event_id: Optional[int] = None) -> str:
+        prefix = f"id: {event_id}\n" if event_id is not None else ""
+        return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def generate():
+        cursor = start_cursor
+        last_status = None
+        seen = _splitter_progress_versions.get(file_id, 0)
+        idle = 0.0
+        while True:
+            job = db.get_splitter_progress(file_id)
+            if job is None:
+                yield sse({"type": "error", "error": "not_found"})
+                return
+            if job["status"] == "queued":
+                _ensure_splitter_workers()
+
+            classifications = job["classifications"]
+            if len(classifications) < cursor:
+                # Job was restarted: the client must drop what it has
+                cursor = 0
+                yield sse({"type": "reset"}, cursor)
+            if len(classifications) > cursor:
+                new_pages = classifications[cursor:]
+                cursor = len(classifications)
+                yield sse({"type": "pages", "pages": new_pages}, cursor)
+
+            status = {
+                "type": "status",
+                "status": job["status"],
+                "page_count": job["page_count"],
+                "current_page": job["current_page"],
+            }
+            if job["status"] == "queued":
+                status["queue_position"] = db.splitter_queue_position(file_id)
+            if status != last_status:
+                last_status = status
+                idle = 0.0
+                yield sse(status, cursor)
+
+            if job["status"] == "completed":
+                # Post-processing may relabel pages already sent, so ship the final list once
+                yield sse({
+                    "type": "done",
+                    "classifications": classifications,
+                    "output_files": [
+                        {
+                            "filename": f["filename"],
+                            "document_type": f["document_type"],
+                            "person_name": f["person_name"],
+                            "pages": f["pages"],
+                        }
+                        for f in job["output_files"]
+                    ],
+                }, cursor)
+                return
+            if job["status"] == "error":
+                yield sse({"type": "error", "error": job["error"]}, cursor)
+                return
+
+            version = _wait_splitter_progress(file_id, seen, SPLITTER_EVENTS_POLL_SEC)
+            if version == seen:
+                idle += SPLITTER_EVENTS_POLL_SEC
+                if idle >= SPLITTER_EVENTS_KEEPALIVE_SEC:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+            seen = version
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@app.get("/api/metrics/rate_limits")
+def rate_limit_metrics():
+    return jsonify(get_rate_limiter_stats())
+
+
+@app.get("/api/metrics/page_cache")
+def page_cache_metrics():
+    return jsonify(get_page_cache_stats())
+
+
+@app.get("/api/metrics/splitter_queue")
+def splitter_queue_metrics():
+    stats = db.get_splitter_queue_stats()
+    with _splitter_workers_lock:
+        stats["workers"] = SPLITTER_MAX_WORKERS if _splitter_workers_started else 0
+        stats["busy_workers"] = _splitter_busy_workers
+    return jsonify(stats)
+
+
 @app.get("/api/ai-splitter/download/<file_id>/<filename>")
 def splitter_download_single(file_id: str, filename: str):
-    # Check both splitter_jobs (AI) and filesystem (manual splits)
+    # Served straight from disk (AI and manual splits share the layout)
     file_path = SPLITTER_OUTPUT_DIR / file_id / filename
     if not file_path.exists():
         return jsonify({"error": "file_not_found"}), 404
@@ -3229,14 +3650,20 @@ def splitter_view_single(file_id: str, filename: str):
 
 @app.get("/api/ai-splitter/download-zip/<file_id>")
 def splitter_download_zip(file_id: str):
-    if file_id not in splitter_jobs:
+    job = db.get_splitter_job(file_id)
+    if not job:
         return jsonify({"error": "not_found"}), 404
-    job = splitter_jobs[file_id]
-    if job["status"] != "completed" or not job.get("zip_path"):
+    if job["status"] != "completed" or not job.get("output_files"):
         return jsonify({"error": "not_ready"}), 400
-    zip_path = SplitterPath(job["zip_path"])
-    return send_from_directory(str(zip_path.parent), zip_path.name,
-                                as_attachment=True, mimetype="application/zip")
+    files = [(f["path"], f["filename"]) for f in job["output_files"]]
+    if not all(os.path.isfile(path) for path, _ in files):
+        return jsonify({"error": "file_not_found"}), 404
+    # Stream the archive as it is built: no temp ZIP on disk, PDFs stored (not deflated)
+    return Response(
+        iter_zip_stream(files),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{file_id}.zip"'},
+    )
 
 
 @app.get("/api/ai-splitter/list-outputs")
@@ -3276,11 +3703,13 @@ def splitter_list_outputs():
                     source_project_id = meta.get("project_id")
                 except Exception:
                     pass
-            # Fallback to in-memory splitter_jobs
-            if not source_name and not is_manual and folder_name in splitter_jobs:
-                source_name = splitter_jobs[folder_name].get("filename", "")
-                if source_project_id is None:
-                    source_project_id = splitter_jobs[folder_name].get("project_id")
+            # Fallback to the splitter job record
+            if not source_name and not is_manual:
+                job = db.get_splitter_job(folder_name)
+                if job:
+                    source_name = job.get("filename", "")
+                    if source_project_id is None:
+                        source_project_id = job.get("project_id")
 
             # Filter by project if requested
             if project_id is not None and source_project_id != project_id:
@@ -3326,59 +3755,16 @@ def manual_split_upload_and_split():
     file.save(tmp_path)
 
     try:
-        reader = PdfReader(tmp_path)
+        total_pages = get_page_count(tmp_path)
     except Exception as exc:
         shutil.rmtree(tmp_dir, ignore_errors=True)
         return jsonify({"error": "read_pdf_failed", "detail": str(exc)}), 500
 
-    total_pages = len(reader.pages)
-    created: list[dict[str, Any]] = []
-
-    def _sanitize_name(value: str, fallback: str) -> str:
-        text = (value or "").strip()
-        text = re.sub(r"[\\/:*?\"<>|]+", " ", text)
-        text = re.sub(r"\s+", " ", text).strip()
-        return text or fallback
-
-    def _pick_unique(dest_dir: str, stem: str, ext: str) -> str:
-        candidate = os.path.join(dest_dir, f"{stem}{ext}")
-        idx = 1
-        while os.path.exists(candidate):
-            candidate = os.path.join(dest_dir, f"{stem} ({idx}){ext}")
-            idx += 1
-        return candidate
-
-    for seg in segments:
-        if not isinstance(seg, dict):
-            continue
-        name = _sanitize_name(seg.get("output_name") or "", "DOCUMENT")
-        try:
-            s = int(seg.get("start_page"))
-            e = int(seg.get("end_page"))
-        except Exception:
-            continue
-        if s < 1 or e < 1 or s > total_pages or e > total_pages:
-            continue
-        if s > e:
-            s, e = e, s
-        writer = PdfWriter()
-        for i in range(s - 1, e):
-            writer.add_page(reader.pages[i])
-        out_path = _pick_unique(output_dir, name, ".pdf")
-        try:
-            with open(out_path, "wb") as f:
-                writer.write(f)
-        except Exception:
-            continue
-        created.append(
-            {
-                "output_name": name,
-                "start_page": s,
-                "end_page": e,
-                "to": os.path.relpath(out_path, output_dir).replace("\\", "/"),
-                "file_id": manual_id,
-            }
-        )
+    try:
+        created = _write_manual_segments(tmp_path, total_pages, segments, output_dir, manual_id)
+    except Exception as exc:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return jsonify({"error": "split_failed", "detail": str(exc)}), 500
 
     # Clean up temp
     shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -3565,7 +3951,7 @@ def splitter_merge_outputs():
 @app.post("/api/ai-splitter/clear-outputs")
 def splitter_clear_outputs():
     """Delete ALL output folders in splitter_outputs/ (AI + manual).
-    Also clears in-memory splitter_jobs."""
+    Also drops finished splitter job records (queued/running jobs are kept)."""
     output_dir = str(SPLITTER_OUTPUT_DIR)
     deleted_count = 0
     if os.path.isdir(output_dir):
@@ -3577,7 +3963,7 @@ def splitter_clear_outputs():
             elif os.path.isfile(path):
                 os.remove(path)  # remove .zip files etc.
                 deleted_count += 1
-    splitter_jobs.clear()
+    db.delete_finished_splitter_jobs()
     return jsonify({"status": "done", "deleted_count": deleted_count})
 
 
@@ -3611,14 +3997,16 @@ def translate_upload_file():
     ext = ext or ".bin"
     token = uuid.uuid4().hex
     out_name = f"translate_{token}{ext}"
-    out_path = os.path.join(tempfile.gettempdir(), out_name)
+    out_path = os.path.join(TRANSLATE_UPLOAD_DIR, out_name)
 
+    _purge_stale_translation_uploads()
     try:
+        os.makedirs(TRANSLATE_UPLOAD_DIR, exist_ok=True)
         f.save(out_path)
+        _save_translation_upload(token, {"temp_path": out_path, "filename": safe_name})
     except Exception as e:
         return jsonify({"error": "save_failed", "detail": str(e)}), 500
 
-    translation_upload_cache[token] = {"temp_path": out_path, "filename": safe_name}
     file_ref = f"upload_token:{token}"
     return jsonify(
         {
@@ -3639,6 +4027,7 @@ def run_translate_stream():
     flow_id = payload.get("flow_id") or 1
     ocr_model = payload.get("ocr_model") or get_text_model()  # default gpt-5-mini
     translate_model = payload.get("translate_model") or get_text_model()
+    project_id = payload.get("project_id") if isinstance(payload.get("project_id"), int) else None
 
     if not file_ref:
         return jsonify({"error": "missing_file_ref"}), 400
@@ -3667,80 +4056,83 @@ def run_translate_stream():
                 evt["data"] = data
             yield f"data: {json.dumps(evt, ensure_ascii=False)}\n\n"
 
-        try:
-            # Step 1: OCR
-            yield from send_event(1, "⏳ Đang OCR tài liệu...")
-            llm_ocr = ChatOpenAI(model=ocr_model, temperature=0)
-            ocr_text = _ocr_document_for_translation(llm_ocr, source_path)
-            if not ocr_text.strip():
-                yield from send_event(-1, "❌ Không trích xuất được OCR từ file")
-                return
-            yield from send_event(1, "✅ OCR hoàn tất")
-
-            # Step 2: Translate
-            yield from send_event(2, "⏳ Đang dịch sang tiếng Anh...")
-            llm_translate = ChatOpenAI(model=translate_model, temperature=0)
-            translated_text = _translate_ocr_text(llm_translate, ocr_text)
-            if not translated_text.strip():
-                yield from send_event(-1, "❌ Không tạo được bản dịch")
-                return
-            yield from send_event(2, "✅ Dịch hoàn tất")
-
-            # Step 3: Build HTML
-            yield from send_event(3, "⏳ Đang tạo HTML theo template...")
-            source_pdf_text = extract_text_with_openai(llm_ocr, source_path) or ocr_text
-            html_result = _build_translation_html(
-                llm_translate,
-                translated_text,
-                template_html,
-                source_pdf_text,
-            )
-            if not html_result.strip():
-                yield from send_event(-1, "❌ Không tạo được HTML")
-                return
-            yield from send_event(3, "✅ Tạo HTML hoàn tất")
-
-            file_stem = os.path.splitext(os.path.basename(source_path))[0]
-            safe_stem = _safe_name(file_stem) or "translated_document"
-            out_dir = os.path.join(TRANSLATE_OUTPUT_DIR, f"flow_{flow_id}")
-            os.makedirs(out_dir, exist_ok=True)
-
-            ocr_path = os.path.join(out_dir, f"{safe_stem}.ocr.txt")
-            translated_path = os.path.join(out_dir, f"{safe_stem}.translated.txt")
-            html_path = os.path.join(out_dir, f"{safe_stem}.translated.html")
-            with open(ocr_path, "w", encoding="utf-8") as f:
-                f.write(ocr_text)
-            with open(translated_path, "w", encoding="utf-8") as f:
-                f.write(translated_text)
-            with open(html_path, "w", encoding="utf-8") as f:
-                f.write(html_result)
-
-            yield from send_event(
-                4,
-                "✅ Hoàn tất",
-                {
-                    "ocr_text": ocr_text,
-                    "translated_text": translated_text,
-                    "html": html_result,
-                    "paths": {
-                        "ocr_path": ocr_path,
-                        "translated_path": translated_path,
-                        "html_path": html_path,
+        # One scope for the whole request: OCR, translation and HTML share the
+        # duplicate-prompt registry and are attributed to the project
+        with llm_call_scope("translate", project_id):
+            try:
+                # Step 1: OCR
+                yield from send_event(1, "⏳ Đang OCR tài liệu...")
+                llm_ocr = get_chat_model(ocr_model)
+                ocr_text = _ocr_document_for_translation(llm_ocr, source_path)
+                if not ocr_text.strip():
+                    yield from send_event(-1, "❌ Không trích xuất được OCR từ file")
+                    return
+                yield from send_event(1, "✅ OCR hoàn tất")
+
+                # Step 2: Translate
+                yield from send_event(2, "⏳ Đang dịch sang tiếng Anh...")
+                llm_translate = get_chat_model(translate_model)
+                translated_text = _translate_ocr_text(llm_translate, ocr_text)
+                if not translated_text.strip():
+                    yield from send_event(-1, "❌ Không tạo được bản dịch")
+                    return
+                yield from send_event(2, "✅ Dịch hoàn tất")
+
+                # Step 3: Build HTML
+                yield from send_event(3, "⏳ Đang tạo HTML theo template...")
+                source_pdf_text = extract_text_with_openai(llm_ocr, source_path) or ocr_text
+                html_result = _build_translation_html(
+                    llm_translate,
+                    translated_text,
+                    template_html,
+                    source_pdf_text,
+                )
+                if not html_result.strip():
+                    yield from send_event(-1, "❌ Không tạo được HTML")
+                    return
+                yield from send_event(3, "✅ Tạo HTML hoàn tất")
+
+                file_stem = os.path.splitext(os.path.basename(source_path))[0]
+                safe_stem = _safe_name(file_stem) or "translated_document"
+                out_dir = os.path.join(TRANSLATE_OUTPUT_DIR, f"flow_{flow_id}")
+                os.makedirs(out_dir, exist_ok=True)
+
+                ocr_path = os.path.join(out_dir, f"{safe_stem}.ocr.txt")
+                translated_path = os.path.join(out_dir, f"{safe_stem}.translated.txt")
+                html_path = os.path.join(out_dir, f"{safe_stem}.translated.html")
+                with open(ocr_path, "w", encoding="utf-8") as f:
+                    f.write(ocr_text)
+                with open(translated_path, "w", encoding="utf-8") as f:
+                    f.write(translated_text)
+                with open(html_path, "w", encoding="utf-8") as f:
+                    f.write(html_result)
+
+                yield from send_event(
+                    4,
+                    "✅ Hoàn tất",
+                    {
+                        "ocr_text": ocr_text,
+                        "translated_text": translated_text,
+                        "html": html_result,
+                        "paths": {
+                            "ocr_path": ocr_path,
+                            "translated_path": translated_path,
+                            "html_path": html_path,
+                        },
                     },
-                },
-            )
-        except Exception as e:
-            yield from send_event(-1, f"❌ Lỗi: {str(e)}")
-        finally:
-            # Cleanup temporary uploaded file (if any)
-            if upload_token:
-                meta = translation_upload_cache.pop(upload_token, None) or {}
-                temp_path = meta.get("temp_path", "")
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except Exception:
-                        pass
+                )
+            except Exception as e:
+                yield from send_event(-1, f"❌ Lỗi: {str(e)}")
+            finally:
+                # Cleanup temporary uploaded file (if any)
+                if upload_token:
+                    meta = _pop_translation_upload(upload_token)
+                    temp_path = meta.get("temp_path", "")
+                    if temp_path and os.path.exists(temp_path):
+                        try:
+                            os.remove(temp_path)
+                        except Exception:
+                            pass
 
     return Response(
         generate(),
@@ -3791,6 +4183,21 @@ def translate_save_html():
 
 
 if __name__ == "__main__":
+    # Dev server (reloader + debugger). Production: python serve.py
+    # The reloader parent and child run this one after the other, never concurrently
+    db.init_db()
+    # Only the reloader's child process serves requests, so only it runs splitter workers
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        _ensure_splitter_workers()
+        db.start_blob_maintenance()
     app.run(host="127.0.0.1", port=8000, debug=True)
+elif __name__ == "server":
+    # Imported by serve.py / a WSGI server: resume queued and orphaned jobs right away.
+    # (Not when re-imported as __mp_main__ by a spawned render/split process.)
+    # serve.py has already set up the schema in the master process
+    if os.environ.get("VISA_DB_INITIALIZED") != "1":
+        db.init_db()
+    _ensure_splitter_workers()
+    db.start_blob_maintenance()
 
 
@@ -78,4 +78,4 @@ echo   Bam Ctrl+C de dung server
 echo ============================================
 echo.
 start http://127.0.0.1:8000
-python server.py
+python serve.py